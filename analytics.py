@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Offline reports over collected beacon events
+#
+# Dictionary : Encodes the distinct values of a string column as dense integer codes
+# EventBatch : A chunk of events as columnar NumPy arrays
+# GroupCounts : Event counts keyed by (customer, value) pairs, merged chunk by chunk
+# Report : Per-customer aggregates accumulated over event batches
+#
+# Usage: python analytics.py [--customer ID] [--chunk-size N] [--bucket SECONDS] [--top N] PATH [PATH ...]
+#
+# Events are read from event log segments in chunks of chunk_size records.
+# Each chunk becomes one array per beacon field: strings dictionary encoded as
+# int32 codes, timestamps as int64 epoch milliseconds, screen sizes as ints.
+# Strings are encoded from their raw utf-8 bytes, so each distinct value is
+# decoded once, when a report is rendered, not once per event.
+#
+# Every aggregate is a count of page views grouped by customer and one other
+# key, so each is kept as int64 customer code and key columns, sorted by both,
+# and their counts. A chunk is merged in with one more sort, of one composite
+# key where the range of keys allows it without overflowing int64, otherwise
+# with np.lexsort, so memory is bounded by the chunk size and the number of
+# distinct keys, however large the input. Timestamps outside the dates the
+# event log can represent are left out of the timeline. Requires numpy.
+
+import os
+import sys
+import json
+import argparse
+import datetime as DT
+import numpy as np
+from eventlog import SegmentReader, SUFFIX, INT_FIELDS, STRING_FIELDS, EPOCH, _read_varint
+
+PAGE_VIEW = 'pageload' # The event counted as a page view
+
+# Epoch millisecond timestamps of the first and last dates, and the value kept for one outside them
+MIN_TIMESTAMP = int((DT.datetime.min - EPOCH).total_seconds()) * 1000
+MAX_TIMESTAMP = int((DT.datetime.max - EPOCH).total_seconds()) * 1000
+NO_TIMESTAMP  = -2 ** 63
+
+# Screen width histogram bins: lower bounds in pixels, then labels
+SCREEN_WIDTHS = np.array([1, 480, 768, 1024, 1280, 1440, 1920, 2560])
+SCREEN_LABELS = ['unknown', '<480', '480-767', '768-1023', '1024-1279', '1280-1439', '1440-1919', '1920-2559', '2560+']
+
+# Columns kept from each event, and the body position of each string column
+STRING_COLUMNS = ('customer_id', 'page_url', 'referrer_url', 'event', 'language', 'script_version')
+INT_COLUMNS    = INT_FIELDS
+_POSITIONS     = [STRING_FIELDS.index(name) for name in STRING_COLUMNS]
+
+
+class Dictionary(object):
+
+    def __init__(self):
+        """Construct an empty dictionary, in which "" is code 0"""
+        self.codes  = {'': 0} # Raw utf-8 value => code
+        self.values = ['']    # Code => raw utf-8 value
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        """Return the code of a raw utf-8 value, adding it if it is new"""
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def get(self, value):
+        """Return the code of a unicode or utf-8 value, or None if it has not been seen"""
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return self.codes.get(value)
+
+    def decode(self, code):
+        """Return the unicode value of a code"""
+        return self.values[code].decode('utf-8', 'replace')
+
+
+class EventBatch(object):
+
+    def __init__(self, columns, size):
+        """Construct a batch of size events from a dict of column name => array"""
+        self.columns = columns
+        self.size    = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def select(self, mask):
+        """Return a batch of the events where the boolean array mask is True"""
+        return EventBatch(dict((name, column[mask]) for name, column in self.columns.items()), int(mask.sum()))
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Return one batch of the events in batches, in order"""
+        batches = list(batches)
+        if not batches:
+            return _empty_batch()
+        names = batches[0].columns.keys()
+        return cls(dict((name, np.concatenate([b[name] for b in batches])) for name in names),
+            sum(len(b) for b in batches))
+
+
+def _empty_batch():
+    columns = dict((name, np.zeros(0, np.int32)) for name in STRING_COLUMNS + INT_COLUMNS)
+    columns['timestamp'] = np.zeros(0, np.int64)
+    return EventBatch(columns, 0)
+
+
+def _fields(body):
+    """Return the timestamp, int fields and raw utf-8 string fields of an event body, without decoding strings"""
+    n, i = _read_varint(body, 0)
+    i += n # Skip data_id
+    timestamp, i = _read_varint(body, i)
+    ints = []
+    for field in INT_FIELDS:
+        value, i = _read_varint(body, i)
+        ints.append(value)
+    strings = []
+    for field in STRING_FIELDS:
+        n, i = _read_varint(body, i)
+        strings.append(body[i:i + n])
+        i += n
+    return timestamp, ints, strings
+
+
+def segment_paths(paths):
+    """Return event log segment files under paths, each a segment file or a directory searched recursively"""
+    segments = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                segments.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(SUFFIX))
+        else:
+            segments.append(path)
+    return segments
+
+
+def read_batches(paths, dictionaries, chunk_size=100000):
+    """Yield EventBatches of at most chunk_size events from the segment files at paths, encoding strings
+    with dictionaries, a dict of column name => Dictionary shared by every batch"""
+    encoders   = [(position, dictionaries.setdefault(name, Dictionary()).code)
+                  for name, position in zip(STRING_COLUMNS, _POSITIONS)]
+    timestamps = []
+    ints       = [[] for name in INT_COLUMNS]
+    strings    = [[] for name in STRING_COLUMNS]
+    for path in paths:
+        for seq, body in SegmentReader(path).records():
+            timestamp, values, raw = _fields(body)
+            timestamps.append(timestamp if MIN_TIMESTAMP <= timestamp <= MAX_TIMESTAMP else NO_TIMESTAMP)
+            for column, value in zip(ints, values):
+                column.append(value)
+            for column, (position, encode) in zip(strings, encoders):
+                column.append(encode(raw[position]))
+            if len(timestamps) >= chunk_size:
+                yield _batch(timestamps, ints, strings)
+                timestamps = []
+                ints       = [[] for name in INT_COLUMNS]
+                strings    = [[] for name in STRING_COLUMNS]
+    if timestamps:
+        yield _batch(timestamps, ints, strings)
+
+
+def _batch(timestamps, ints, strings):
+    """Return an EventBatch of column lists"""
+    columns = dict(timestamp=np.array(timestamps, np.int64))
+    for name, column in zip(INT_COLUMNS, ints):
+        columns[name] = np.array(column, np.int32)
+    for name, column in zip(STRING_COLUMNS, strings):
+        columns[name] = np.array(column, np.int32)
+    return EventBatch(columns, len(timestamps))
+
+
+def load(paths):
+    """Return every event in the segment files at paths as one EventBatch, and its dictionaries"""
+    dictionaries = dict()
+    return EventBatch.concatenate(read_batches(paths, dictionaries)), dictionaries
+
+
+class GroupCounts(object):
+
+    def __init__(self):
+        """Construct empty counts"""
+        self.groups = np.zeros(0, np.int64) # Customer codes, sorted
+        self.values = np.zeros(0, np.int64) # Values, sorted within each customer
+        self.counts = np.zeros(0, np.int64)
+
+    def add(self, customers, values):
+        """Count one event per (customer code, value) pair in two equal length int arrays"""
+        if not len(customers):
+            return
+        groups = np.concatenate([self.groups, customers.astype(np.int64)])
+        values = np.concatenate([self.values, values.astype(np.int64)])
+        counts = np.concatenate([self.counts, np.ones(len(customers), np.int64)])
+        lo = int(values.min())
+        span = int(values.max()) - lo + 1
+        if (int(groups.max()) + 1) * span <= 2 ** 63:
+            keys = groups * span + (values - lo) # Sorts as (customer, value) without overflowing
+            order = keys.argsort()
+            keys = keys[order]
+        else:
+            order = np.lexsort((values, groups))
+            keys = None
+        groups, values, counts = groups[order], values[order], counts[order]
+        first = np.ones(len(groups), bool)
+        if keys is not None:
+            first[1:] = keys[1:] != keys[:-1]
+        else:
+            first[1:] = (groups[1:] != groups[:-1]) | (values[1:] != values[:-1])
+        starts = np.flatnonzero(first)
+        self.groups, self.values = groups[starts], values[starts]
+        self.counts = np.add.reduceat(counts, starts)
+
+    def for_customer(self, customer):
+        """Return the value and count arrays of one customer code, by value"""
+        lo, hi = np.searchsorted(self.groups, [customer, customer + 1])
+        return self.values[lo:hi], self.counts[lo:hi]
+
+    def customers(self):
+        """Return the customer codes with counts"""
+        return np.unique(self.groups)
+
+
+class Report(object):
+
+    def __init__(self, dictionaries=None, bucket=3600, top=10):
+        """Construct an empty report, counting page views in time buckets of bucket seconds, and
+        reporting the top most common referrers"""
+        self.dictionaries = dictionaries if dictionaries is not None else dict()
+        self.bucket       = bucket
+        self.top          = top
+        self.events       = 0
+        self.undated      = 0 # Page views with a timestamp outside the dates the event log can represent
+        self.urls         = GroupCounts()
+        self.screens      = GroupCounts()
+        self.languages    = GroupCounts()
+        self.referrers    = GroupCounts()
+        self.timeline     = GroupCounts()
+
+    def add(self, batch):
+        """Count the page views in an EventBatch"""
+        self.events += len(batch)
+        page_view = self.dictionaries.get('event', Dictionary()).get(PAGE_VIEW)
+        if page_view is None:
+            return self
+        views = batch.select(batch['event'] == page_view)
+        if not len(views):
+            return self
+        customers = views['customer_id']
+        self.urls.add(customers, views['page_url'])
+        self.screens.add(customers, np.searchsorted(SCREEN_WIDTHS, views['screen_width'], side='right'))
+        self.languages.add(customers, views['language'])
+        self.referrers.add(customers, views['referrer_url'])
+        dated = views['timestamp'] != NO_TIMESTAMP
+        self.undated += len(views) - int(dated.sum())
+        self.timeline.add(customers[dated], views['timestamp'][dated] // (self.bucket * 1000))
+        return self
+
+    def customers(self):
+        """Return the ids of customers with page views"""
+        decode = self.dictionaries.get('customer_id', Dictionary()).decode
+        return sorted(decode(code) for code in self.urls.customers())
+
+    def for_customer(self, customer_id):
+        """Return a dict of aggregates for a customer id, or None if it has no page views"""
+        customer = self.dictionaries.get('customer_id', Dictionary()).get(customer_id)
+        if customer is None:
+            return None
+        urls, counts = self.urls.for_customer(customer)
+        if not len(urls):
+            return None
+        total = int(counts.sum())
+        report = dict(customer_id=customer_id, page_views=total)
+        report['urls'] = self._ranked('page_url', urls, counts)
+
+        bins, counts = self.screens.for_customer(customer)
+        report['screen_widths'] = [(SCREEN_LABELS[b], int(c)) for b, c in zip(bins, counts)]
+
+        languages, counts = self.languages.for_customer(customer)
+        report['languages'] = [(value, round(float(c) / total, 4)) for value, c in
+            self._ranked('language', languages, counts)]
+
+        referrers, counts = self.referrers.for_customer(customer)
+        direct = referrers == 0 # No referrer
+        report['direct'] = int(counts[direct].sum())
+        report['referrers'] = self._ranked('referrer_url', referrers[~direct], counts[~direct], self.top)
+
+        buckets, counts = self.timeline.for_customer(customer)
+        report['timeline'] = [(int(b) * self.bucket, int(c)) for b, c in zip(buckets, counts)]
+        return report
+
+    def _ranked(self, column, codes, counts, top=None):
+        """Return [(value, count)] for a column's codes, most common first, ties in the order first seen"""
+        decode = self.dictionaries[column].decode
+        order = np.lexsort((codes, -counts))
+        if top is not None:
+            order = order[:top]
+        return [(decode(codes[i]), int(counts[i])) for i in order]
+
+
+def analyse(paths, chunk_size=100000, bucket=3600, top=10):
+    """Return a Report over the segment files at paths, streamed chunk_size events at a time"""
+    report = Report(bucket=bucket, top=top)
+    for batch in read_batches(paths, report.dictionaries, chunk_size):
+        report.add(batch)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report on collected beacon events")
+    parser.add_argument('paths', nargs='+', metavar='PATH', help="Event log segment files, or directories of them")
+    parser.add_argument('--customer', help="Report on one customer id, default all")
+    parser.add_argument('--chunk-size', type=int, default=100000, help="Events read into memory at a time")
+    parser.add_argument('--bucket', type=int, default=3600, help="Seconds per timeline bucket")
+    parser.add_argument('--top', type=int, default=10, help="Referrers reported per customer")
+    options = parser.parse_args()
+
+    report = analyse(segment_paths(options.paths), options.chunk_size, options.bucket, options.top)
+    customers = [options.customer] if options.customer else report.customers()
+    json.dump([report.for_customer(id) for id in customers], sys.stdout, indent=2)
+    sys.stdout.write("\n")
@@ -4,16 +4,27 @@
 # Basic Personalised Content Beacon Endpoint
 
 
+import os
+import hashlib
 import datetime as DT
 import logging
-from flask import Flask, request, json, make_response, abort
-from models import Customer, Visitor
-from werkzeug.exceptions import HTTPException, BadRequest, InternalServerError, Conflict
+import config
+import models
+import logs
+from assets import Asset
+from limits import RateLimiter, ConcurrencyLimit
+from flask import Flask, request, json, make_response, abort, redirect
+from json.encoder import encode_basestring_ascii
+from metrics import Registry, Counter, Histogram, Gauge, Sampler, NULL_TIMER
+from models import Customer, Site, Visitor, Component, component_store, warm_caches, DEFAULT_PREFIX
+from params import Schema, Param, ParamError, INT, ID, BOOL, TIMESTAMP
+from werkzeug.exceptions import HTTPException, BadRequest, InternalServerError, Conflict, TooManyRequests
 
-# Logging config
+# Logging config, written from a background thread
 logger = logging.getLogger('APE')
-logger.setLevel(logging.DEBUG)
-logger.addHandler(logging.StreamHandler()) # Log to STDOUT for now
+log_listener, log_sampling = logs.configure(logger, config.LOG_LEVEL, queue=config.LOG_QUEUE,
+    queue_size=config.LOG_QUEUE_SIZE, rates=config.LOG_SAMPLE_RATES)
+SAMPLED = dict(sampled=True) # Extra for records already sampled
 
 # The app
 app = Flask(__name__, static_folder='static', static_url_path='')
@@ -22,114 +33,352 @@ app = Flask(__name__, static_folder='static', static_url_path='')
 # See: http://flask.pocoo.org/docs/0.10/api/#flask.Flask.trap_http_exception
 app.config['TRAP_HTTP_EXCEPTIONS'] = True
 
+# Default JSONP callback, and the names a beacon may choose instead: dotted JavaScript identifiers
 JSONP_CALLBACK = "_ape.callback"
+JSONP_CALLBACK_PATTERN = r"[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*"
 
-def make_jsonp_response(payload=dict(), code=200):
-    """Make a jsonp response object from a payload dict"""
+# Pre-encoded pieces of every JSONP body
+JSONP_OPEN       = dict((code, '({"status_code": %d' % code) for code in (200, 400, 403, 404, 409, 429, 500))
+JSONP_VISITOR_ID = ', "visitor_id": '
+JSONP_COMPONENTS = ', "components": '
+JSONP_CLOSE      = '})'
+JSONP_HEADERS    = [('Content-Type', "application/javascript;charset=utf-8"), ('Cache-Control', "no-store")]
+
+# Beacon query parameters, sent by static/ape.js
+BEACON_PARAMS = Schema(
+    Param('jsonp', 'jsonp',          default=JSONP_CALLBACK, max_length=64,   # JSONP callback function
+          pattern=JSONP_CALLBACK_PATTERN),
+    Param('cc',    'visitor_id',     max_length=64),                          # The APE cookie visitor_id
+    Param('db',    'debug',          type=BOOL, default=False),               # Debug switch
+    Param('dl',    'page_url',       required=True, max_length=4096),         # Page URL
+    Param('dr',    'referrer_url',   max_length=4096),                        # Referrer URL if set
+    Param('dt',    'page_title',     max_length=1024),                        # Page title
+    Param('ev',    'event',          max_length=64),                          # Event
+    Param('id',    'customer_id',    type=ID, required=True, min=0,           # The customer account ID
+          max=2 ** 63 - 1),
+    Param('ld',    'timestamp',      type=TIMESTAMP),                         # Event timestamp
+    Param('lg',    'language',       max_length=64),                          # Browser language
+    Param('pc',    'placeholders',   max_length=4096),                        # The set of Placeholder ids on this page
+    Param('px',    'prefix',         default=DEFAULT_PREFIX, max_length=64),  # Placeholder class prefix
+    Param('sc',    'screen_colour',  type=INT, default=0, min=0, max=64),     # Screen colour depth
+    Param('sh',    'screen_height',  type=INT, default=0, min=0, max=100000), # Screen height
+    Param('sw',    'screen_width',   type=INT, default=0, min=0, max=100000), # Screen width
+    Param('ua',    'user_agent',     max_length=1024),                        # User Agent
+    Param('vr',    'script_version', default="0.0", max_length=16),           # Version number of this script
+)
+
+# Batch query parameters: a beacon's, plus its events as name.offset pairs, eg "click.1200,scroll.3400",
+# where offset is milliseconds after the page load time (ld)
+BATCH_EVENT   = r"[\w-]{1,64}\.\d{1,10}"
+BATCH_PARAMS  = Schema(*BEACON_PARAMS.params + (
+    Param('eb', 'events', required=True, max_length=80 * config.BATCH_MAX_EVENTS,
+          pattern=r"%s(?:,%s)*" % (BATCH_EVENT, BATCH_EVENT)),
+))
+
+# Cacheable components query parameters. Nothing in them identifies the visitor, so one response is shared
+# by every visitor in the same segments (sg, space separated, none for anonymous visitors) on any page with
+# the same placeholders
+COMPONENT_PARAMS = Schema(*[param for param in BEACON_PARAMS.params if param.code in ('jsonp', 'id', 'pc', 'px')] + [
+    Param('sg', 'segments', max_length=1024, pattern=r"(?:[\w-]+(?: [\w-]+)*)?"),
+])
+
+# Static assets held in memory, served with an ETag at their plain and versioned URLs
+ape_js = Asset(os.path.join(app.static_folder, 'ape.js'))
+ASSET_CONTENT_TYPE = "application/javascript;charset=utf-8"
+
+# Metrics
+metrics = Registry()
+requests_total = metrics.add(Counter('ape_beacon_requests_total', "Beacon requests received"))
+errors_total   = metrics.add(Counter('ape_errors_total', "Error responses by HTTP code", label='code'))
+events_total   = metrics.add(Counter('ape_batch_events_total', "Events received in batch requests"))
+components_total = metrics.add(Counter('ape_component_requests_total', "Cacheable components requests received"))
+bots_total     = metrics.add(Counter('ape_bot_requests_total', "Beacon requests from known crawlers"))
+beacon_seconds = metrics.add(Histogram('ape_beacon_seconds', "Time to handle sampled beacon requests"))
+stage_seconds  = metrics.add(Histogram('ape_beacon_stage_seconds', "Time in each stage of sampled beacon requests", label='stage'))
+metrics.add(Gauge('ape_customer_cache', "Customer cache counters", models.customer_cache.stats, label='counter'))
+metrics.add(Gauge('ape_user_agents', "User agent classification cache and parse counters", models.user_agents.stats, label='counter'))
+metrics.add(Gauge('ape_visitor_ids', "Visitor id validation counters", models.visitor_ids.stats, label='counter'))
+metrics.add(Gauge('ape_visitor_store', "Visitor segment state store counters", models.visitor_store.stats, label='counter'))
+metrics.add(Gauge('ape_ingest', "Visitor event ingestion counters", models.visitor_events.stats, label='counter'))
+if log_listener is not None:
+    metrics.add(Gauge('ape_log_queue', "Log record queue counters", log_listener.queue_handler.stats, label='counter'))
+sampler = Sampler(config.METRICS_SAMPLE_RATE)
+
+# Admission control, checked before any lookups, so a refused request costs little
+customer_limits = RateLimiter(config.RATE_LIMIT_CUSTOMER_RATE, config.RATE_LIMIT_CUSTOMER_BURST, config.RATE_LIMIT_MAX_KEYS)
+visitor_limits  = RateLimiter(config.RATE_LIMIT_VISITOR_RATE, config.RATE_LIMIT_VISITOR_BURST, config.RATE_LIMIT_MAX_KEYS)
+concurrency     = ConcurrencyLimit(config.MAX_CONCURRENT_BEACONS)
+metrics.add(Gauge('ape_customer_rate_limits', "Per customer beacon rate limit counters", lambda: customer_limits.stats(), label='counter'))
+metrics.add(Gauge('ape_visitor_rate_limits', "Per visitor beacon rate limit counters", lambda: visitor_limits.stats(), label='counter'))
+metrics.add(Gauge('ape_beacon_concurrency', "Beacon requests in flight and shed", lambda: concurrency.stats(), label='counter'))
+
+# The payload of a refused request, pre-encoded as JSON object members, as it is the same every time
+TOO_MANY_REQUESTS = TooManyRequests("Too Many Requests: rate limit exceeded, try again later")
+SHED_PAYLOAD      = json.dumps(dict(description=TOO_MANY_REQUESTS.description, name=TOO_MANY_REQUESTS.name))[1:-1]
+
+def render_jsonp(payload=None, code=200, components=None, callback=JSONP_CALLBACK):
+    """Return a jsonp body calling callback with a payload dict, or its pre-encoded members as a str,
+    and optional pre-rendered components JSON"""
+    # Actual HTTP code sent in payload, then the payload's members, joined from pre-encoded pieces
+    parts = [callback, JSONP_OPEN.get(code) or '({"status_code": %d' % code]
+    if isinstance(payload, str):
+        parts += [', ', payload]
+    elif payload:
+        visitor_id = payload.get('visitor_id')
+        if len(payload) == 1 and isinstance(visitor_id, basestring):
+            parts += [JSONP_VISITOR_ID, encode_basestring_ascii(visitor_id)]
+        else:
+            parts += [', ', json.dumps(payload)[1:-1]]
+    if components is not None:
+        # Splice the components object in, rather than decoding and re-encoding it
+        parts += [JSONP_COMPONENTS, components]
+    parts.append(JSONP_CLOSE)
+    body = ''.join(parts)
+    if log_sampling.sampled(logging.DEBUG) and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(" JSONP %s", body, extra=SAMPLED)
+    return body
+
+
+def make_jsonp_response(payload=None, code=200, components=None, callback=JSONP_CALLBACK):
+    """Make a jsonp response object calling callback with a payload dict, and optional pre-rendered components JSON"""
     # Response always returns 200 code, to ensure client can handle callback
-    # Actual HTTP code sent in payload
-    payload['status_code'] = code
-    body = "%s(%s)" % (JSONP_CALLBACK, json.dumps(payload))
-    response = make_response(body, 200)
-    response.headers['Content-Type'] = "application/javascript;charset=utf-8"
-    logger.debug(" JSONP %s" % body)
-    return response
+    return app.response_class(render_jsonp(payload, code, components, callback), 200, JSONP_HEADERS)
+
+
+def cacheable(response, max_age, etag=None, immutable=False):
+    """Let any cache keep response for max_age seconds, with an ETag, by default a hash of its body,
+    and answer a request whose If-None-Match matches it with 304 Not Modified"""
+    response.headers['Cache-Control'] = "public, max-age=%d%s" % (max_age, ", immutable" if immutable else "")
+    response.set_etag(etag or hashlib.md5(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+
+def error_payload(e):
+    """Count and log an HTTPException, returning its response payload dict"""
+    errors_total.inc(e.code)
+    logger.error("HTTPException %s %s %s", e.code, e.name, e.description)
+    return dict(description=e.description, name=e.name)
 
 
 @app.route('/beacon.js')
 def beacon():
+    timer = sampler.timer(stage_seconds, beacon_seconds)
+    callback, code, payload, components = handle_beacon(request.query_string, request.headers, timer)
+    response = make_jsonp_response(payload, code, components, callback)
+    if code == 200:
+        timer.mark('render')
+        timer.done()
+    return response
 
-    global JSONP_CALLBACK
-    JSONP_CALLBACK = request.args.get('jsonp', "_ape.callback")
-
-    # Get args data or defaults
-    args = dict()
-    args['jsonp']          = JSONP_CALLBACK                 # JSONP callback function
-    args['visitor_id']     = request.args.get('cc', "")     # The APE cookie visitor_id
-    args['debug']          = request.args.get('db', "")     # Debug switch
-    args['page_url']       = request.args.get('dl', "")     # Page URL
-    args['referrer_url']   = request.args.get('dr', "")     # Referrer URL if set
-    args['page_title']     = request.args.get('dt', "")     # Page title
-    args['event']          = request.args.get('ev', "")     # Event
-    args['customer_id']    = request.args.get('id', "")     # The customer account ID
-    args['timestamp']      = request.args.get('ld', "")     # Event timestamp
-    args['language']       = request.args.get('lg', "")     # Browser language
-    args['placeholders']   = request.args.get('pc', "")     # The set of Placeholder ids on this page
-    args['prefix']         = request.args.get('px', "ape")  # Placeholder class prefix
-    args['screen_colour']  = request.args.get('sc', 0)      # Screen colour depth
-    args['screen_height']  = request.args.get('sh', 0)      # Screen height
-    args['screen_width']   = request.args.get('sw', 0)      # Screen width
-    args['user_agent']     = request.args.get('ua', "")     # User Agent
-    args['script_version'] = request.args.get('vr', "0.0")  # Version number of this script
-
-    # Ensure page url and customer id are provided
-    if not args['page_url']:    raise BadRequest("Bad Request: Value required for page url (dl)")
-    if not args['customer_id']: raise BadRequest("Bad Request: Value required for customer id (id)")
 
-    # Extract placeholder identifiers
-    placeholders = args['placeholders'].split(' ')
-    prefix = "%s-" % args['prefix']
-    args['placeholder_ids'] = [c.lstrip(prefix) for c in placeholders if c.startswith(prefix)]
+@app.route('/batch.js', methods=['GET', 'POST'])
+def batch():
+    # Batches flushed as the page unloads are POSTed, with the query string as the body
+    query_string = request.stream.read(config.BATCH_MAX_BODY) if request.method == 'POST' else request.query_string
+    callback, code, payload, components = handle_beacon(query_string, request.headers, batch=True)
+    return make_jsonp_response(payload, code, components, callback)
+
+
+@app.route('/components.js')
+def components():
+    callback, code, payload, components = handle_components(request.query_string)
+    response = make_jsonp_response(payload, code, components, callback)
+    if code == 200:
+        return cacheable(response, config.COMPONENTS_MAX_AGE)
+    return response
+
+
+@app.route('/ape.js')
+def script():
+    asset = ape_js.refresh() if app.debug else ape_js
+    response = app.response_class(asset.body, 200, content_type=ASSET_CONTENT_TYPE)
+    return cacheable(response, config.ASSET_LATEST_AGE, asset.etag)
+
+
+@app.route('/ape.<version>.js')
+def script_version(version):
+    asset = ape_js.refresh() if app.debug else ape_js
+    if version != asset.version:
+        # Superseded, so send the current version instead
+        return redirect(asset.url)
+    response = app.response_class(asset.body, 200, content_type=ASSET_CONTENT_TYPE)
+    return cacheable(response, config.ASSET_MAX_AGE, asset.etag, immutable=True)
+
+
+def placeholder_ids(placeholders, prefix):
+    """Return the ids of space separated placeholder classes starting with prefix followed by a dash"""
+    prefix = "%s-" % prefix
+    return [c[len(prefix):] for c in placeholders.split(' ') if c.startswith(prefix) and len(c) > len(prefix)]
+
+
+def batch_events(events, load):
+    """Return [(event, timestamp)] for a batch's events param, timed from load, the page load datetime"""
+    result = []
+    for pair in events.split(','):
+        event, _, offset = pair.rpartition('.')
+        result.append((event, load + DT.timedelta(milliseconds=int(offset))))
+    return result
+
+
+def handle_beacon(query_string, headers, timer=NULL_TIMER, batch=False):
+    """Handle a beacon's raw query string and request headers, returning its JSONP callback, the HTTP
+    code, the response payload dict and pre-rendered components JSON. Shared by every serving mode.
+    Everything about the response is returned, so concurrent requests share no state.
+    If batch is True, the query string carries a batch of events for one visitor."""
+
+    requests_total.inc()
+
+    # Parse args, or report the first missing or invalid value
+    events = None
+    try:
+        if batch:
+            args = BATCH_PARAMS.parse(query_string)
+            try:
+                events = batch_events(args['events'], args['timestamp'])
+            except OverflowError:
+                raise ParamError("Events (eb) timed out of range", args)
+            if len(events) > config.BATCH_MAX_EVENTS:
+                raise ParamError("Too many events (eb), at most %d" % config.BATCH_MAX_EVENTS, args)
+        else:
+            args = BEACON_PARAMS.parse(query_string)
+    except ParamError as e:
+        return str(e.values['jsonp']), 400, error_payload(BadRequest("Bad Request: %s" % e)), None
+    callback = str(args['jsonp']) # Validated as ASCII
+
+    # Refuse the request before any lookups if its visitor or customer is over its rate, or too many are in flight
+    if not admit(args['customer_id'], args['visitor_id']):
+        errors_total.inc(429) # Not logged, as a flood would flood the log too
+        return callback, 429, SHED_PAYLOAD, None
+
+    try:
+        payload, components = beacon_response(args, headers, timer, events)
+    except HTTPException as e:
+        return callback, e.code, error_payload(e), None
+    finally:
+        concurrency.release()
+    return callback, 200, payload, components
+
+
+def admit(customer_id, visitor_id):
+    """Take a token from the visitor's and the customer's rate limits, then a place in flight, which the
+    caller must release. Returns False if any is refused. A visitor is checked first, so a single
+    misbehaving visitor doesn't use up its customer's tokens. New visitors have no id to limit."""
+    if visitor_id and not visitor_limits.allow(visitor_id):
+        return False
+    return customer_limits.allow(customer_id) and concurrency.acquire()
+
+
+def handle_components(query_string):
+    """Handle a cacheable components request's raw query string, returning its JSONP callback, the HTTP
+    code, the response payload dict and pre-rendered components JSON. The response depends only on the
+    customer, segments, placeholders and prefix, so it never sets or reads a visitor."""
+
+    components_total.inc()
 
-    # Deserialise timestamp
     try:
-        args['timestamp'] = DT.datetime.utcfromtimestamp(int(args['timestamp']) / 1000)
-    except ValueError:
-        args['timestamp'] = DT.datetime.now()
+        args = COMPONENT_PARAMS.parse(query_string)
+    except ParamError as e:
+        return str(e.values['jsonp']), 400, error_payload(BadRequest("Bad Request: %s" % e)), None
+    callback = str(args['jsonp']) # Validated as ASCII
+
+    # Placeholders in canonical order, so every page with the same set gets the same body
+    ids = sorted(set(placeholder_ids(args['placeholders'], args['prefix'])))
+    if not ids or not Customer.get(id=args['customer_id']):
+        return callback, 200, None, None
+
+    # Components for visitors in exactly these segments
+    segments = frozenset(args['segments'].split())
+    components = Component.render(component_store.get_many(ids, segments=segments), args['prefix'])
+    return callback, 200, None, components
 
-    # Convert values to base data types
-    args['screen_width']  = int(args['screen_width'])
-    args['screen_height'] = int(args['screen_height'])
-    args['screen_colour'] = int(args['screen_colour'])
-    args['debug']         = (args['debug'] == "true")
 
-    # The response payload
+def beacon_response(args, headers, timer, events=None):
+    """Return the response payload dict and pre-rendered components JSON for parsed beacon args,
+    or raise an HTTPException. Lookups are made once, however many (event, timestamp) events."""
+
+    # Extract placeholder identifiers
+    args['placeholder_ids'] = placeholder_ids(args['placeholders'], args['prefix'])
+    timer.mark('parse')
+
+    # Classify the user agent, as device, browser and os fields for segmenting
+    agent = models.user_agents.classify(args['user_agent'])
+    args.update(agent.fields())
+    timer.mark('user_agent')
+
+    # The response payload, and its pre-rendered components
     payload = dict()
+    components = None
 
     # Respect Do Not Track
-    if request.headers.get('DNT', False):
+    if headers.get('DNT', False):
         raise Conflict("Do Not Track enabled on client")
+    timer.mark('dnt')
     
     # Return args in payload in debug mode
     if args['debug']:
-        payload['args'] = args
+        payload['args'] = BEACON_PARAMS.echo(args)
+        payload['args']['placeholder_ids'] = args['placeholder_ids']
+        if events is not None:
+            payload['args']['events'] = args['events']
+        payload['args'].update(agent.fields())
+
+    # Answer known crawlers without a visitor or components, so they're neither stored nor personalised
+    if agent.bot:
+        bots_total.inc()
+        return payload, components
+
+    # Pages no customer owns are answered as for a customer that doesn't own them, without loading it
+    if Site.unowned(args['page_url'], args['customer_id']):
+        timer.mark('ownership')
+        return payload, components
 
     # Get customer record
     customer = Customer.get(id=args['customer_id'])
+    timer.mark('customer')
     if customer:
         
         # Ensure customer account_id is valid for this page url
-        if customer.is_site_owner(url=args['page_url']):
+        owner = customer.is_site_owner(url=args['page_url'])
+        timer.mark('ownership')
+        if owner:
         
             # Get/create visitor record for this customer
             visitor = customer.get_visitor(id=args['visitor_id'])
             payload['visitor_id'] = visitor.id
+            timer.mark('visitor')
         
-            # Update visitor data from payload args
-            visitor.update_with_data(data=args)
+            # Update visitor data from payload args, once per event in a batch
+            if events is None:
+                visitor.update_with_data(data=args)
+            else:
+                for event, timestamp in events:
+                    visitor.update_with_data(data=dict(args, event=event, timestamp=timestamp))
+                events_total.inc(n=len(events))
+                payload['events'] = len(events)
+            timer.mark('update')
 
             # Ensure we have placeholder ids (hence there are ads on the page)
             if args['placeholder_ids']:
 
                 # Get personalised components for this visitor for these placeholders
-                components = visitor.components(ad_ids=args['placeholder_ids'])
-                
-                # Format components for json response
-                payload['components'] = dict()
-                for component in components:
-                    key = "%s-%s" % (args['prefix'], component.id)
-                    payload['components'][key] = dict()
-                    payload['components'][key]['id']      = component.id
-                    payload['components'][key]['styles']  = component.styles
-                    payload['components'][key]['content'] = component.content
+                # Formatted for json response from each component's cached fragment
+                components = Component.render(visitor.components(ad_ids=args['placeholder_ids']), args['prefix'])
+                timer.mark('components')
     
-    return make_jsonp_response(payload)
+    return payload, components
 
 
 @app.errorhandler(HTTPException)
 def handle_error(e):
-    logger.error("HTTPException %s %s %s" % (e.code, e.name, e.description))
-    return make_jsonp_response(dict(description=e.description, name=e.name), e.code)
+    return make_jsonp_response(error_payload(e), e.code)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose metrics in the Prometheus text format"""
+    response = make_response(metrics.render(), 200)
+    response.headers['Content-Type'] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
 
 
 # @app.errorhandler(Exception)
@@ -140,4 +389,5 @@ def handle_error(e):
 
 
 if __name__ == "__main__":
+    warm_caches()
     app.run(debug=True, host="0.0.0.0", port=3000)
\ No newline at end of file
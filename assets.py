@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Content hashed static assets
+#
+# Asset : A static file held in memory, with an ETag and versioned URL from a hash of its content
+#
+# An asset's versioned URL, eg /ape.0123456789ab.js, changes whenever its
+# content does, so it can be cached forever. Its plain URL, eg /ape.js, is
+# what customers embed in their pages, so it is cached briefly and
+# revalidated by ETag, which costs a 304 and no body.
+
+import os
+import hashlib
+import mimetypes
+
+VERSION_LENGTH = 12 # Hex digits of the content hash in a versioned URL
+
+
+class Asset(object):
+
+    def __init__(self, path, mimetype=None):
+        """Construct an asset from the file at path, read once now"""
+        self.path     = path
+        self.name     = os.path.basename(path)
+        self.mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.mtime    = None
+        self.load()
+
+    def load(self):
+        """Read the file and hash its content"""
+        with open(self.path, 'rb') as f:
+            self.body = f.read()
+        self.mtime   = os.path.getmtime(self.path)
+        self.etag    = hashlib.sha1(self.body).hexdigest()
+        self.version = self.etag[:VERSION_LENGTH]
+
+    def refresh(self):
+        """Reload the file if it has changed since it was read, for development"""
+        if os.path.getmtime(self.path) != self.mtime:
+            self.load()
+        return self
+
+    @property
+    def url(self):
+        """The versioned URL of the current content, eg /ape.0123456789ab.js"""
+        stem, ext = os.path.splitext(self.name)
+        return "/%s.%s%s" % (stem, self.version, ext)
@@ -0,0 +1,1031 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Benchmarks for APE hot paths
+#
+# Usage: python bench.py [--save results.json] [--compare baseline.json] [benchmark ...]
+#
+# Microbenchmarks time single hot functions. The wsgi_* benchmarks drive the
+# whole app through WSGI with a realistic mix of beacon query strings and
+# report requests/sec with p50/p95/p99 latency. Everything runs offline
+# against the in-process database. Results can be saved as JSON, and
+# compared with a previous run.
+
+import gc
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import timeit
+import itertools
+import logging
+import atexit
+import shutil
+import argparse
+import tempfile
+import calendar
+import contextlib
+import datetime as DT
+import threading
+from collections import OrderedDict
+
+benchmarks = OrderedDict()
+
+# Results of this run, by benchmark then "section: label"
+results = OrderedDict()
+current = dict(benchmark=None, section=None)
+
+
+def benchmark(func):
+    """Register a benchmark function to run by name"""
+    benchmarks[func.__name__] = func
+    return func
+
+
+def section(title):
+    """Start a titled group of measurements within the running benchmark"""
+    current['section'] = title
+    print title
+
+
+def record(label, **values):
+    """Keep values measured for label in the results of this run"""
+    if current['section']:
+        label = "%s: %s" % (current['section'], label)
+    results.setdefault(current['benchmark'], OrderedDict())[label] = values
+
+
+def measure(label, func, number=10000, repeat=3):
+    """Time func, print and return its best rate in calls per second"""
+    seconds = min(timeit.repeat(func, number=number, repeat=repeat))
+    rate = number / seconds
+    print "  %-48s %12.0f ops/sec %10.3f us/op" % (label, rate, 1e6 / rate)
+    record(label, ops_per_sec=rate, us_per_op=1e6 / rate)
+    return rate
+
+
+def percentile(ordered, p):
+    """Return the pth percentile of an ordered list by nearest rank"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+
+def measure_requests(label, func, requests, threads=1):
+    """Call func(request) for each request across threads, print and return throughput and latency"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def run(share):
+        timings = []
+        failed = 0
+        for request in share:
+            start = time.time()
+            try:
+                func(request)
+            except Exception:
+                failed += 1
+            timings.append(time.time() - start)
+        with lock:
+            latencies.extend(timings)
+            errors.append(failed)
+
+    workers = [threading.Thread(target=run, args=(requests[i::threads],)) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    stats = OrderedDict([('requests', len(latencies)), ('errors', sum(errors)), ('threads', threads),
+        ('requests_per_sec', len(latencies) / elapsed)])
+    for p in (50, 95, 99):
+        stats['p%d_ms' % p] = percentile(latencies, p) * 1000
+    print "  %-48s %12.0f req/sec   p50 %.3f  p95 %.3f  p99 %.3f ms%s" % (label,
+        stats['requests_per_sec'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+        "   %d errors" % stats['errors'] if stats['errors'] else "")
+    record(label, **stats)
+    return stats
+
+
+def legacy_is_site_owner(sites, url):
+    """The linear scan Customer.is_site_owner used before SiteIndex"""
+    for protocol in ["https://", "http://", "//"]:
+        url = url.lstrip(protocol)
+    for site in sites:
+        if url.startswith(site): return True
+    return False
+
+
+@benchmark
+def site_ownership():
+    """Customer.is_site_owner: linear scan vs compiled SiteIndex"""
+    from sites import SiteIndex
+
+    for count in (10, 100, 1000):
+        sites = ["site%d.com" % i for i in range(count // 2)]
+        sites += ["shared.com/customer%d" % i for i in range(count // 2)]
+        index = SiteIndex(sites)
+        last = "http://site%d.com/page" % (count // 2 - 1)
+        miss = "http://unknown.com/page"
+
+        section("%d sites" % count)
+        measure("scan, last site", lambda: legacy_is_site_owner(sites, last))
+        measure("index, last site", lambda: index.owns(last))
+        measure("scan, unknown site", lambda: legacy_is_site_owner(sites, miss))
+        measure("index, unknown site", lambda: index.owns(miss))
+
+
+@benchmark
+def site_routing():
+    """Customer for a page url: an indexed query on reversed hostname vs the bulk loaded owner map"""
+    from models import Site
+
+    ids = customer_ids()
+    url = "http://www.customer%d-site3.com/path" % (len(ids) - 1)
+    start = time.time()
+    owners = Site.load_owners()
+    print "  Loaded %d customers' sites in %.3f ms" % (len(ids), (time.time() - start) * 1000)
+    measure("Site.owner_of, indexed query", lambda: Site.owner_of(url), number=2000)
+    measure("SiteIndex.owner, bulk loaded", lambda: owners.owner(url))
+    measure("SiteIndex.owner, unknown host", lambda: owners.owner("http://unknown.com/"))
+
+
+def legacy_components_payload(components, prefix):
+    """The per-request component dicts app.beacon built before pre-rendered fragments"""
+    payload = dict()
+    for component in components:
+        key = "%s-%s" % (prefix, component.id)
+        payload[key] = dict()
+        payload[key]['id']      = component.id
+        payload[key]['styles']  = component.styles
+        payload[key]['content'] = component.content
+    return json.dumps(payload)
+
+
+@benchmark
+def component_payload():
+    """Components JSON: per-request dicts and json.dumps vs cached fragments"""
+    from models import Component
+
+    for count in (1, 4, 20):
+        components = [Component(id="component%d" % i,
+            content='<strong>Ad Number %d</strong><br><a href="#">Buy Things!</a>' % i,
+            styles='.ape-component%d {color: red;}' % i) for i in range(count)]
+
+        section("%d components" % count)
+        measure("dicts and json.dumps", lambda: legacy_components_payload(components, "ape"))
+        measure("cached fragments", lambda: Component.render(components, "ape"))
+
+
+def rss():
+    """Return the resident set size of this process in bytes, or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return None
+
+
+def measure_memory(label, build, count=200000):
+    """Build count objects, print and return the resident bytes each one added"""
+    gc.collect()
+    before = rss()
+    objects = [build(i) for i in xrange(count)]
+    gc.collect()
+    after = rss()
+    if before is None:
+        print "  %-48s (no /proc, skipped)" % label
+        return None
+    size = float(after - before) / count
+    print "  %-48s %12.1f bytes/object" % (label, size)
+    record(label, bytes_per_object=size)
+    del objects
+    return size
+
+
+class LegacyComponent(object):
+    """Component as it was before __slots__"""
+
+    def __init__(self, id, content, styles=""):
+        self.id      = id
+        self.content = content
+        self.styles  = styles
+
+
+class LegacyVisitor(object):
+    """Visitor as it was before __slots__"""
+
+    def __init__(self, customer, id=None):
+        self.id       = id if id else uuid.uuid4()
+        self.customer = customer
+        self.data_id  = "%s-%s" % (self.customer.id, self.id)
+
+
+@benchmark
+def object_memory():
+    """Memory per Visitor, VisitorState and Component: dict-backed vs __slots__"""
+    from models import Customer, Visitor, Component
+    from segments import VisitorState
+
+    customer = Customer(id=1)
+    content = '<strong>Ad</strong><br><a href="#">Buy Things!</a>'
+
+    section("Visitors with random ids")
+    measure_memory("dict-backed Visitor", lambda i: LegacyVisitor(customer))
+    measure_memory("slotted Visitor", lambda i: Visitor(customer))
+
+    section("Empty visitor segment state")
+    measure_memory("fresh dicts and set", lambda i: (dict(), dict(), set()))
+    measure_memory("VisitorState", lambda i: VisitorState())
+
+    section("Components sharing 1000 ids")
+    measure_memory("dict-backed Component", lambda i: LegacyComponent(str(i % 1000), content))
+    measure_memory("slotted Component, interned id", lambda i: Component(str(i % 1000), content))
+
+
+# Fixtures shared by the benchmarks that need a populated database
+fixtures = dict()
+
+SCREENS     = [(1920, 1080), (1366, 768), (1440, 900), (375, 667), (414, 896), (768, 1024)]
+LANGUAGES   = ['en-GB', 'en-US', 'fr', 'de', 'es', 'ja']
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_4) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.1 Safari/603.1.30",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.0 Mobile/14E304 Safari/602.1",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:53.0) Gecko/20100101 Firefox/53.0",
+    "Mozilla/5.0 (Linux; Android 7.0; SM-G930F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.83 Mobile Safari/537.36",
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+]
+
+
+def customer_ids(count=200, sites=5):
+    """Create customers with sites in the in-process database once, returning their ids"""
+    if 'customer_ids' not in fixtures:
+        from config import sql_engine, SQL_Session, SQL_Base
+        from models import Customer
+        SQL_Base.metadata.create_all(sql_engine)
+        session = SQL_Session()
+        customers = [Customer(name="Customer %d" % i, sites=["customer%d-site%d.com" % (i, n) for n in range(sites)])
+            for i in range(count)]
+        session.add_all(customers)
+        session.commit()
+        fixtures['customer_ids'] = [customer.id for customer in customers]
+        session.close()
+
+        # Warm the customer cache
+        for id in fixtures['customer_ids']:
+            Customer.get(id)
+    return fixtures['customer_ids']
+
+
+def beacon_query_strings(count, seed=1):
+    """Return count beacon query strings with a realistic mix of customers, visitors, pages and placeholders.
+    Customer popularity is skewed, most visitors return, and a few requests are bad or for foreign sites."""
+    from urllib import urlencode
+    import config
+    from models import COMPONENTS
+    from ids import VisitorIds
+
+    rng = random.Random(seed)
+    ids = customer_ids()
+    made = VisitorIds(config.VISITOR_ID_KEY, seed=seed)
+    visitors = [made.new(now=1490916389 - rng.randrange(90 * 86400)) for i in range(count // 4)]
+    placeholders = ["ape ape-%s" % component.id for component in COMPONENTS]
+    load = 1490916389000
+
+    query_strings = []
+    for i in xrange(count):
+        n = int(len(ids) * rng.random() ** 3)
+        width, height = rng.choice(SCREENS)
+        args = [
+            ('cc', rng.choice(visitors) if rng.random() < 0.7 else ''),
+            ('db', 'false'),
+            ('dl', "http://customer%d-site%d.com/%s" % (n, rng.randrange(5), rng.choice(['', 'pricing', 'blog/post-%d' % rng.randrange(50)]))),
+            ('dr', rng.choice(['', 'https://www.google.com/', 'https://t.co/abc'])),
+            ('dt', "Page title %d" % rng.randrange(100)),
+            ('ev', 'pageload'),
+            ('id', ids[n]),
+            ('ld', load + i * 100),
+            ('lg', rng.choice(LANGUAGES)),
+            ('pc', " ".join(rng.sample(placeholders, rng.randrange(len(placeholders) + 1)))),
+            ('px', 'ape'),
+            ('sc', 24),
+            ('sh', height),
+            ('sw', width),
+            ('ua', rng.choice(USER_AGENTS)),
+            ('vr', '0.1'),
+            ('jsonp', '_ape.callback'),
+            ('rd', rng.random()),
+        ]
+        roll = rng.random()
+        if roll < 0.01:
+            args = [(k, v) for k, v in args if k != 'dl']  # Bad request
+        elif roll < 0.03:
+            args = [(k, 'http://elsewhere.com/' if k == 'dl' else v) for k, v in args] # Foreign site
+        elif roll < 0.04:
+            args = [(k, 999999 if k == 'id' else v) for k, v in args] # Unknown customer
+        query_strings.append(urlencode(args))
+    return query_strings
+
+
+def wsgi_environs(query_strings, path='/beacon.js'):
+    """Return a WSGI environ per query string, built ahead of timing"""
+    from werkzeug.test import create_environ
+    return [create_environ(path, query_string=qs) for qs in query_strings]
+
+
+def wsgi_call(wsgi_app):
+    """Return a function calling wsgi_app with an environ and consuming the response"""
+    def start_response(status, headers, exc_info=None):
+        return lambda data: None
+
+    def call(environ):
+        response = wsgi_app(dict(environ), start_response)
+        for chunk in response:
+            pass
+        if hasattr(response, 'close'):
+            response.close()
+    return call
+
+
+@contextlib.contextmanager
+def admission(customer=(0, 1), visitor=(0, 1), concurrency=0):
+    """Run with the app's admission control replaced: (rate, burst) per customer and per visitor, and the
+    max requests in flight. By default there are no limits, so repeated requests measure the work they do."""
+    import app as ape
+    from limits import RateLimiter, ConcurrencyLimit
+
+    saved = ape.customer_limits, ape.visitor_limits, ape.concurrency
+    ape.customer_limits, ape.visitor_limits = RateLimiter(*customer), RateLimiter(*visitor)
+    ape.concurrency = ConcurrencyLimit(concurrency)
+    try:
+        yield
+    finally:
+        ape.customer_limits, ape.visitor_limits, ape.concurrency = saved
+
+
+def replay(call, schedule):
+    """Serve (arrival time, environ, measured) requests one at a time in order of arrival, as a single worker
+    would, with times in seconds from now. Returns the sorted latencies of measured requests, from arrival
+    to response, so they include time queued behind other requests."""
+    latencies = []
+    start = time.time()
+    for arrival, environ, measured in schedule:
+        wait = start + arrival - time.time()
+        if wait > 0.001:
+            time.sleep(wait - 0.001)
+        while time.time() < start + arrival:
+            pass # Sleeping overshoots by longer than a request takes
+        call(environ)
+        if measured:
+            latencies.append(time.time() - start - arrival)
+    latencies.sort()
+    return latencies
+
+
+@benchmark
+def customer_get():
+    """Customer lookup: a database query vs the customer cache"""
+    from models import Customer
+
+    ids = customer_ids()
+    hot = ids[0]
+    measure("Customer.load, prepared query", lambda: Customer.load(hot), number=2000)
+    measure("Customer.get, cached", lambda: Customer.get(hot))
+    measure("Customer.get, unknown id cached", lambda: Customer.get(999999))
+
+
+@benchmark
+def log_records():
+    """The per-response debug line: written synchronously, eagerly or lazily formatted, vs queued and sampled"""
+    import logs
+    from models import COMPONENTS, Component
+
+    body = "_ape.callback(%s)" % Component.render(COMPONENTS, 'ape')
+    disabled = logging.root.manager.disable
+    logging.disable(logging.NOTSET)
+    devnull = open(os.devnull, 'w')
+    try:
+        for title, queue, rates in (("StreamHandler", False, None), ("Queued", True, None), ("Queued, DEBUG sampled at 1%", True, {'DEBUG': 0.01})):
+            section(title)
+            logger = logging.getLogger('APE.bench-%s' % title)
+            logger.propagate = False
+            listener, sampling = logs.configure(logger, logging.DEBUG, queue=queue, queue_size=100000,
+                rates=rates, handler=logging.StreamHandler(devnull))
+            if rates:
+                def log():
+                    if sampling.sampled(logging.DEBUG) and logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(" JSONP %s", body, extra=dict(sampled=True))
+                measure("sampled before the record is made", log)
+            else:
+                measure("formatted by the caller", lambda: logger.debug(" JSONP %s" % body))
+                measure("formatted lazily", lambda: logger.debug(" JSONP %s", body))
+            if listener is not None:
+                listener.stop()
+                print "  %-48s %12d" % ("dropped records", listener.queue_handler.dropped)
+
+        # A stream that can't keep up, eg a blocked pipe
+        class SlowStream(object):
+            def write(self, data):
+                time.sleep(0.001)
+            def flush(self):
+                pass
+        for title, queue in (("StreamHandler, slow stream", False), ("Queued, slow stream", True)):
+            section(title)
+            logger = logging.getLogger('APE.bench-%s' % title)
+            logger.propagate = False
+            listener, sampling = logs.configure(logger, logging.DEBUG, queue=queue, queue_size=1000,
+                handler=logging.StreamHandler(SlowStream()))
+            measure("formatted lazily", lambda: logger.debug(" JSONP %s", body), number=500)
+            if listener is not None:
+                print "  %-48s %12d" % ("dropped records", listener.queue_handler.dropped)
+                listener.queue_handler.queue.clear()
+                listener.stop()
+    finally:
+        devnull.close()
+        logging.disable(disabled)
+
+
+@benchmark
+def visitor_ids():
+    """New visitor ids and checking returning visitors' ids: uuid4 vs signed, time ordered ids"""
+    import config
+    from ids import VisitorIds
+
+    ids = VisitorIds(config.VISITOR_ID_KEY, legacy=True)
+    section("New id")
+    measure("uuid.uuid4()", uuid.uuid4)
+    measure("str(uuid.uuid4())", lambda: str(uuid.uuid4()))
+    measure("VisitorIds.new()", ids.new)
+    print "  %-48s %12d vs %d characters" % ("length", len(str(uuid.uuid4())), len(ids.new()))
+
+    section("Returning visitor id")
+    id, legacy, forged = ids.new(), str(uuid.uuid4()), ids.new()[:-2] + '-F'
+    measure("unchecked, as before", lambda: id and "%s-%s" % (1, id))
+    measure("valid signed id", lambda: ids.valid(id))
+    measure("valid legacy uuid", lambda: ids.valid(legacy))
+    measure("forged id", lambda: ids.valid(forged))
+    measure("garbage, 64 characters", lambda: ids.valid('x' * 64))
+
+
+@benchmark
+def visitor_store():
+    """Visitor state lookups by backend and number of stored visitors: hot in cache, or cold loads, and batched writes"""
+    from models import segment_engine
+    from segments import VisitorState
+    from visitors import VisitorStore, MemoryBackend, DiskBackend
+
+    state = VisitorState()
+    segment_engine.update(state, dict(event='pageload', page_url='http://foo.com/pricing', screen_width=640))
+    directory = tempfile.mkdtemp()
+    try:
+        for name, backend in (("memory", lambda: MemoryBackend(16)), ("disk", lambda: DiskBackend(directory, 16))):
+            for size in (1000, 100000):
+                section("%s, %d visitors" % (name, size))
+                store = VisitorStore(backend(), shards=16, cache_size=256, batch_size=1000)
+                ids = ["1-%032x" % i for i in range(size)]
+                store.backend.count() # Open every shard before timing
+                start = time.time()
+                for data_id in ids:
+                    store.save(data_id, state)
+                store.flush()
+                rate = size / (time.time() - start)
+                print "  %-48s %12.0f states/sec" % ("batched write back", rate)
+                record("batched write back", ops=rate)
+                hot = ids[0]
+                store.get(hot)
+                measure("get, hot", lambda: store.get(hot))
+                cold = itertools.cycle(random.sample(ids, min(size, 20000))).next
+                measure("get, mostly cold (cache of 256)", lambda: store.get(cold()), number=5000)
+                store.close()
+            shutil.rmtree(directory)
+            directory = tempfile.mkdtemp()
+    finally:
+        shutil.rmtree(directory)
+
+
+def legacy_customer_load(id):
+    """Customer.load as it was: a new session and query per call"""
+    from config import SQL_Session
+    from models import Customer
+    session = SQL_Session()
+    result = session.query(Customer).filter(Customer.id == id).first()
+    session.close()
+    return result
+
+
+@benchmark
+def database():
+    """Customer loads against the configured database: session churn vs pooled reuse and a prepared query"""
+    from config import sql_engine
+    from models import Customer
+
+    ids = customer_ids()
+    print "  Database %s, %s" % (sql_engine.url, sql_engine.pool.__class__.__name__)
+    requests = [random.Random(1).choice(ids) for i in range(2000)]
+    for threads in (1, 4):
+        section("%d thread%s" % (threads, "s" if threads > 1 else ""))
+        measure_requests("Session per call", legacy_customer_load, requests, threads)
+        measure_requests("Reused session, prepared query", Customer.load, requests, threads)
+
+
+def legacy_beacon_args(query):
+    """handle_beacon's argument parsing as it was: a get per field over decoded args, then conversions"""
+    args = dict()
+    args['jsonp']          = query.get('jsonp', "_ape.callback")
+    args['visitor_id']     = query.get('cc', "")
+    args['debug']          = query.get('db', "")
+    args['page_url']       = query.get('dl', "")
+    args['referrer_url']   = query.get('dr', "")
+    args['page_title']     = query.get('dt', "")
+    args['event']          = query.get('ev', "")
+    args['customer_id']    = query.get('id', "")
+    args['timestamp']      = query.get('ld', "")
+    args['language']       = query.get('lg', "")
+    args['placeholders']   = query.get('pc', "")
+    args['prefix']         = query.get('px', "ape")
+    args['screen_colour']  = query.get('sc', 0)
+    args['screen_height']  = query.get('sh', 0)
+    args['screen_width']   = query.get('sw', 0)
+    args['user_agent']     = query.get('ua', "")
+    args['script_version'] = query.get('vr', "0.0")
+    placeholders = args['placeholders'].split(' ')
+    prefix = "%s-" % args['prefix']
+    args['placeholder_ids'] = [c.lstrip(prefix) for c in placeholders if c.startswith(prefix)]
+    try:
+        args['timestamp'] = DT.datetime.utcfromtimestamp(int(args['timestamp']) / 1000)
+    except ValueError:
+        args['timestamp'] = DT.datetime.now()
+    args['screen_width']  = int(args['screen_width'])
+    args['screen_height'] = int(args['screen_height'])
+    args['screen_colour'] = int(args['screen_colour'])
+    args['debug']         = (args['debug'] == "true")
+    return args
+
+
+@benchmark
+def beacon_args():
+    """Beacon argument parsing: a get per field over werkzeug's decoded args vs the compiled schema"""
+    from werkzeug.urls import url_decode
+    from app import BEACON_PARAMS, placeholder_ids
+
+    def schema(query_string):
+        args = BEACON_PARAMS.parse(query_string)
+        args['placeholder_ids'] = placeholder_ids(args['placeholders'], args['prefix'])
+        return args
+
+    query_strings = [qs for qs in beacon_query_strings(1000) if '&dl=' in qs]
+    typical = query_strings[0]
+    measure("url_decode and gets, typical beacon", lambda: legacy_beacon_args(url_decode(typical)))
+    measure("BEACON_PARAMS.parse, typical beacon", lambda: schema(typical))
+    cycle = iter(query_strings * 1000).next
+    measure("url_decode and gets, beacon mix", lambda: legacy_beacon_args(url_decode(cycle())))
+    measure("BEACON_PARAMS.parse, beacon mix", lambda: schema(cycle()))
+
+
+def legacy_render_jsonp(payload, code=200, components=None, callback="_ape.callback"):
+    """render_jsonp as it was: the payload dict mutated, dumped and formatted into the body"""
+    from flask import json
+    payload['status_code'] = code
+    body = json.dumps(payload)
+    if components is not None:
+        body = '%s, "components": %s}' % (body[:-1], components)
+    return "%s(%s)" % (callback, body)
+
+
+@benchmark
+def jsonp_response():
+    """JSONP bodies formatted from the payload dict vs joined from pre-encoded pieces, and whole responses"""
+    from app import app, render_jsonp, make_jsonp_response
+    from models import COMPONENTS, Component
+
+    components = Component.render(COMPONENTS, 'ape')
+    visitor_id = "%032x" % 1
+    error = dict(description="Bad Request", name="Bad Request")
+    with app.test_request_context('/beacon.js'):
+        section("Body")
+        measure("formatted, visitor id only", lambda: legacy_render_jsonp(dict(visitor_id=visitor_id)))
+        measure("templates, visitor id only", lambda: render_jsonp(dict(visitor_id=visitor_id)))
+        measure("formatted, visitor id and 4 components", lambda: legacy_render_jsonp(dict(visitor_id=visitor_id), components=components))
+        measure("templates, visitor id and 4 components", lambda: render_jsonp(dict(visitor_id=visitor_id), components=components))
+        section("Response")
+        measure("visitor id only", lambda: make_jsonp_response(dict(visitor_id=visitor_id)))
+        measure("visitor id and 4 components", lambda: make_jsonp_response(dict(visitor_id=visitor_id), components=components))
+        measure("error", lambda: make_jsonp_response(dict(error), 400))
+
+
+@benchmark
+def beacon_view():
+    """The app.beacon view function alone, inside a prepared request context"""
+    from app import app, beacon
+    from models import visitor_ids
+
+    ids = customer_ids()
+    url = "/beacon.js?id=%s&dl=http%%3A//customer0-site0.com/&cc=%s&sw=1920&sh=1080&sc=24" % (ids[0], visitor_ids.new())
+    for label, query in (("no placeholders", ""), ("4 placeholders", "&pc=ape-W3P0xOxK3rLV%20ape-A9GDeXaib6kZ%20ape-oXjwYAV0bd9T%20ape-nNQQOYbFBbPI")):
+        with app.test_request_context(url + query), admission():
+            measure(label, beacon, number=2000)
+
+
+@benchmark
+def wsgi_beacon():
+    """End to end /beacon.js through WSGI with a realistic request mix"""
+    from app import app
+    from server import beacon_wsgi
+
+    environs = wsgi_environs(beacon_query_strings(5000))
+    for title, wsgi_app in (("Flask route", app), ("Lean beacon_wsgi", beacon_wsgi)):
+        section(title)
+        call = wsgi_call(wsgi_app)
+        for environ in environs[:500]:
+            call(environ) # Warm caches
+        with admission():
+            for threads in (1, 4):
+                measure_requests("%d thread(s)" % threads, call, environs, threads=threads)
+
+
+@benchmark
+def batch_beacon():
+    """Interaction events through beacon_wsgi: one /beacon.js request per event vs /batch.js batches"""
+    from server import beacon_wsgi
+    from models import visitor_ids
+
+    ids = customer_ids()
+    page = "id=%s&dl=http%%3A//customer0-site0.com/&cc=%s&ld=1490916389000&sw=1920&sh=1080&sc=24" % (ids[0], visitor_ids.new())
+    call = wsgi_call(beacon_wsgi)
+    for size in (1, 10, 50):
+        section("%d events" % size)
+        events = wsgi_environs([page + "&ev=click&ld=%d" % (1490916389000 + i) for i in range(size)])
+        batch = wsgi_environs([page + "&eb=" + ",".join("click.%d" % i for i in range(size))], '/batch.js')[0]
+        with admission():
+            single = measure("one request per event", lambda: [call(environ) for environ in events], number=200)
+            batched = measure("one batch request", lambda: call(batch), number=200)
+        print "  %-48s %12.0f vs %.0f events/sec" % ("events", batched * size, single * size)
+        record("events per second", single=single * size, batched=batched * size)
+
+
+@benchmark
+def http_caching():
+    """Script and anonymous components requests through WSGI: full responses vs 304 revalidations,
+    and a per-visitor beacon vs the shared components response"""
+    from werkzeug.test import create_environ
+    from app import app, ape_js
+    from server import beacon_wsgi
+
+    ids = customer_ids()
+    call = wsgi_call(beacon_wsgi)
+    placeholders = "ape%20ape-W3P0xOxK3rLV%20ape-A9GDeXaib6kZ%20ape-oXjwYAV0bd9T%20ape-nNQQOYbFBbPI"
+    etag = '"%s"' % ape_js.etag
+
+    section("ape.js")
+    measure("full response", lambda: call(create_environ('/ape.js')), number=2000)
+    revalidate = create_environ('/ape.js', headers=[('If-None-Match', etag)])
+    measure("304 Not Modified", lambda: call(revalidate), number=2000)
+    print "  %-48s %12d vs 0 bytes" % ("body", len(ape_js.body))
+
+    section("Anonymous components, 4 placeholders")
+    beacon = create_environ('/beacon.js', query_string="id=%s&dl=http%%3A//customer0-site0.com/&pc=%s" % (ids[0], placeholders))
+    with admission():
+        measure("per-visitor /beacon.js", lambda: call(beacon), number=2000)
+    components = create_environ('/components.js', query_string="id=%s&pc=%s" % (ids[0], placeholders))
+    measure("shared /components.js", lambda: call(components), number=2000)
+    response = app.test_client().get(components['PATH_INFO'] + '?' + components['QUERY_STRING'])
+    revalidate = create_environ('/components.js', query_string=components['QUERY_STRING'],
+        headers=[('If-None-Match', response.headers['ETag'])])
+    measure("shared /components.js, 304 Not Modified", lambda: call(revalidate), number=2000)
+
+
+@benchmark
+def user_agents():
+    """User agent classification: parsing every request vs the cache over a skewed stream of distinct
+    user agents, and a crawler's beacon vs a browser's through beacon_wsgi"""
+    from useragents import UserAgents, parse
+    from server import beacon_wsgi
+
+    # Browser builds vary by version, so a site sees thousands of distinct strings, some far more often
+    rng = random.Random(1)
+    distinct = [agent.replace("/5", "/5.%d" % i, 1) if i else agent for i in range(500) for agent in USER_AGENTS]
+    stream = [distinct[int(len(distinct) * rng.random() ** 4)] for i in range(100000)]
+
+    section("Classify")
+    chrome = USER_AGENTS[0]
+    measure("parse", lambda: parse(chrome), number=20000)
+    agents = UserAgents(maxsize=10000)
+    agents.classify(chrome)
+    measure("classify, cached", lambda: agents.classify(chrome), number=20000)
+
+    requests = itertools.cycle(stream)
+    for maxsize in (100, 1000, 10000):
+        agents = UserAgents(maxsize=maxsize)
+        label = "classify, %d distinct, cache of %d" % (len(distinct), maxsize)
+        measure(label, lambda: agents.classify(next(requests)), number=len(stream), repeat=1)
+        stats = agents.stats()
+        print "  %-48s %12.1f%% hits %10.3f us/parse" % ("", stats['hit_rate'] * 100,
+            stats['parse_seconds'] / stats['parses'] * 1e6)
+        record(label + " cache", hit_rate=stats['hit_rate'], us_per_parse=stats['parse_seconds'] / stats['parses'] * 1e6)
+
+    section("Beacon through beacon_wsgi, 4 placeholders")
+    ids = customer_ids()
+    call = wsgi_call(beacon_wsgi)
+    query = "id=%s&dl=http%%3A//customer0-site0.com/&ev=pageload&pc=ape%%20ape-W3P0xOxK3rLV%%20ape-A9GDeXaib6kZ%%20ape-oXjwYAV0bd9T%%20ape-nNQQOYbFBbPI&ua=" % ids[0]
+    with admission():
+        for label, agent in (("browser", USER_AGENTS[0]), ("crawler", USER_AGENTS[-1])):
+            environ = wsgi_environs([query + agent.replace(' ', '%20')])[0]
+            measure(label, lambda: call(environ), number=2000)
+
+
+@benchmark
+def rate_limits():
+    """Admission control in beacon_wsgi: the cost of a refused request, and latency for other customers
+    while one customer floods a single worker, with and without rate limits"""
+    import models
+    from server import beacon_wsgi
+    from limits import RateLimiter
+
+    ids = customer_ids()
+    call = wsgi_call(beacon_wsgi)
+
+    section("RateLimiter")
+    limiter = RateLimiter(1000, 2000)
+    keys = itertools.cycle([str(i) for i in range(10000)])
+    measure("allow, 10000 keys", lambda: limiter.allow(next(keys)), number=100000)
+
+    # A traffic spike: page views from new visitors to one customer's site
+    flooder = len(ids) - 1
+    flood = wsgi_environs(["id=%s&dl=http%%3A//customer%d-site0.com/&ev=pageload&ld=1490916389000&sw=1920&sh=1080&sc=24"
+        % (ids[flooder], flooder)])[0]
+    section("Flood request")
+    with admission():
+        flood_capacity = measure("admitted", lambda: call(flood), number=2000)
+    with admission(customer=(1, 1)):
+        measure("refused, customer over its rate", lambda: call(flood), number=2000)
+
+    # Other customers arrive at a fifth of the rate the worker can serve them, the flood at all of its rate.
+    # Without limits the queue grows for as long as the flood lasts; limited to 500 per second, refusals are
+    # cheap enough for the worker to keep up.
+    duration = 2.0
+    rng = random.Random(1)
+    others = [environ for environ in wsgi_environs(beacon_query_strings(5000))
+        if "&id=%s&" % ids[flooder] not in "&%s&" % environ['QUERY_STRING']]
+    with admission():
+        start = time.time()
+        for environ in others:
+            call(environ) # Warms caches too
+        capacity = len(others) / (time.time() - start)
+    normal = [(rng.uniform(0, duration), environ, True) for environ in others[:int(capacity * 0.2 * duration)]]
+    flooding = sorted(normal + [(rng.uniform(0, duration), flood, False) for i in range(int(flood_capacity * duration))])
+    section("Other customers' latency, one worker")
+    for label, schedule, limits in (("no flood", sorted(normal), dict()),
+                                    ("flood, no limits", flooding, dict()),
+                                    ("flood, customer limited to 500/sec", flooding, dict(customer=(500, 500)))):
+        # Finish writing what the last run stored, so background threads don't compete with this one
+        models.visitor_events.stop()
+        models.visitor_store.flush()
+        gc.collect()
+        with admission(**limits):
+            latencies = replay(call, schedule)
+        stats = OrderedDict([('requests', len(latencies))])
+        for p in (50, 95, 99):
+            stats['p%d_ms' % p] = percentile(latencies, p) * 1000
+        print "  %-48s %12d requests   p50 %.3f  p95 %.3f  p99 %.3f ms" % (label,
+            stats['requests'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'])
+        record(label, **stats)
+
+
+def row_report(paths, bucket=3600):
+    """Per-customer page view counts as they would be computed row by row: each event decoded, then counted"""
+    from collections import Counter, defaultdict
+    from eventlog import SegmentReader
+    from analytics import SCREEN_WIDTHS
+    import bisect
+
+    widths = list(SCREEN_WIDTHS)
+    counts = defaultdict(lambda: dict(urls=Counter(), screens=Counter(), languages=Counter(),
+                                      referrers=Counter(), timeline=Counter()))
+    for path in paths:
+        for seq, (data_id, data) in SegmentReader(path):
+            if data['event'] != 'pageload':
+                continue
+            customer = counts[data['customer_id']]
+            customer['urls'][data['page_url']] += 1
+            customer['screens'][bisect.bisect_right(widths, data['screen_width'])] += 1
+            customer['languages'][data['language']] += 1
+            customer['referrers'][data['referrer_url']] += 1
+            customer['timeline'][calendar.timegm(data['timestamp'].utctimetuple()) // bucket] += 1
+    return counts
+
+
+@benchmark
+def analytics_report():
+    """Per-customer reports over an event log: row by row in Python vs columnar NumPy, and chunk sizes"""
+    import resource
+    import analytics
+    from app import BEACON_PARAMS
+    from eventlog import EventLog
+
+    directory = tempfile.mkdtemp()
+    try:
+        log = EventLog(directory)
+        query_strings = beacon_query_strings(5000)
+        total = 0
+        for repeat in range(40):
+            events = []
+            for query in query_strings:
+                try:
+                    args = BEACON_PARAMS.parse(query)
+                except ValueError:
+                    continue
+                args['timestamp'] += DT.timedelta(hours=repeat)
+                events.append(("%s-%s" % (args['customer_id'], args['visitor_id']), args))
+            log.extend(events)
+            total += len(events)
+        log.close()
+        paths = analytics.segment_paths([directory])
+        size = sum(os.path.getsize(path) for path in paths)
+        print "  %-48s %12d events, %.1f MB" % ("event log", total, size / 1e6)
+
+        section("Report")
+        for label, run in (("row by row", lambda: row_report(paths)), ("columnar", lambda: analytics.analyse(paths))):
+            start = time.time()
+            run()
+            rate = total / (time.time() - start)
+            print "  %-48s %12.0f events/sec" % (label, rate)
+            record(label, ops=rate)
+        report = analytics.analyse(paths)
+        batch, dictionaries = analytics.load(paths)
+        measure("aggregates over loaded arrays", lambda: analytics.Report(dictionaries).add(batch), number=10)
+        measure("render one customer", lambda: report.for_customer(report.customers()[0]), number=1000)
+
+        section("Chunk size")
+        for chunk_size in (1000, 10000, 100000, total):
+            # In a child process, so each peak is measured from the same starting point
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                gc.collect()
+                before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                analytics.analyse(paths, chunk_size=chunk_size)
+                elapsed = time.time() - start
+                os.write(write, json.dumps([elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before]))
+                os._exit(0)
+            os.close(write)
+            elapsed, peak = json.loads(os.read(read, 1024))
+            os.close(read)
+            os.waitpid(pid, 0)
+            print "  %-48s %12.0f events/sec, peak RSS +%d KB" % ("%d events" % chunk_size, total / elapsed, peak)
+            record("%d events" % chunk_size, ops=total / elapsed, peak_kb=peak)
+    finally:
+        shutil.rmtree(directory)
+
+
+def http_load(job):
+    """Send GET requests for paths to a local port, one connection each, for duration seconds.
+    Returns the number answered. Runs in a client process."""
+    import httplib
+    port, paths, duration = job
+    done = 0
+    end = time.time() + duration
+    while time.time() < end:
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+        connection.request('GET', paths[done % len(paths)])
+        connection.getresponse().read()
+        connection.close()
+        done += 1
+    return done
+
+
+@benchmark
+def prefork():
+    """server.py --workers N over HTTP: throughput, startup time and per-worker memory as workers are added"""
+    import re
+    import socket
+    import subprocess
+    import multiprocessing
+    from config import make_engine, SQL_Session, SQL_Base
+    from models import Customer
+    from server import process_memory
+
+    # The server processes need a database file holding the fixture customers
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///' + os.path.join(directory, 'prefork.db')
+    engine = make_engine(url)
+    SQL_Base.metadata.create_all(engine)
+    session = SQL_Session(bind=engine)
+    for id in customer_ids():
+        customer = Customer.get(id)
+        session.add(Customer(id=id, name=customer.name, sites=list(customer.sites)))
+    session.commit()
+    session.close()
+    engine.dispose()
+
+    paths = ['/beacon.js?' + qs for qs in beacon_query_strings(5000)]
+    cores = multiprocessing.cpu_count()
+    duration = 3.0
+    print "  %d cores, %d client processes per worker, %.0fs per run" % (cores, 2, duration)
+
+    for workers in sorted(set([1, 2, cores])):
+        section("%d worker%s" % (workers, "s" if workers > 1 else ""))
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        server = subprocess.Popen([sys.executable, 'server.py', '--workers', str(workers), '--threaded',
+            '--host', '127.0.0.1', '--port', str(port)], cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, APE_DATABASE_URL=url), stderr=subprocess.PIPE)
+        startup, pids = None, []
+        while len(pids) < workers:
+            line = server.stderr.readline()
+            if not line:
+                raise RuntimeError("server.py exited before serving")
+            match = re.search(r"started in ([\d.]+)s", line)
+            if match:
+                startup = float(match.group(1))
+            match = re.match(r"Worker \d+ pid (\d+)", line)
+            if match:
+                pids.append(int(match.group(1)))
+        drain = threading.Thread(target=server.stderr.read) # Error logs from bad requests mustn't block the server
+        drain.daemon = True
+        drain.start()
+
+        sys.stdout.flush() # Forked clients would otherwise each print what's buffered again
+        clients = multiprocessing.Pool(workers * 2)
+        try:
+            answered = sum(clients.map(http_load, [(port, paths[i::workers * 2], duration) for i in range(workers * 2)]))
+        finally:
+            clients.close()
+            clients.join()
+        memory = [process_memory(pid) for pid in pids]
+        server.terminate()
+        server.wait()
+
+        rate = answered / duration
+        rss = [m[0] for m in memory if m[0] is not None]
+        pss = [m[1] for m in memory if m[1] is not None]
+        stats = OrderedDict([('workers', workers), ('requests_per_sec', rate), ('requests_per_sec_per_worker', rate / workers),
+            ('startup_sec', startup), ('worker_rss_mb', sum(rss) / len(rss) / 1048576.0 if rss else None),
+            ('worker_pss_mb', sum(pss) / len(pss) / 1048576.0 if pss else None)])
+        print "  %-48s %12.0f req/sec %8.0f per worker   started in %.3fs   worker RSS %s PSS %s" % ("HTTP beacons",
+            rate, rate / workers, startup or 0,
+            "%.1f MB" % stats['worker_rss_mb'] if rss else "n/a", "%.1f MB" % stats['worker_pss_mb'] if pss else "n/a")
+        record("HTTP beacons", **stats)
+
+    shutil.rmtree(directory)
+
+
+def compare(baseline):
+    """Print each result of this run as a ratio of the same result in a baseline results dict"""
+    print "Compared with %s" % baseline['meta']['time']
+    keys = ('ops_per_sec', 'requests_per_sec', 'p50_ms', 'p95_ms', 'p99_ms', 'bytes_per_object')
+    for name, measured in results.items():
+        for label, values in measured.items():
+            before = baseline['results'].get(name, {}).get(label)
+            if not before:
+                continue
+            ratios = ["%s x%.2f" % (key, values[key] / before[key])
+                for key in keys if values.get(key) and before.get(key)]
+            print "  %-64s %s" % ("%s %s" % (name, label), "  ".join(ratios))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark APE hot paths")
+    parser.add_argument('names', nargs='*', metavar='benchmark', help="Benchmarks to run, default all")
+    parser.add_argument('--save', metavar='PATH', help="Save results as JSON")
+    parser.add_argument('--compare', metavar='PATH', help="Compare results with a saved JSON run")
+    parser.add_argument('--log', action='store_true', help="Keep APE logging enabled")
+    parser.add_argument('--database', metavar='URL', help="Database to benchmark against, eg sqlite:///var/bench.db")
+    options = parser.parse_args()
+
+    # Modules are imported by each benchmark, so config reads these first
+    if options.database:
+        os.environ['APE_DATABASE_URL'] = options.database
+
+    # Synthetic events and visitor state go to a scratch directory, never var/, read by reports
+    os.environ['APE_VAR_DIR'] = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, os.environ['APE_VAR_DIR'], True) # Last, after the app's own exit handlers
+
+    if not options.log:
+        logging.disable(logging.CRITICAL)
+
+    for name in options.names or benchmarks.keys():
+        print "%s: %s" % (name, benchmarks[name].__doc__)
+        current.update(benchmark=name, section=None)
+        benchmarks[name]()
+
+    if options.save:
+        meta = dict(time=DT.datetime.utcnow().isoformat(), python=sys.version.split()[0], argv=sys.argv[1:])
+        with open(options.save, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2)
+        print "Saved %s" % options.save
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f))
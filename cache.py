@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# In-process caches for hot lookups
+#
+# LRUCache : A bounded, thread-safe LRU cache with expiry and negative caching
+#
+# A miss is loaded once however many requests want the key at the same time:
+# the first loads it, outside the lock, and the rest wait for its result. A
+# key invalidated or set while its load is running isn't overwritten by the
+# value loaded, which may be older.
+
+import time
+import threading
+from collections import OrderedDict
+
+DEFAULT = object() # The cache's own ttl
+
+
+class _Load(object):
+
+    __slots__ = ('done', 'value', 'failed', 'superseded')
+
+    def __init__(self, event):
+        self.done       = event() # Set when the load has finished
+        self.value      = None
+        self.failed     = False   # The loader raised, so waiters load for themselves
+        self.superseded = False   # The key was invalidated or set while loading, so the value isn't cached
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=1024, ttl=None, negative_ttl=None, clock=time.time, event=threading.Event):
+        """Construct a cache holding at most maxsize entries, each expiring after ttl seconds (None for never).
+        Misses (None values) are cached for negative_ttl seconds, or not at all if negative_ttl is 0.
+        Requests waiting on another's load wait on an event(), which cooperative serving modes replace."""
+        self.maxsize      = maxsize
+        self.ttl          = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.clock        = clock
+        self.hits         = 0
+        self.misses       = 0
+        self.evictions    = 0
+        self.event        = event
+        self._entries     = OrderedDict() # key => (expires, value)
+        self._loading     = dict()        # key => _Load running now
+        self._lock        = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        """Return the live (expires, value) entry for key, refreshing its recency, or None. Lock must be held."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= self.clock():
+            return None
+        self._entries[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if absent or expired"""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=DEFAULT):
+        """Cache value for key, evicting the least recently used entries when full. ttl overrides the
+        cache's own for this entry, None for never expiring."""
+        with self._lock:
+            self._supersede(key)
+            self._store(key, value, ttl)
+        return value
+
+    def _store(self, key, value, ttl=DEFAULT):
+        """Cache value for key, unless its ttl is 0. Lock must be held."""
+        if ttl is DEFAULT:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl == 0:
+            return
+        expires = self.clock() + ttl if ttl is not None else None
+        self._entries.pop(key, None)
+        self._entries[key] = (expires, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _supersede(self, key):
+        """Stop a load of key running now from caching its value. Lock must be held."""
+        load = self._loading.pop(key, None)
+        if load is not None:
+            load.superseded = True
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() to fill the cache on a miss, once for all
+        concurrent misses of the key. A loader returning None is negatively cached."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            load = self._loading.get(key)
+            if load is None:
+                load = self._loading[key] = _Load(self.event)
+                loading = True
+            else:
+                loading = False
+
+        if not loading:
+            load.done.wait()
+            if not load.failed:
+                return load.value
+            return loader() # Let this request see the error for itself
+
+        # Load outside the lock so a slow loader doesn't block other keys
+        try:
+            value = loader()
+        except Exception:
+            load.failed = True
+            with self._lock:
+                if self._loading.get(key) is load:
+                    del self._loading[key]
+            load.done.set()
+            raise
+        load.value = value
+        with self._lock:
+            if not load.superseded:
+                del self._loading[key]
+                self._store(key, value)
+        load.done.set()
+        return value
+
+    def invalidate(self, key):
+        """Remove key from the cache, returning True if it was present. A load of key running now
+        isn't cached."""
+        with self._lock:
+            self._supersede(key)
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        """Remove all entries from the cache and reset counters. Loads running now aren't cached."""
+        with self._lock:
+            for key in self._loading.keys():
+                self._supersede(key)
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return cache counters as a dict"""
+        return dict(size=len(self._entries), maxsize=self.maxsize,
+            hits=self.hits, misses=self.misses, evictions=self.evictions)
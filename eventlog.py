@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Append-only local log of beacon events
+#
+# EventLog : A directory of segment files, appended to and replayed in order
+# SegmentReader : A memory-mapped sequential reader over one segment file
+#
+# Each segment starts with a header of magic, format version and the sequence
+# number of its first record. Records follow back to back as
+#
+#   [body length: uint32][crc32 of body: uint32][body]
+#
+# The body is a (data_id, data) visitor event packed against a fixed schema of
+# beacon fields: ints and the timestamp as zigzag varints, strings as varint
+# length prefixed utf-8. A torn record at the tail of the last segment, from a
+# crash mid-write, is truncated when the log is reopened.
+
+import os
+import mmap
+import zlib
+import struct
+import calendar
+import threading
+import datetime as DT
+from ingest import claim, unfinished, reject
+
+MAGIC   = 'APEL'
+VERSION = 1
+HEADER  = struct.Struct('<4sBQ')  # magic, version, first sequence number
+RECORD  = struct.Struct('<II')    # body length, crc32
+SUFFIX  = '.log'
+
+# Beacon fields stored for each event, in body order
+INT_FIELDS    = ('screen_colour', 'screen_height', 'screen_width')
+STRING_FIELDS = ('customer_id', 'visitor_id', 'page_url', 'referrer_url', 'page_title',
+                 'event', 'language', 'prefix', 'user_agent', 'script_version')
+EPOCH         = DT.datetime(1970, 1, 1)
+
+
+def _varint(out, n):
+    """Append the zigzag varint encoding of int n to the list out"""
+    n = (n << 1) ^ (n >> 63) if n < 0 else n << 1
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+
+
+def _read_varint(body, i):
+    """Return the int decoded at body[i] and the index after it"""
+    n = shift = 0
+    while True:
+        b = ord(body[i])
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return (n >> 1) ^ -(n & 1), i
+
+
+def _string(out, s):
+    """Append a length prefixed utf-8 string to the list out"""
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    else:
+        s = str(s)
+    _varint(out, len(s))
+    out.append(s)
+
+
+def _read_string(body, i):
+    """Return the unicode string decoded at body[i] and the index after it"""
+    n, i = _read_varint(body, i)
+    return body[i:i + n].decode('utf-8'), i + n
+
+
+def encode(event):
+    """Return the body bytes for a (data_id, data) event"""
+    data_id, data = event
+    out = []
+    _string(out, data_id)
+    timestamp = data.get('timestamp')
+    if isinstance(timestamp, DT.datetime):
+        timestamp = calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+    _varint(out, int(timestamp or 0))
+    for field in INT_FIELDS:
+        _varint(out, int(data.get(field) or 0))
+    for field in STRING_FIELDS:
+        _string(out, data.get(field) or '')
+    placeholder_ids = data.get('placeholder_ids') or []
+    _varint(out, len(placeholder_ids))
+    for placeholder_id in placeholder_ids:
+        _string(out, placeholder_id)
+    return ''.join(out)
+
+
+def decode(body):
+    """Return the (data_id, data) event for body bytes"""
+    data = dict()
+    data_id, i = _read_string(body, 0)
+    timestamp, i = _read_varint(body, i)
+    data['timestamp'] = EPOCH + DT.timedelta(milliseconds=timestamp)
+    for field in INT_FIELDS:
+        data[field], i = _read_varint(body, i)
+    for field in STRING_FIELDS:
+        data[field], i = _read_string(body, i)
+    count, i = _read_varint(body, i)
+    data['placeholder_ids'] = list()
+    for n in range(count):
+        placeholder_id, i = _read_string(body, i)
+        data['placeholder_ids'].append(placeholder_id)
+    return data_id, data
+
+
+class SegmentReader(object):
+
+    def __init__(self, path):
+        """Construct a reader over the segment file at path"""
+        self.path      = path
+        self.first_seq = None
+        self.end       = 0 # Offset after the last valid record read
+
+    def records(self):
+        """Yield (sequence number, body) for each valid record, stopping at a torn tail"""
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, version, self.first_seq = HEADER.unpack_from(buf, 0)
+                if magic != MAGIC or version != VERSION:
+                    raise IOError("Not an event log segment: %s" % self.path)
+                seq, offset, size = self.first_seq, HEADER.size, len(buf)
+                self.end = offset
+                while offset + RECORD.size <= size:
+                    length, crc = RECORD.unpack_from(buf, offset)
+                    start = offset + RECORD.size
+                    body = buf[start:start + length]
+                    if len(body) < length or zlib.crc32(body) & 0xffffffff != crc:
+                        break
+                    yield seq, body
+                    seq += 1
+                    offset = self.end = start + length
+            finally:
+                buf.close()
+
+    def __iter__(self):
+        """Yield (sequence number, event) for each valid record"""
+        for seq, body in self.records():
+            yield seq, decode(body)
+
+
+class EventLog(object):
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync=False):
+        """Construct a log of segment files in directory, rotating at segment_size bytes.
+        If fsync is True, every append is forced to disk before returning."""
+        self.directory    = directory
+        self.segment_size = segment_size
+        self.fsync        = fsync
+        self.lock         = threading.Lock()
+        self.file         = None # The open tail segment
+        self.next_seq     = None
+
+    def segments(self):
+        """Return segment paths, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(SUFFIX))
+        return [os.path.join(self.directory, n) for n in names]
+
+    def _open(self):
+        """Open the tail segment for appending, recovering from a torn write. Lock must be held."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        segments = self.segments()
+        if not segments:
+            return self._rotate(0)
+        reader = SegmentReader(segments[-1])
+        count = sum(1 for record in reader.records())
+        if reader.first_seq is None:
+            os.remove(segments[-1]) # Crashed before the header was written
+            return self._open()
+        self.file = open(segments[-1], 'r+b')
+        self.file.truncate(reader.end)
+        self.file.seek(reader.end)
+        self.next_seq = reader.first_seq + count
+
+    def _rotate(self, first_seq):
+        """Close the tail segment and start a new one. Lock must be held."""
+        self._close()
+        path = os.path.join(self.directory, "%020d%s" % (first_seq, SUFFIX))
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, first_seq))
+        self.next_seq = first_seq
+
+    def _flush(self, fsync=None):
+        self.file.flush()
+        if fsync is None:
+            fsync = self.fsync
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def extend(self, events):
+        """Append (data_id, data) events and flush them, returning the sequence number of the first"""
+        records = []
+        for event in events:
+            body = encode(event)
+            records.append(RECORD.pack(len(body), zlib.crc32(body) & 0xffffffff) + body)
+        with self.lock:
+            if self.file is None:
+                self._open()
+            first = self.next_seq
+            for record in records:
+                if self.file.tell() + len(record) > self.segment_size and self.file.tell() > HEADER.size:
+                    self._rotate(self.next_seq)
+                self.file.write(record)
+                self.next_seq += 1
+            self._flush()
+            return first
+
+    def append(self, event):
+        """Append one (data_id, data) event, returning its sequence number"""
+        return self.extend([event])
+
+    def replay(self, start=0):
+        """Yield (sequence number, event) for every event from sequence number start, in order"""
+        with self.lock:
+            if self.file:
+                self._flush()
+            segments = self.segments()
+        for i, path in enumerate(segments):
+            # Skip segments wholly before start, known from the next segment's name
+            if i + 1 < len(segments) and int(os.path.basename(segments[i + 1])[:-len(SUFFIX)]) <= start:
+                continue
+            for seq, event in SegmentReader(path):
+                if seq >= start:
+                    yield seq, event
+
+    def claim(self):
+        """Return the paths of segments to replay when the log is a spill store, oldest first: left
+        unfinished, then every current segment, renamed so appends from here start a fresh log"""
+        with self.lock:
+            self._close()
+            claimed = unfinished(self.directory, '')
+            for path in self.segments():
+                claimed.append(claim(path))
+        return claimed
+
+    def read(self, path):
+        """Yield the events in a claimed segment, in order"""
+        for seq, event in SegmentReader(path):
+            yield event
+
+    def remove(self, path):
+        """Delete a claimed segment, replayed in full"""
+        os.remove(path)
+
+    def reject(self, path):
+        reject(path)
+
+    def _close(self):
+        if self.file:
+            self._flush(fsync=True)
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        """Flush and close the tail segment"""
+        with self.lock:
+            self._close()
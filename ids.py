@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Compact, signed visitor ids
+#
+# VisitorIds : Makes and validates visitor ids signed with a secret key
+#
+# A visitor id packs 16 bytes into 22 characters:
+#
+#   [milliseconds since the epoch: 6 bytes][random: 6 bytes][HMAC-SHA1: 4 bytes]
+#
+# The characters are an ASCII-ordered variant of URL-safe base64, so ids sort
+# by creation time, and keys built from them, eg data_id, are stored near
+# other visitors of the same age. Random bits come from a generator seeded
+# once per process from the OS, so making an id needs no system call; forked
+# workers must reseed. The truncated HMAC lets a forged or mangled id be
+# rejected with one hash, before it reaches any lookup or storage.
+
+import os
+import re
+import hmac
+import time
+import base64
+import random
+import string
+import struct
+import hashlib
+import threading
+
+LENGTH = 22 # Characters in a visitor id
+
+# URL-safe base64 digits in ASCII order, so encoded ids sort as their bytes do
+ALPHABET    = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+BASE64      = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+TO_ORDERED  = string.maketrans(BASE64, ALPHABET)
+TO_BASE64   = string.maketrans(ALPHABET, BASE64)
+
+# The last digit carries 2 bits, padded with zeros, so only 4 of its 64 values are canonical
+VALID       = re.compile("[%s]{%d}[%s]\\Z" % (re.escape(ALPHABET), LENGTH - 1, re.escape(ALPHABET[::16]))).match
+
+# Version 4 UUIDs, as issued before signed ids
+LEGACY = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}\Z").match
+
+_SIX_BYTES = struct.Struct('>Q') # Packs 64 bits, of which the low 48 are kept
+
+
+class VisitorIds(object):
+
+    def __init__(self, key, legacy=False, seed=None):
+        """Construct a generator of ids signed with secret key. If legacy, valid() also accepts the
+        UUIDs issued before, which can't be checked. A seed makes the random bits repeatable."""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if len(key) > 64:
+            key = hashlib.sha1(key).digest()
+        key = key.ljust(64, '\0')
+        # HMAC with its padded key hashes prepared once, so signing is two hash copies
+        self.inner    = hashlib.sha1(key.translate(hmac.trans_36))
+        self.outer    = hashlib.sha1(key.translate(hmac.trans_5C))
+        self.legacy   = legacy
+        self.lock     = threading.Lock()
+        self.counts   = dict(rejected=0, legacy=0)
+        self.reseed(seed)
+
+    def reseed(self, seed=None):
+        """Seed the random bits from the OS, or from seed. Call in each forked process."""
+        self.random = random.Random(seed if seed is not None else os.urandom(16))
+        return self
+
+    def sign(self, body):
+        """Return the 4 byte signature of body"""
+        inner = self.inner.copy()
+        inner.update(body)
+        outer = self.outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()[:4]
+
+    def new(self, now=None):
+        """Return a new id made at time now, in epoch seconds, by default the current time"""
+        now = time.time() if now is None else now
+        body = _SIX_BYTES.pack(int(now * 1000))[2:] + _SIX_BYTES.pack(self.random.getrandbits(48))[2:]
+        return base64.urlsafe_b64encode(body + self.sign(body))[:LENGTH].translate(TO_ORDERED)
+
+    def decode(self, id):
+        """Return the 12 byte body of a well formed and correctly signed id, or None"""
+        if len(id) != LENGTH or not VALID(id):
+            return None
+        raw = base64.urlsafe_b64decode(str(id).translate(TO_BASE64) + '==')
+        body = raw[:12]
+        if not hmac.compare_digest(raw[12:], self.sign(body)):
+            return None
+        return body
+
+    def valid(self, id):
+        """Test if id was made by a generator with this key, or is a legacy UUID if those are accepted"""
+        if self.decode(id) is not None:
+            return True
+        if self.legacy and len(id) == 36 and LEGACY(id):
+            self._count('legacy')
+            return True
+        self._count('rejected')
+        return False
+
+    def timestamp(self, id):
+        """Return when a valid id was made, in epoch seconds, or None"""
+        body = self.decode(id)
+        if body is None:
+            return None
+        return _SIX_BYTES.unpack('\0\0' + body[:6])[0] / 1000.0
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        """Return validation counters as a dict"""
+        with self.lock:
+            return dict(self.counts)
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Asynchronous, batched event ingestion
+#
+# IngestPipeline : A bounded queue drained in batches by background workers
+#
+# Producers call put() on the request thread, which never waits on storage.
+# Workers hand events to the sink in batches of up to batch_size, or whatever
+# has arrived after flush_interval seconds. When the queue is full, the policy
+# decides whether put() drops the event, blocks, or spills it to disk.
+#
+# A spill store has append(event) and claim(), which renames its spilled files
+# to names private to this process and returns them, for read(path), then
+# remove(path) once the sink has taken every event, or reject(path) if the
+# file can't be read. FileSpill pickles any event; eventlog.EventLog stores
+# visitor events compactly. Workers replay spilled events to the sink
+# whenever the queue is empty: on starting, which picks up events spilled
+# before a restart, and every flush_interval seconds while idle. One worker
+# replays at a time. A file the sink fails on stays claimed, to be retried
+# from where it stopped, and files claimed by a process that exited before
+# replaying them are claimed again, so a crash can repeat spilled events but
+# not lose them.
+
+import os
+import time
+import errno
+import pickle
+import itertools
+import atexit
+import logging
+import threading
+from Queue import Queue, Full, Empty
+
+logger = logging.getLogger('APE')
+
+DROP  = 'drop'
+BLOCK = 'block'
+SPILL = 'spill'
+
+_STOP = object() # Queue sentinel, one per worker
+
+CLAIMED  = '.drain' # Suffix of spill files claimed for replay, after ".<pid>-<n>"
+REJECTED = '.bad'   # Suffix of claimed files that couldn't be read, kept for inspection
+_claims  = itertools.count()
+
+
+def claim(path, original=None):
+    """Rename the spill file at path to a name private to this process, returning it"""
+    claimed = "%s.%d-%d%s" % (original or path, os.getpid(), next(_claims), CLAIMED)
+    os.rename(path, claimed)
+    return claimed
+
+
+def _alive(pid):
+    """Test if process pid exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def unfinished(directory, prefix):
+    """Return the paths of files in directory starting with prefix that were claimed for replay and not
+    removed, by this process, or by one that has exited, in which case they're claimed again"""
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith(prefix) or not name.endswith(CLAIMED):
+            continue
+        original, _, owner = name[:-len(CLAIMED)].rpartition('.')
+        try:
+            pid = int(owner.split('-')[0])
+        except ValueError:
+            continue
+        path = os.path.join(directory, name)
+        if pid == os.getpid():
+            paths.append(path)
+        elif not _alive(pid):
+            try:
+                paths.append(claim(path, os.path.join(directory, original)))
+            except OSError:
+                pass # Claimed by another process first
+    return paths
+
+
+def reject(path):
+    """Set a claimed file that can't be read aside, out of replay"""
+    os.rename(path, path[:-len(CLAIMED)] + REJECTED)
+
+
+class FileSpill(object):
+
+    def __init__(self, path):
+        """Construct a spill file of pickled events at path"""
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, event):
+        """Append an event to the spill file"""
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                pickle.dump(event, f, pickle.HIGHEST_PROTOCOL)
+
+    def claim(self):
+        """Return the paths of spill files to replay, oldest first: left unfinished, then the current file,
+        which appends from here replace"""
+        with self.lock:
+            directory, prefix = os.path.split(self.path)
+            claimed = unfinished(directory or '.', prefix + '.')
+            if os.path.exists(self.path):
+                claimed.append(claim(self.path))
+        return claimed
+
+    def read(self, path):
+        """Yield the events in a claimed spill file, in order"""
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+
+    def remove(self, path):
+        """Delete a claimed spill file, replayed in full"""
+        os.remove(path)
+
+    def reject(self, path):
+        reject(path)
+
+
+class IngestPipeline(object):
+
+    def __init__(self, sink, maxsize=10000, batch_size=100, flush_interval=1.0,
+                 workers=1, policy=DROP, spill=None, block_timeout=None):
+        """Construct a pipeline feeding batches (lists) of events to sink(batch)"""
+        if policy not in (DROP, BLOCK, SPILL):
+            raise ValueError("Unknown backpressure policy %r" % policy)
+        if policy == SPILL and spill is None:
+            raise ValueError("Spill policy requires a spill store")
+        self.sink           = sink
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.workers        = workers
+        self.policy         = policy
+        self.spill          = spill
+        self.block_timeout  = block_timeout
+        self.queue          = Queue(maxsize)
+        self.threads        = []
+        self.lock           = threading.Lock()
+        self.replay_lock    = threading.Lock() # One worker replays at a time
+        self.progress       = dict() # Claimed spill path => events stored before the sink failed on it
+        self.counts         = dict(enqueued=0, dropped=0, spilled=0, replayed=0, flushed=0, batches=0, errors=0)
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def start(self):
+        """Start the background workers, if not already running"""
+        with self.lock:
+            if self.threads:
+                return self
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name="ingest-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    @property
+    def running(self):
+        return bool(self.threads)
+
+    def put(self, event):
+        """Queue an event for ingestion, returning False if it was dropped"""
+        if not self.threads:
+            self.start()
+        try:
+            if self.policy == BLOCK:
+                self.queue.put(event, True, self.block_timeout)
+            else:
+                self.queue.put_nowait(event)
+        except Full:
+            if self.policy == SPILL:
+                self.spill.append(event)
+                self._count('spilled')
+                return True
+            self._count('dropped')
+            return False
+        self._count('enqueued')
+        return True
+
+    def _flush(self, batch):
+        """Hand a batch to the sink, logging rather than raising sink errors. Returns whether it succeeded."""
+        try:
+            self.sink(batch)
+        except Exception:
+            self._count('errors')
+            logger.exception("Ingest sink failed for batch of %d events", len(batch))
+            return False
+        self._count('flushed', len(batch))
+        self._count('batches')
+        return True
+
+    def _work(self):
+        """Worker loop: collect events into batches and flush by size or time, and replay spilled
+        events whenever the queue is empty"""
+        batch = []
+        deadline = None
+        self.replay_spill()
+        while True:
+            if deadline is None:
+                # Nothing waiting to be flushed: wait for an event, waking to replay spills if there's a store
+                timeout = self.flush_interval if self.spill is not None else None
+            else:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                event = self.queue.get(True, timeout) if timeout != 0 else self.queue.get_nowait()
+            except Empty:
+                if deadline is None:
+                    self.replay_spill() # Idle, so the queue has drained
+                    continue
+                event = None
+            if event is _STOP:
+                if batch:
+                    self._flush(batch)
+                return
+            if event is not None:
+                batch.append(event)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            if batch and (len(batch) >= self.batch_size or time.time() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def replay_spill(self):
+        """Feed spilled events back to the sink in batches, returning how many. Returns 0 at once if another
+        worker is replaying. Errors are logged, not raised, so they can't stop a worker."""
+        if self.spill is None or not self.replay_lock.acquire(False):
+            return 0
+        replayed = 0
+        try:
+            for path in self.spill.claim():
+                stored, finished = self._replay(path)
+                replayed += stored
+                if not finished:
+                    break # The sink is failing, so retry later
+        except Exception:
+            self._count('errors')
+            logger.exception("Ingest failed replaying spilled events")
+        finally:
+            self.replay_lock.release()
+            if replayed:
+                self._count('replayed', replayed)
+        return replayed
+
+    def _replay(self, path):
+        """Feed one claimed spill file to the sink, from where an earlier attempt stopped, removing it once
+        the sink has taken every event, or setting it aside if it can't be read. Returns how many events
+        were stored, and whether the file is finished with."""
+        done = skip = self.progress.pop(path, 0)
+        stored = 0
+        batch = []
+        try:
+            for event in self.spill.read(path):
+                if skip:
+                    skip -= 1
+                    continue
+                batch.append(event)
+                if len(batch) >= self.batch_size:
+                    if not self._flush(batch):
+                        self.progress[path] = done
+                        return stored, False
+                    done += len(batch)
+                    stored += len(batch)
+                    batch = []
+        except Exception:
+            self._count('errors')
+            logger.exception("Ingest failed reading spilled events from %s, setting it aside", path)
+            if batch and self._flush(batch):
+                stored += len(batch)
+            self.spill.reject(path)
+            return stored, True
+        if batch:
+            if not self._flush(batch):
+                self.progress[path] = done
+                return stored, False
+            stored += len(batch)
+        self.spill.remove(path)
+        return stored, True
+
+    def stop(self, timeout=None):
+        """Drain queued events to the sink and stop the workers"""
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            self.queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """Return pipeline counters as a dict"""
+        with self.lock:
+            stats = dict(self.counts)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def register_shutdown(self):
+        """Flush on interpreter exit"""
+        atexit.register(self.stop)
+        return self
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Admission control for beacon requests
+#
+# RateLimiter : Token buckets by key, eg per customer or per visitor, evicted when idle
+# ConcurrencyLimit : Caps the requests in flight, shedding the excess rather than queueing it
+#
+# A token bucket is kept as one float per key: the time at which it will be
+# full again (the "theoretical arrival time" of the generic cell rate
+# algorithm). Each admitted request pushes that time on by 1/rate seconds,
+# and a request is refused while it is more than burst requests ahead of
+# now. A key whose time has passed has a full bucket, the same as having no
+# entry at all, so idle keys can simply be forgotten.
+#
+# Keys are held in two generations of dicts. Every window seconds the older
+# is dropped and the newer takes its place, so a key unused for a whole
+# window is evicted at no cost per request. The window is at least as long
+# as an empty bucket takes to refill, so only full buckets are forgotten,
+# unless more than max_keys keys turn up within one window: then the
+# generations turn over early, and the limiter fails open rather than grow.
+#
+# Limits are per process: with N pre-fork workers, a key is admitted at up
+# to N times its rate.
+
+import time
+import threading
+
+ROUNDING = 1e-9 # Seconds of slack, so a bucket's last token isn't lost to float error
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst=1, max_keys=100000, clock=time.time):
+        """Construct a limiter admitting rate requests per second per key on average, and bursts of up to
+        burst at once, tracking at most max_keys keys per window. A rate of 0 admits everything."""
+        self.rate      = rate
+        self.burst     = max(burst, 1)
+        self.max_keys  = max_keys
+        self.clock     = clock
+        self.interval  = 1.0 / rate if rate else 0.0             # Seconds each request pushes a key's time on
+        self.tolerance = self.interval * (self.burst - 1) + ROUNDING # Max seconds a key's time may be ahead of now
+        self.window    = max(self.tolerance + self.interval, 1.0)  # Seconds between generations
+        self.current   = dict() # Key => time its bucket is full, for keys used this window
+        self.previous  = dict() # The same, for keys used last window
+        self.rotated   = clock()
+        self.lock      = threading.Lock()
+        self.admitted  = 0
+        self.limited   = 0
+        self.evicted   = 0
+
+    def allow(self, key):
+        """Take a token from key's bucket, returning False, and counting the request limited, if it is empty"""
+        if not self.rate:
+            return True
+        now = self.clock()
+        with self.lock:
+            if now - self.rotated >= self.window or len(self.current) >= self.max_keys:
+                self._rotate(now)
+            full = self.current.get(key)
+            if full is None:
+                full = self.previous.pop(key, now)
+            if full < now:
+                full = now
+            if full - now > self.tolerance:
+                self.current[key] = full
+                self.limited += 1
+                return False
+            self.current[key] = full + self.interval
+            self.admitted += 1
+            return True
+
+    def _rotate(self, now):
+        """Forget the keys unused for a window, and start a new one. Lock must be held."""
+        self.evicted += len(self.previous)
+        self.previous, self.current = self.current, dict()
+        self.rotated = now
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def stats(self):
+        """Return limiter counters as a dict"""
+        with self.lock:
+            return dict(keys=len(self), admitted=self.admitted, limited=self.limited, evicted=self.evicted)
+
+
+class ConcurrencyLimit(object):
+
+    def __init__(self, limit):
+        """Construct a limit of limit requests in flight at once, or none if 0"""
+        self.limit  = limit
+        self.active = 0
+        self.peak   = 0
+        self.shed   = 0
+        self.lock   = threading.Lock()
+
+    def acquire(self):
+        """Count a request in, returning False, and counting it shed, if the limit is already in flight"""
+        with self.lock:
+            if self.limit and self.active >= self.limit:
+                self.shed += 1
+                return False
+            self.active += 1
+            if self.active > self.peak:
+                self.peak = self.active
+            return True
+
+    def release(self):
+        """Count an acquired request out"""
+        with self.lock:
+            self.active -= 1
+
+    def stats(self):
+        """Return concurrency counters as a dict"""
+        with self.lock:
+            return dict(active=self.active, peak=self.peak, limit=self.limit, shed=self.shed)
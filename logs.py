@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Logging off the request path
+#
+# QueueHandler : Puts log records on a bounded queue, dropping and counting them when it is full
+# QueueListener : A background thread handing queued records to the real handlers
+# SamplingFilter : Passes a fixed fraction of records at each level
+#
+# A request thread only creates a record and appends it to the queue, a
+# deque, which takes no lock; the listener polls it, and formats and writes
+# each record. Messages are formatted lazily from the record's args, so a
+# record that is filtered, sampled out or dropped is never formatted at all.
+# Tracebacks are the exception: they're rendered before queueing, as the
+# frames they refer to won't outlive the request.
+#
+# Hot paths can ask sampled(level) before logging, to skip creating a record
+# at all, and pass extra={'sampled': True} so it isn't sampled again.
+
+import os
+import atexit
+import random
+import logging
+import threading
+from time import sleep # Bound now, so the listener stays a real thread if gevent patches time later
+from collections import deque
+
+
+class QueueHandler(logging.Handler):
+
+    def __init__(self, maxsize=10000):
+        """Construct a handler putting records on a queue of at most maxsize records"""
+        logging.Handler.__init__(self)
+        self.maxsize = maxsize
+        self.queue   = deque()
+        self.dropped = 0
+
+    def createLock(self):
+        self.lock = None # Appending to a deque is atomic, so emit() needn't be serialised
+
+    def emit(self, record):
+        """Queue a record without waiting, or drop it if the queue is full"""
+        if record.exc_info:
+            # Render the traceback now, and let the frames go
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if len(self.queue) >= self.maxsize:
+            self.dropped += 1 # Racy across threads, but never blocks
+            return
+        self.queue.append(record)
+
+    def stats(self):
+        """Return queue counters as a dict"""
+        return dict(queued=len(self.queue), maxsize=self.maxsize, dropped=self.dropped)
+
+
+class QueueListener(object):
+
+    def __init__(self, queue_handler, *handlers, **options):
+        """Construct a listener handing records from queue_handler's queue to handlers, checking
+        the queue every interval seconds (an option, default 0.05) while it is empty"""
+        self.queue_handler = queue_handler
+        self.handlers      = handlers
+        self.interval      = options.get('interval', 0.05)
+        self.thread        = None
+        self.pid           = None
+        self.lock          = threading.Lock()
+
+    def start(self):
+        """Start the listener thread in this process, if not already running. After a fork,
+        records queued before it are left to the parent."""
+        with self.lock:
+            if self.pid == os.getpid():
+                return self
+            if self.pid is not None:
+                self.queue_handler.queue.clear()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._work, name="log-listener")
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def _work(self):
+        """Listener loop: write queued records until stopped"""
+        while self.thread is threading.current_thread():
+            if not self.drain():
+                sleep(self.interval)
+
+    def drain(self):
+        """Format and write every queued record with each handler at or below its level, returning how many"""
+        queue = self.queue_handler.queue
+        n = 0
+        while True:
+            try:
+                record = queue.popleft()
+            except IndexError:
+                return n
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            n += 1
+
+    def stop(self):
+        """Stop the listener thread, then write every queued record"""
+        with self.lock:
+            thread, self.thread, self.pid = self.thread, None, None
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self.drain()
+
+    def register_shutdown(self):
+        """Write queued records on interpreter exit"""
+        atexit.register(self.stop)
+        return self
+
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rates):
+        """Construct a filter passing a fraction of records at each level, from a dict of level => rate from
+        0 to 1. Levels not in rates are always passed, as are records logged with extra={'sampled': True}."""
+        logging.Filter.__init__(self)
+        self.rates = dict((logging._checkLevel(level), rate) for level, rate in rates.items())
+
+    def sampled(self, level):
+        """Decide whether a record at level is logged, before it is created"""
+        rate = self.rates.get(level, 1)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def filter(self, record):
+        return getattr(record, 'sampled', False) or self.sampled(record.levelno)
+
+
+def configure(logger, level, queue=True, queue_size=10000, rates=None, handler=None):
+    """Set logger's level and make it log to handler, by default stderr, sampling records at rates.
+    Returns the started QueueListener if records pass through a queue, else None, and the SamplingFilter."""
+    handler = handler or logging.StreamHandler()
+    logger.setLevel(level)
+    sampling = SamplingFilter(rates or {})
+    if not queue:
+        handler.addFilter(sampling)
+        logger.addHandler(handler)
+        return None, sampling
+    queue_handler = QueueHandler(queue_size)
+    queue_handler.addFilter(sampling)
+    logger.addHandler(queue_handler)
+    return QueueListener(queue_handler, handler).start().register_shutdown(), sampling
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# In-process metrics, exposed in the Prometheus text format
+#
+# Counter : A count of events, optionally split by one label
+# Histogram : A distribution of observed values in fixed buckets, optionally split by one label
+# Gauge : A value read from a callback when metrics are scraped
+# Registry : A set of metrics rendered together
+# StageTimer : Times consecutive stages of one request into a Histogram
+# Sampler : Chooses which requests get a StageTimer
+#
+# Timings are sampled: only a fraction of requests are timed, decided once per
+# request, so unsampled requests pay for a random() call and nothing else.
+# Histogram counts are therefore of sampled requests, not all requests.
+
+import time
+import random
+import bisect
+import threading
+
+# Seconds, from 10us to 1s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_value(value):
+    """Return a sample value in the text format"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, label=None):
+        """Construct a metric called name, optionally split by values of one label"""
+        self.name   = name
+        self.help   = help
+        self.label  = label
+        self.lock   = threading.Lock()
+        self.values = dict() # Label value (None if unlabelled) => metric value
+
+    def labels(self, value, extra=None):
+        """Return the label set for a sample with this label value, and an extra (name, value) pair"""
+        pairs = []
+        if self.label is not None:
+            pairs.append((self.label, value))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+    def samples(self):
+        """Return (suffix, labels, value) samples for rendering"""
+        raise NotImplementedError
+
+    def render(self):
+        """Return this metric in the text format"""
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, labels, format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, label=None, n=1):
+        """Add n to the count for a label value"""
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + n
+
+    def get(self, label=None):
+        return self.values.get(label, 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [('', self.labels(label), value) for label, value in values]
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        """Construct a histogram with the given upper bucket bounds"""
+        Metric.__init__(self, name, help, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, label=None):
+        """Record one observed value for a label value"""
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label)
+            if counts is None:
+                # Per-bucket counts, with the overflow bucket last, then the sum of values
+                counts = self.values[label] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def count(self, label=None):
+        counts = self.values.get(label)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self.lock:
+            values = sorted((label, list(counts)) for label, counts in self.values.items())
+        samples = []
+        for label, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append(('_bucket', self.labels(label, ('le', format_value(float(bound)))), total))
+            samples.append(('_sum', self.labels(label), counts[-1]))
+            samples.append(('_count', self.labels(label), total))
+        return samples
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, help, func, label=None):
+        """Construct a gauge read from func(), which returns a number, or a dict of label value => number"""
+        Metric.__init__(self, name, help, label)
+        self.func = func
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return [('', self.labels(label), v) for label, v in sorted(value.items())]
+        return [('', self.labels(None), value)]
+
+
+class Registry(object):
+
+    def __init__(self):
+        """Construct an empty registry"""
+        self.metrics = []
+
+    def add(self, metric):
+        """Register a metric, returning it"""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return every metric in the text format"""
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class StageTimer(object):
+
+    __slots__ = ('stages', 'total', 'start', 'last')
+
+    def __init__(self, stages, total):
+        """Start timing a request, recording each stage into the stages histogram and the whole into total"""
+        self.stages = stages
+        self.total  = total
+        self.start  = self.last = time.time()
+
+    def mark(self, stage):
+        """Record the time since the previous mark as stage"""
+        now = time.time()
+        self.stages.observe(now - self.last, stage)
+        self.last = now
+
+    def done(self):
+        """Record the time since the timer started"""
+        self.total.observe(time.time() - self.start)
+
+
+class NullTimer(object):
+    """Stands in for a StageTimer on requests that aren't sampled"""
+
+    __slots__ = ()
+
+    def mark(self, stage):
+        pass
+
+    def done(self):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+class Sampler(object):
+
+    def __init__(self, rate):
+        """Construct a sampler choosing a fraction rate, from 0 to 1, of requests"""
+        self.rate = rate
+
+    def timer(self, stages, total):
+        """Return a StageTimer if this request is sampled, else NULL_TIMER"""
+        if self.rate >= 1 or (self.rate > 0 and random.random() < self.rate):
+            return StageTimer(stages, total)
+        return NULL_TIMER
@@ -4,108 +4,475 @@
 # Models for use in APE
 #
 # Component : A personalised section of page content
+# ComponentStore : Components indexed by id and by targeted segment
 # Visitor : A visitor to a site
 # Customer : A site owner
+# Site : A host and optional path owned by a customer, indexed by reversed hostname
 
+import json
 import time
-import uuid
-from config import sql_engine, SQL_Session, SQL_Base
-from sqlalchemy import Column, Integer, String, PickleType
+import itertools
+import threading
+import config
+from cache import LRUCache
+from ingest import IngestPipeline
+from eventlog import EventLog
+from visitors import VisitorStore, make_backend
+from ids import VisitorIds
+from useragents import UserAgents
+from sites import SiteIndex, parse_url, reverse_host, host_suffixes
+from segments import SegmentEngine, VisitorState, build_segments
+from config import sql_engine, SQL_Session, SQL_Base, Worker_Session
+from sqlalchemy import Column, Integer, String, PickleType, ForeignKey, event, bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import relationship, deferred, validates
 
+def run_blocking(func, *args):
+    """Call func(*args). Cooperative serving modes replace this to run blocking I/O off the event loop."""
+    return func(*args)
+
+
+def on_invalidate(id):
+    """Called when a customer is dropped from the cache, or every customer if id is None.
+    Multi-process serving modes replace this to tell sibling processes."""
+    pass
+
+
+# Every site, owned by customer id, loaded in bulk by Site.warm: (SiteIndex, change number when loaded),
+# or None until loaded. Beacons from pages no customer owns are answered without loading their customer.
+site_owners  = None
+site_changes = dict()            # str(customer id) => change number of the customer's latest invalidation
+_changes     = itertools.count() # Numbers invalidations and loads of site_owners, in order
+
+
+def drop_customer(id):
+    """Drop the customer with id from this process's caches, or every customer if id is None"""
+    global site_owners
+    if id is None:
+        customer_cache.clear()
+        site_owners = None
+    else:
+        customer_cache.invalidate(str(id))
+        site_changes[str(id)] = next(_changes) # Its sites in site_owners can't be trusted
+
+
+def warm_caches():
+    """Load the customer, site ownership and component catalogues into this process, returning how many of
+    each were loaded. Customers and sites are skipped if the database has no tables yet."""
+    loaded = dict(customers=0, sites=0, components=component_store.warm())
+    with sql_engine.connect() as connection:
+        if not sql_engine.dialect.has_table(connection, Customer.__tablename__):
+            return loaded
+    loaded.update(customers=Customer.warm(), sites=Site.warm())
+    return loaded
+
+
+# Prepared ORM queries, compiled to SQL once
+bakery = baked.bakery()
+
+# Customers keyed by str(id), shared by all requests in this process
+customer_cache = LRUCache(maxsize=config.CUSTOMER_CACHE_SIZE,
+    ttl=config.CUSTOMER_CACHE_TTL, negative_ttl=config.CUSTOMER_CACHE_NEGATIVE_TTL)
+
+# Makes and checks visitor ids
+visitor_ids = VisitorIds(config.VISITOR_ID_KEY, legacy=config.VISITOR_ID_LEGACY)
+
+# Device, browser and bot classification of user agent strings
+user_agents = UserAgents(maxsize=config.USER_AGENT_CACHE_SIZE)
+
+# Segment state of every visitor keyed by data_id, with hot visitors cached in process
+visitor_store = VisitorStore(
+    make_backend(config.VISITOR_STORE_BACKEND, config.VISITOR_STORE_DIR, config.VISITOR_STORE_SHARDS,
+                 config.VISITOR_STORE_MEMORY_MAX),
+    shards=config.VISITOR_STORE_SHARDS, cache_size=config.VISITOR_STATE_CACHE_SIZE,
+    batch_size=config.VISITOR_STORE_BATCH_SIZE, flush_interval=config.VISITOR_STORE_FLUSH_INTERVAL,
+    revalidate_after=config.VISITOR_STORE_REVALIDATE).register_shutdown()
+
+# Segments, from the rules in config
+SEGMENTS = build_segments(config.SEGMENT_RULES)
+segment_engine = SegmentEngine(SEGMENTS)
+
+# Canonical instances of component ids, so every reference to an id shares one string
+_interned_ids = dict()
+
+
+def intern_id(id):
+    """Return the canonical instance of a str or unicode id"""
+    return _interned_ids.setdefault(id, id)
+
+
+# Placeholder class prefix used by ape.js unless a page sets its own
+DEFAULT_PREFIX = "ape"
 
 
 class Component(object):
 
+    __slots__ = ('id', 'content', 'styles', '_fragment')
+
     def __init__(self, id, content, styles=""):
         """Construct an advert with personalised content and styles"""
         self.id      = id
         self.content = content
         self.styles  = styles
 
+    def __setattr__(self, name, value):
+        """Discard the pre-rendered fragment when the component changes"""
+        if name == 'id':
+            value = intern_id(value)
+        object.__setattr__(self, name, value)
+        if name in ('id', 'content', 'styles'):
+            object.__setattr__(self, '_fragment', None)
+
+    def fragment(self, prefix=DEFAULT_PREFIX):
+        """Return the JSON object member for this component under placeholder prefix. Only the default
+        prefix's is rendered once and kept, as any other prefix comes from the request."""
+        if prefix != DEFAULT_PREFIX:
+            return self._render(prefix)
+        if self._fragment is None:
+            self._fragment = self._render(prefix)
+        return self._fragment
+
+    def _render(self, prefix):
+        key = "%s-%s" % (prefix, self.id)
+        return "%s: %s" % (json.dumps(key), json.dumps(dict(id=self.id, styles=self.styles, content=self.content)))
+
+    @staticmethod
+    def render(components, prefix):
+        """Return a JSON object of components keyed by placeholder class, joined from fragments, cached for the default prefix"""
+        return "{%s}" % ", ".join([component.fragment(prefix) for component in components])
+
+
+class ComponentStore(object):
+
+    def __init__(self, components=()):
+        """Construct a store holding components, untargeted"""
+        self.by_id      = dict() # Component id => Component
+        self.segments   = dict() # Component id => frozenset of targeted segments
+        self.by_segment = dict() # Segment => set of component ids
+        self.lock       = threading.Lock()
+        for component in components:
+            self.add(component)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, component, segments=()):
+        """Add or replace a component, targeted at any of segments, or at every visitor if none"""
+        with self.lock:
+            self._remove(component.id)
+            self.by_id[component.id] = component
+            self.segments[component.id] = frozenset(segments)
+            for segment in segments:
+                self.by_segment.setdefault(segment, set()).add(component.id)
+
+    def remove(self, id):
+        """Remove the component with id, if present"""
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        self.by_id.pop(id, None)
+        for segment in self.segments.pop(id, ()):
+            ids = self.by_segment[segment]
+            ids.discard(id)
+            if not ids:
+                del self.by_segment[segment]
+
+    def get(self, id):
+        """Return the component with id, or None"""
+        return self.by_id.get(id)
+
+    def get_many(self, ids, segments=None):
+        """Return the components with ids, in order, skipping unknown and repeated ids.
+        If segments is given, skip components targeted only at other segments."""
+        result = []
+        seen = set()
+        for id in ids:
+            component = self.by_id.get(id)
+            if component is None or id in seen:
+                continue
+            seen.add(id)
+            if segments is not None:
+                targets = self.segments.get(id)
+                if targets and targets.isdisjoint(segments):
+                    continue
+            result.append(component)
+        return result
+
+    def for_segment(self, segment):
+        """Return the components targeted at segment"""
+        return self.get_many(sorted(self.by_segment.get(segment, ())))
+
+    def all(self):
+        """Return every component"""
+        return self.by_id.values()
+
+    def ids(self):
+        """Return every component id"""
+        return self.by_id.keys()
+
+    def warm(self):
+        """Pre-render every component's fragment for the default prefix, returning the number of components"""
+        for component in self.all():
+            component.fragment()
+        return len(self)
+
+
+# Demo component catalogue, shared so each component's rendered fragments are reused
+COMPONENTS = [
+    Component(id  ='W3P0xOxK3rLV',
+        content='<strong>Ad Number One</strong><br><a href="#">Buy Things!</a>',
+        styles ='.ape-W3P0xOxK3rLV {color: red;}'),
+    Component(id  ='A9GDeXaib6kZ',
+        content='<strong>Ad Number Two</strong><br><a href="#">Buy Things!</a>',
+        styles ='.ape-A9GDeXaib6kZ {color: green;}'),
+    Component(id  ='oXjwYAV0bd9T',
+        content='<strong>Ad Number Three</strong><br><a href="#">Buy Things!</a>',
+        styles ='.ape-oXjwYAV0bd9T {color: blue;}'),
+    Component(id  ='nNQQOYbFBbPI',
+        content='<strong>Ad Number Four</strong><br><a href="#">Buy Things!</a>',
+        styles ='.ape-nNQQOYbFBbPI {color: purple;}'),
+]
+
+# Components available to visitors, by id and segment
+# TODO Load components from DB
+component_store = ComponentStore(COMPONENTS)
+
 
 class Visitor(object):
 
+    __slots__ = ('id', 'customer', 'data_id', 'state')
+
     def __init__(self, customer, id=None):
-        """Construct a Visitor object, for a customer, with an optional or random id"""
-        self.id       = id if id else uuid.uuid4()
+        """Construct a Visitor object, for a customer, with an optional or new id"""
+        self.id       = id if id else visitor_ids.new()
         self.customer = customer
         self.data_id  = "%s-%s" % (self.customer.id, self.id)
+        self.state    = VisitorState()
 
     def update_with_data(self, data):
-        """Update this Visitor record with the payload data"""
-        # TODO save data in NoSQL db using self.data_id
+        """Update this Visitor's segments with the payload data, and queue it for storage without waiting"""
+        segment_engine.update(self.state, data)
+        visitor_store.save(self.data_id, self.state)
+        visitor_events.put((self.data_id, dict(data)))
         return self
 
+    @classmethod
+    def store_events(cls, batch):
+        """Store a batch of (data_id, data) visitor events"""
+        event_log.extend(batch)
+        # TODO save data in NoSQL db using data_id
+
     def data(self):
         """Return full data for this visitor in basic data types"""
-        # TODO Load data from DB
-        return dict()
+        data = dict(self.state.fields)
+        data['segments'] = self.segments()
+        return data
 
     def segments(self):
         """Return a list of segments assigned to this visitor"""
-        # TODO Load data from DB
-        return list()
+        return segment_engine.segments(self.state)
 
     def components(self, ad_ids=[]):
-        """Return all ads with personalised content for this visitor. Optionally filter by ad_ids."""
-        # TODO Load data from DB
-        return [
-            Component(id  ='W3P0xOxK3rLV',
-                content='<strong>Ad Number One</strong><br><a href="#">Buy Things!</a>',
-                styles ='.ape-W3P0xOxK3rLV {color: red;}'),
-            Component(id  ='A9GDeXaib6kZ',
-                content='<strong>Ad Number Two</strong><br><a href="#">Buy Things!</a>',
-                styles ='.ape-A9GDeXaib6kZ {color: green;}'),
-            Component(id  ='oXjwYAV0bd9T',
-                content='<strong>Ad Number Three</strong><br><a href="#">Buy Things!</a>',
-                styles ='.ape-oXjwYAV0bd9T {color: blue;}'),
-            Component(id  ='nNQQOYbFBbPI',
-                content='<strong>Ad Number Four</strong><br><a href="#">Buy Things!</a>',
-                styles ='.ape-nNQQOYbFBbPI {color: purple;}'),
-        ]
+        """Return the ads with personalised content targeted at this visitor's segments. Optionally filter by ad_ids."""
+        return component_store.get_many(ad_ids or component_store.ids(), segments=self.segments())
        
     @classmethod
     def get(cls, customer, id):
-      """Return visitor object with id, for customer"""
-      # TODO Find visitor
-      return Visitor(customer, id)
+      """Return visitor object with id, for customer, with its stored state. A new visitor if id is None,
+      or isn't a valid visitor id."""
+      if id and not visitor_ids.valid(id):
+          id = None # Malformed or forged
+      visitor = Visitor(customer, id)
+      visitor.state = visitor_store.get(visitor.data_id, new=not id)
+      return visitor
       
 
 
+# Durable local record of every visitor event, for replay by segmenting
+event_log = EventLog(config.EVENT_LOG_DIR,
+    segment_size=config.EVENT_LOG_SEGMENT_SIZE, fsync=config.EVENT_LOG_FSYNC)
+
+# Visitor events waiting to be stored, flushed in the background
+visitor_events = IngestPipeline(Visitor.store_events,
+    maxsize=config.INGEST_QUEUE_SIZE, batch_size=config.INGEST_BATCH_SIZE,
+    flush_interval=config.INGEST_FLUSH_INTERVAL, workers=config.INGEST_WORKERS,
+    policy=config.INGEST_POLICY, spill=EventLog(config.INGEST_SPILL_DIR)).register_shutdown()
+
+
 class Customer(SQL_Base):
 
     __tablename__ = 'customers'
 
     id   = Column(Integer, primary_key=True)
     name = Column(String)
-    sites = Column(PickleType, default=list())
+
+    # Sites are loaded with the customer, so cached customers are complete once detached
+    site_rows = relationship('Site', order_by='Site.id', lazy='selectin', cascade='all, delete-orphan')
+    sites     = association_proxy('site_rows', 'site', creator=lambda site: Site(site=site))
+
+    # Pickled site lists from before the sites table, never loaded unless asked for
+    legacy_sites = deferred(Column('sites', PickleType))
 
     def __repr__(self):
         return "<Customer [%s] %s, %s>" % (self.id, self.name, " ".join(self.sites))
 
-    def is_site_owner(self, url):
-        """Test if this customer is owner over this site"""
-        
-        for protocol in ["https://", "http://", "//"]:
-            url = url.lstrip(protocol)
+    def compile_sites(self):
+        """Build the site ownership index, once per load from the database"""
+        self._site_index = SiteIndex(self.sites)
+        return self._site_index
 
-        for site in self.sites:
-            if url.startswith(site): return True
+    @validates('site_rows', include_removes=True)
+    def validate_sites(self, key, site, is_remove):
+        """Discard the site ownership index when sites change"""
+        self._site_index = None
+        return site
 
-        return False
+    def is_site_owner(self, url):
+        """Test if this customer is owner over this site"""
+        index = getattr(self, '_site_index', None) or self.compile_sites()
+        return index.owns(url)
 
     def get_visitor(self, id=None):
         """Return Visitor object with id, belonging to this customer"""
-        # TODO query for visitor
         return Visitor.get(self, id)
 
     @classmethod
     def get(cls, id):
-        """Return Customer object with id"""
-        session = SQL_Session()
-        result = session.query(Customer).filter(Customer.id == id).first()
-        session.close()
-        return result
+        """Return Customer object with id, from the customer cache where possible"""
+        return customer_cache.get_or_load(str(id), lambda: run_blocking(cls.load, id))
+
+    @classmethod
+    def load(cls, id):
+        """Return Customer object with id, from the database"""
+        # Prepared statement, on this thread's reused session
+        query = bakery(lambda session: session.query(Customer))
+        query += lambda q: q.filter(Customer.id == bindparam('id'))
+        session = Worker_Session()
+        try:
+            customer = query(session).params(id=id).first()
+            if customer is not None:
+                customer.compile_sites() # Once per load, before the customer is shared
+            return customer
+        finally:
+            session.close() # Detaches the result and returns the connection to the pool
+
+    @classmethod
+    def invalidate(cls, id=None):
+        """Drop the customer with id from the customer cache, or every customer if id is None"""
+        drop_customer(id)
+        on_invalidate(id)
+
+    @classmethod
+    def warm(cls, limit=None):
+        """Load up to limit customers into the customer cache in one query, returning the number loaded.
+        They expire after CUSTOMER_CACHE_WARM_TTL, if ever, unless invalidated."""
+        session = Worker_Session()
+        try:
+            customers = session.query(Customer).order_by(Customer.id).limit(limit or config.CUSTOMER_CACHE_SIZE).all()
+            for customer in customers:
+                customer.compile_sites()
+                customer_cache.set(str(customer.id), customer, ttl=config.CUSTOMER_CACHE_WARM_TTL)
+        finally:
+            session.close()
+        return len(customers)
+
+    @classmethod
+    def migrate_pickled_sites(cls, session):
+        """Move pickled site lists into the sites table, returning the number of customers migrated.
+        Safe to run repeatedly, as migrated customers have their pickled list cleared."""
+        customers = session.query(Customer).filter(Customer.legacy_sites != None).all()
+        for customer in customers:
+            for site in customer.legacy_sites or []:
+                if site not in customer.sites:
+                    customer.sites.append(site)
+            customer.legacy_sites = None
+        session.commit()
+        return len(customers)
+
+
+class Site(SQL_Base):
+
+    __tablename__ = 'sites'
+
+    id          = Column(Integer, primary_key=True)
+    customer_id = Column(Integer, ForeignKey('customers.id'), nullable=False, index=True)
+    host        = Column(String, nullable=False, index=True) # Reversed hostname, eg "com.foo"
+    site        = Column(String, nullable=False)             # As given, eg "foo.com/blog"
+
+    def __init__(self, site, **kwargs):
+        """Construct a site from a site string, eg "foo.com/blog" """
+        SQL_Base.__init__(self, site=site, host=reverse_host(parse_url(site)[0]), **kwargs)
+
+    def __repr__(self):
+        return "<Site [%s] %s, customer %s>" % (self.id, self.site, self.customer_id)
+
+    @classmethod
+    def owner_of(cls, url, session=None):
+        """Return the id of the customer owning url, or None, querying only the sites of its host
+        and parent domains"""
+        host = parse_url(url)[0]
+        if not host:
+            return None
+        owned = session or Worker_Session()
+        try:
+            rows = owned.query(Site.site, Site.customer_id).filter(Site.host.in_(list(host_suffixes(host)))).all()
+        finally:
+            if session is None:
+                owned.close()
+        return SiteIndex.owners(rows).owner(url)
+
+    @classmethod
+    def warm(cls):
+        """Load every site's owner into site_owners in one query, returning the number of sites"""
+        global site_owners
+        loaded = next(_changes)
+        owners = cls.load_owners()
+        site_owners = (owners, loaded)
+        for id, changed in site_changes.items():
+            if changed < loaded:
+                site_changes.pop(id, None)
+        return len(owners)
+
+    @classmethod
+    def unowned(cls, url, customer_id):
+        """Test if site_owners shows no customer owns url. False if it isn't loaded, or customer_id's sites
+        may have changed since: a site it has added would be missing."""
+        if site_owners is None:
+            return False
+        owners, loaded = site_owners
+        if site_changes.get(str(customer_id), -1) > loaded:
+            return False
+        return not owners.owns(url)
+
+    @classmethod
+    def load_owners(cls, session=None):
+        """Return a SiteIndex of every site, owned by customer id, for routing urls without a query.
+        Reads the sites table only, so no customer is loaded."""
+        owned = session or Worker_Session()
+        try:
+            return SiteIndex.owners(owned.query(Site.site, Site.customer_id).yield_per(1000))
+        finally:
+            if session is None:
+                owned.close()
+
+
+@event.listens_for(Customer, 'after_insert')
+@event.listens_for(Customer, 'after_update')
+@event.listens_for(Customer, 'after_delete')
+def invalidate_customer(mapper, connection, target):
+    """Keep the customer cache coherent with ORM writes made in this process"""
+    Customer.invalidate(target.id)
+
+
+@event.listens_for(Site, 'after_insert')
+@event.listens_for(Site, 'after_update')
+@event.listens_for(Site, 'after_delete')
+def invalidate_site_customer(mapper, connection, target):
+    """Sites written on their own change the customer that owns them"""
+    if target.customer_id is not None:
+        Customer.invalidate(target.customer_id)
 
 
 if __name__ == "__main__":
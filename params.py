@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Declarative query string parameters
+#
+# Param : One query string parameter: its code, name, type, default and limits
+# Schema : A set of Params compiled into one parser over a raw query string
+# ParamError : A required parameter is missing, or a value can't be converted
+#
+# The beacon sends short parameter codes, eg "sw" for screen width. A Schema
+# maps each code to its name and converter once, then parses a query string in
+# one pass: split on '&', skip codes it doesn't know before decoding them, and
+# convert what's left. Defaults are filled from a prepared dict. Every
+# conversion failure becomes a ParamError, so bad input can't escape as an
+# arbitrary exception.
+
+import re
+import datetime as DT
+from urllib import unquote_plus
+
+STRING    = 'string'    # Unicode text truncated to max_length, or with a pattern, rejected unless it matches within max_length
+INT       = 'int'       # An integer between min and max
+ID        = 'id'        # An integer between min and max as its canonical string, so "01", "+1" and " 1" are all u"1"
+BOOL      = 'bool'      # True only for "true"
+TIMESTAMP = 'timestamp' # Epoch milliseconds as a UTC datetime, the time of parsing if missing or invalid
+
+
+class ParamError(ValueError):
+
+    def __init__(self, message, values):
+        """Construct an error for message, with the values parsed so far"""
+        ValueError.__init__(self, message)
+        self.values = values
+
+
+class Param(object):
+
+    def __init__(self, code, name, type=STRING, default="", required=False, min=None, max=None, max_length=None,
+                 pattern=None):
+        """Construct a parameter sent as code and parsed as name"""
+        self.code       = code
+        self.name       = name
+        self.type       = type
+        self.default    = default
+        self.required   = required
+        self.min        = min
+        self.max        = max
+        self.max_length = max_length
+        self.pattern    = pattern
+
+    @property
+    def label(self):
+        """Human readable name for error messages, eg "page url (dl)" """
+        return "%s (%s)" % (self.name.replace('_', ' '), self.code)
+
+    def converter(self):
+        """Return a function converting a decoded value, raising ValueError if it is invalid"""
+        if self.type == STRING:
+            max_length = self.max_length
+            if self.pattern is not None:
+                match = re.compile("(?:%s)\\Z" % self.pattern).match
+                def convert(value):
+                    if max_length and len(value) > max_length or not match(value):
+                        raise ValueError("doesn't match")
+                    return value
+                return convert
+            return (lambda value: value[:max_length]) if max_length else None
+
+        if self.type in (INT, ID):
+            low, high = self.min, self.max
+            canonical = unicode if self.type == ID else int
+            def convert(value):
+                value = int(value)
+                if (low is not None and value < low) or (high is not None and value > high):
+                    raise ValueError("out of range")
+                return canonical(value)
+            return convert
+
+        if self.type == BOOL:
+            return lambda value: value == "true"
+
+        if self.type == TIMESTAMP:
+            def convert(value):
+                try:
+                    return DT.datetime.utcfromtimestamp(int(value) / 1000)
+                except (ValueError, OverflowError):
+                    return DT.datetime.utcnow()
+            return convert
+
+        raise ValueError("Unknown parameter type %r" % self.type)
+
+
+class Schema(object):
+
+    def __init__(self, *params):
+        """Compile params into a parser"""
+        self.params   = params
+        self.by_code  = dict((param.code, (param.name, param.converter(), param)) for param in params)
+        self.defaults = dict((param.name, param.default) for param in params if param.type != TIMESTAMP)
+        self.required = [param for param in params if param.required]
+        self.dynamic  = [(param.name, param.converter()) for param in params if param.type == TIMESTAMP] # Defaults computed per parse
+
+    def parse(self, query_string):
+        """Return a dict of parameter name => value from a raw query string. The first value sent
+        for a code is used. Raises ParamError for a missing required or invalid value."""
+        values = dict(self.defaults)
+        seen = set()
+        error = None
+        for pair in query_string.split('&'):
+            code, _, value = pair.partition('=')
+            field = self.by_code.get(code)
+            if field is None:
+                if '%' not in code and '+' not in code:
+                    continue # Not ours, so not worth decoding
+                field = self.by_code.get(unquote_plus(code))
+                if field is None:
+                    continue
+            name, convert, param = field
+            if name in seen:
+                continue
+            seen.add(name)
+            if '%' in value or '+' in value:
+                value = unquote_plus(value)
+            value = value.decode('utf-8', 'replace')
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except ValueError:
+                    if error is None:
+                        error = "Invalid value for %s" % param.label
+                    continue
+            values[name] = value
+
+        for name, convert in self.dynamic:
+            if name not in seen:
+                values[name] = convert("")
+        if error is not None:
+            raise ParamError(error, values) # First, as a value that failed to convert is left missing
+        for param in self.required:
+            if not values[param.name]:
+                raise ParamError("Value required for %s" % param.label, values)
+        return values
+
+    def echo(self, values):
+        """Return the parsed values of every parameter in the schema, for debug output"""
+        return dict((param.name, values[param.name]) for param in self.params)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Rule based visitor segments
+#
+# Field : A condition on the latest value of a beacon field
+# Count : A condition on how many matching events a visitor has sent, optionally within a window
+# LastSeen : A condition on how recently a visitor sent a matching event
+# Segment : A named set of conditions, all of which must hold
+# build_segments : Segments from rules given as plain data, eg config.SEGMENT_RULES
+# VisitorState : The incremental aggregates and segment membership of one visitor
+# SegmentEngine : Compiled segments, updated one event at a time
+#
+# Segments are compiled once into predicates over a VisitorState, and indexed
+# by the fields and aggregates they read. Each event updates only the
+# aggregates it matches, then re-evaluates only the segments depending on
+# what changed. Conditions with a time window can lapse without any event, so
+# membership is rechecked on read once the earliest window edge has passed.
+
+import time
+import calendar
+import operator
+import datetime as DT
+from collections import deque
+from sites import parse_url
+
+MINUTE = 60
+HOUR   = 60 * MINUTE
+DAY    = 24 * HOUR
+
+OPERATORS = {
+    '==': operator.eq, '!=': operator.ne,
+    '<':  operator.lt, '<=': operator.le,
+    '>':  operator.gt, '>=': operator.ge,
+    'in': lambda value, values: value in values,
+    'prefix': lambda value, prefix: value.startswith(prefix),
+}
+
+
+def event_time(data):
+    """Return the event timestamp in data as epoch seconds, defaulting to now"""
+    timestamp = data.get('timestamp')
+    if isinstance(timestamp, DT.datetime):
+        return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+    return time.time()
+
+
+def path_matches(path, prefix):
+    """Test if path is prefix or below it"""
+    return path == prefix or path.startswith(prefix.rstrip('/') + '/')
+
+
+class Field(object):
+
+    def __init__(self, name, op, value):
+        """Construct a condition comparing the latest value of beacon field name with value"""
+        if op not in OPERATORS:
+            raise ValueError("Unknown operator %r" % op)
+        self.name  = name
+        self.op    = op
+        self.value = value
+
+    def compile(self):
+        """Return a predicate over a VisitorState"""
+        name, compare, value = self.name, OPERATORS[self.op], self.value
+        def predicate(state, now):
+            current = state.fields.get(name)
+            return current is not None and compare(current, value)
+        return predicate
+
+
+class Count(object):
+
+    def __init__(self, event=None, path=None, at_least=1, within=None):
+        """Construct a condition that at least at_least events named event, on pages at or below path,
+        were sent in the last within seconds. None matches any event, any page or all time."""
+        self.event    = event
+        self.path     = path
+        self.at_least = at_least
+        self.within   = within
+
+    @property
+    def key(self):
+        """The aggregate this condition reads, shared by equal conditions"""
+        return ('count', self.event, self.path, self.at_least, self.within)
+
+    def matches(self, event, path):
+        return (self.event is None or self.event == event) and (self.path is None or path_matches(path, self.path))
+
+    def new_aggregate(self):
+        # Only the latest at_least timestamps can decide a windowed count
+        return deque(maxlen=self.at_least) if self.within else [0]
+
+    def update(self, aggregate, timestamp):
+        if self.within:
+            aggregate.append(timestamp)
+        else:
+            aggregate[0] += 1
+
+    def compile(self):
+        """Return a predicate over a VisitorState"""
+        key, at_least, within = self.key, self.at_least, self.within
+        if within is None:
+            def predicate(state, now):
+                aggregate = state.aggregates.get(key)
+                return aggregate is not None and aggregate[0] >= at_least
+        else:
+            def predicate(state, now):
+                aggregate = state.aggregates.get(key)
+                return aggregate is not None and len(aggregate) >= at_least and aggregate[0] > now - within
+        return predicate
+
+    def expires(self, state):
+        """Return when a currently true windowed condition could lapse, or None"""
+        aggregate = state.aggregates.get(self.key)
+        if self.within and aggregate:
+            return aggregate[0] + self.within
+
+
+class LastSeen(Count):
+
+    def __init__(self, event=None, path=None, within=DAY):
+        """Construct a condition that an event named event, on a page at or below path, was sent
+        in the last within seconds"""
+        Count.__init__(self, event=event, path=path, at_least=1, within=within)
+
+
+class Segment(object):
+
+    def __init__(self, name, *conditions):
+        """Construct a named segment whose visitors meet all conditions"""
+        self.name       = name
+        self.conditions = conditions
+
+
+CONDITIONS = dict(field=Field, count=Count, last_seen=LastSeen) # Condition kind => class
+
+
+def build_segments(rules):
+    """Return Segments for (name, [(condition kind, keyword arguments), ...]) rules"""
+    segments = []
+    for name, conditions in rules:
+        for kind, arguments in conditions:
+            if kind not in CONDITIONS:
+                raise ValueError("Unknown condition %r in segment %r" % (kind, name))
+        segments.append(Segment(name, *[CONDITIONS[kind](**arguments) for kind, arguments in conditions]))
+    return segments
+
+
+# Shared by every VisitorState until it has values of its own. Never written to.
+NO_VALUES = dict()
+
+
+class VisitorState(object):
+
+    __slots__ = ('fields', 'aggregates', 'segments', 'expires', 'version', 'checked')
+
+    def __init__(self):
+        """Construct an empty state for a new visitor"""
+        self.fields     = NO_VALUES   # Beacon field => latest value
+        self.aggregates = NO_VALUES   # Aggregate key => counter or window of timestamps
+        self.segments   = frozenset() # Segment names the visitor belongs to
+        self.expires    = None        # When windowed membership must next be rechecked
+        self.version    = None        # Token of the stored copy this was read from or written as, if any
+        self.checked    = 0.0         # When version was last found current in the store
+
+
+class _Compiled(object):
+
+    __slots__ = ('name', 'predicates', 'windows')
+
+    def __init__(self, segment):
+        self.name       = segment.name
+        self.predicates = [condition.compile() for condition in segment.conditions]
+        self.windows    = [c for c in segment.conditions if isinstance(c, Count) and c.within]
+
+    def evaluate(self, state, now):
+        for predicate in self.predicates:
+            if not predicate(state, now):
+                return False
+        return True
+
+
+class SegmentEngine(object):
+
+    def __init__(self, segments=()):
+        """Compile segments and index them by the fields and aggregates they read"""
+        self.compiled = []
+        self.by_field = dict() # Beacon field => [compiled segments reading it]
+        self.by_key   = dict() # Aggregate key => [compiled segments reading it]
+        self.counts   = dict() # Aggregate key => Count condition that maintains it
+        self.by_event = dict() # Event name or None => [Count conditions matching it]
+        self.windowed = []     # Compiled segments that can lapse with time
+        for segment in segments:
+            self.add(segment)
+
+    def add(self, segment):
+        """Compile and index a segment"""
+        compiled = _Compiled(segment)
+        self.compiled.append(compiled)
+        for condition in segment.conditions:
+            if isinstance(condition, Field):
+                self.by_field.setdefault(condition.name, []).append(compiled)
+            elif isinstance(condition, Count):
+                self.by_key.setdefault(condition.key, []).append(compiled)
+                if condition.key not in self.counts:
+                    self.counts[condition.key] = condition
+                    self.by_event.setdefault(condition.event, []).append(condition)
+        if compiled.windows:
+            self.windowed.append(compiled)
+        return self
+
+    def update(self, state, data):
+        """Apply one event's beacon data to state, returning the set of segments whose membership changed"""
+        now = event_time(data)
+        touched = set()
+
+        for name, compiled in self.by_field.items():
+            if name in data and state.fields.get(name) != data[name]:
+                if state.fields is NO_VALUES:
+                    state.fields = dict()
+                state.fields[name] = data[name]
+                touched.update(compiled)
+
+        event = data.get('event')
+        conditions = self.by_event.get(None, [])
+        if event is not None:
+            conditions = self.by_event.get(event, []) + conditions
+        path = None
+        for condition in conditions:
+            if condition.path is not None and path is None:
+                path = parse_url(data.get('page_url', ''))[1]
+            if condition.matches(event, path):
+                aggregate = state.aggregates.get(condition.key)
+                if aggregate is None:
+                    if state.aggregates is NO_VALUES:
+                        state.aggregates = dict()
+                    aggregate = state.aggregates[condition.key] = condition.new_aggregate()
+                condition.update(aggregate, now)
+                touched.update(self.by_key[condition.key])
+
+        return self._evaluate(state, touched, now)
+
+    def _evaluate(self, state, compiled_segments, now):
+        """Re-evaluate compiled_segments for state, returning the names whose membership changed"""
+        changed = set()
+        for compiled in compiled_segments:
+            member = compiled.evaluate(state, now)
+            if member != (compiled.name in state.segments):
+                changed.add(compiled.name)
+        if changed:
+            # Membership changes are rare, so segments is a frozenset replaced on change
+            state.segments = state.segments ^ changed
+        if compiled_segments and self.windowed:
+            state.expires = self._expires(state)
+        return changed
+
+    def _expires(self, state):
+        """Return the earliest time a windowed membership of state could lapse"""
+        expires = None
+        for compiled in self.windowed:
+            if compiled.name in state.segments:
+                for condition in compiled.windows:
+                    when = condition.expires(state)
+                    if when is not None and (expires is None or when < expires):
+                        expires = when
+        return expires
+
+    def segments(self, state, now=None):
+        """Return the sorted segment names state belongs to at time now, rechecking lapsed windows"""
+        now = time.time() if now is None else now
+        if state.expires is not None and state.expires <= now:
+            self._evaluate(state, self.windowed, now)
+        return sorted(state.segments)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Serving modes for the beacon endpoint
+#
+# beacon_wsgi : A lean WSGI app serving /beacon.js without Flask's request machinery
+# serve_cooperative : Serve beacon_wsgi on gevent, with thousands of beacons in flight
+# serve_prefork : Serve beacon_wsgi from worker processes forked with warm caches
+# InvalidationBus : Tells sibling processes which cached customers have changed
+#
+# Usage: python server.py [--host HOST] [--port PORT] [--concurrency N]
+#        python server.py --workers N [--threaded] [--host HOST] [--port PORT]
+#
+# The cooperative mode runs each request in a greenlet. Sockets are patched to
+# yield to the event loop, and customer and visitor loads that miss the cache
+# run in a thread pool, so a request waiting on storage doesn't hold up the rest.
+# Threads are left unpatched so ingestion workers stay real threads, and
+# storage writes never run on the event loop. Python 2 has no asyncio, so
+# gevent is the cooperative runtime here. It is only needed for this mode.
+#
+# The pre-fork mode binds the listening socket and loads the customer, site
+# ownership and component catalogues once in the master, then forks workers
+# that accept from the shared socket. Workers share the warm pages copy on
+# write, each with its own event log, and broadcast customer invalidations to
+# each other over unix datagram sockets. The master restarts workers that die.
+
+import os
+import gc
+import sys
+import glob
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import logging
+import argparse
+import threading
+import config
+import models
+from eventlog import EventLog
+from models import warm_caches
+from werkzeug.datastructures import EnvironHeaders
+from metrics import NULL_TIMER
+from app import app, handle_beacon, render_jsonp, error_payload, sampler, stage_seconds, beacon_seconds, JSONP_HEADERS, log_listener
+from werkzeug.exceptions import BadRequest
+
+logger = logging.getLogger('APE')
+
+BEACON_PATH = '/beacon.js'
+BATCH_PATH  = '/batch.js'
+
+
+def beacon_wsgi(environ, start_response):
+    """Serve /beacon.js and /batch.js through handle_beacon, with the same JSONP contract as the Flask
+    routes. Every other path is passed to the Flask app."""
+    path = environ.get('PATH_INFO')
+    if path == BEACON_PATH:
+        timer = sampler.timer(stage_seconds, beacon_seconds)
+        query_string = environ.get('QUERY_STRING', '')
+    elif path == BATCH_PATH:
+        timer = NULL_TIMER
+        if environ.get('REQUEST_METHOD') == 'POST':
+            length = content_length(environ)
+            if length is None:
+                # The callback is in the unread body, so the error goes to the default one
+                body = render_jsonp(error_payload(BadRequest("Bad Request: Invalid Content-Length")), 400)
+                return jsonp_response(start_response, body)
+            query_string = environ['wsgi.input'].read(min(length, config.BATCH_MAX_BODY))
+        else:
+            query_string = environ.get('QUERY_STRING', '')
+    else:
+        return app(environ, start_response)
+
+    callback, code, payload, components = handle_beacon(query_string, EnvironHeaders(environ), timer,
+        batch=path == BATCH_PATH)
+    body = render_jsonp(payload, code, components, callback)
+    if code == 200:
+        timer.mark('render')
+        timer.done()
+    return jsonp_response(start_response, body)
+
+
+def jsonp_response(start_response, body):
+    """Start a JSONP response and return its body, encoded"""
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+
+    # Response always returns 200 code, to ensure client can handle callback
+    start_response('200 OK', JSONP_HEADERS + [('Content-Length', str(len(body)))])
+    return [body]
+
+
+def content_length(environ):
+    """Return a request's Content-Length, 0 if it has none, or None if it isn't a number of bytes"""
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None
+    return length if length >= 0 else None
+
+
+def offload_blocking(run_blocking, event):
+    """Run customer and visitor loads through run_blocking(func, *args), eg on a threadpool off an event loop.
+    Requests waiting on another's load wait on event, so must be able to yield while it runs."""
+    # An in-memory database is a single connection, so its loads stay where they are
+    if config.sql_engine.url.database not in (None, '', ':memory:'):
+        models.run_blocking = run_blocking
+    models.customer_cache.event = event
+    models.visitor_store.offload(run_blocking, event)
+
+
+def serve_cooperative(host='0.0.0.0', port=3000, concurrency=10000, listener=None):
+    """Serve beacon_wsgi on gevent, with up to concurrency requests in flight.
+    Accepts from listener if given, else binds host and port."""
+    try:
+        from gevent import monkey
+        monkey.patch_all(thread=False)
+        import gevent
+        import gevent.socket
+        import gevent.event
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+    except ImportError:
+        raise SystemExit("Cooperative serving requires gevent: pip install gevent")
+
+    threadpool = gevent.get_hub().threadpool
+    offload_blocking(lambda func, *args: threadpool.apply(func, args), gevent.event.Event)
+
+    if listener is not None:
+        # Accepts on a socket created before patching must yield too
+        listener = gevent.socket.fromfd(listener.fileno(), listener.family, listener.type)
+        host, port = listener.getsockname()[:2]
+
+    logger.info("Serving cooperatively on %s:%d, %d concurrent requests" % (host, port, concurrency))
+    server = WSGIServer(listener or (host, port), beacon_wsgi, spawn=Pool(concurrency), log=None)
+    gevent.signal_handler(signal.SIGTERM, server.stop) # Finish requests in flight, then return
+    server.serve_forever()
+
+
+def serve_threaded(listener, threads=config.SERVER_THREADS):
+    """Serve beacon_wsgi from listener with up to threads requests in flight"""
+    from SocketServer import ThreadingMixIn
+    from werkzeug.serving import BaseWSGIServer
+
+    class Server(ThreadingMixIn, BaseWSGIServer):
+        daemon_threads = True
+        slots = threading.BoundedSemaphore(threads)
+
+        def process_request(self, request, client_address):
+            self.slots.acquire() # Stop accepting when every thread is busy, leaving connections to siblings
+            ThreadingMixIn.process_request(self, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                ThreadingMixIn.process_request_thread(self, request, client_address)
+            finally:
+                self.slots.release()
+
+    host, port = listener.getsockname()[:2]
+    logging.getLogger('werkzeug').setLevel(logging.WARNING) # No access log
+    Server(host, port, beacon_wsgi, fd=listener.fileno()).serve_forever()
+
+
+class InvalidationBus(object):
+
+    def __init__(self, prefix=config.INVALIDATION_SOCKET, name=None):
+        """Bind this process's datagram socket, at prefix plus name, by default the pid. Every
+        process bound to the same prefix receives the customer invalidations the others publish."""
+        self.prefix   = prefix
+        self.path     = "%s.%s.sock" % (prefix, name or os.getpid())
+        self.sent     = 0
+        self.received = 0
+        if os.path.exists(self.path):
+            os.remove(self.path) # Left by a crashed process with this pid
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+
+    def peers(self):
+        """Return the socket paths of every other process on the bus"""
+        return [path for path in glob.glob("%s.*.sock" % self.prefix) if path != self.path]
+
+    def publish(self, id):
+        """Tell every other process to drop the customer with id, or every customer if id is None"""
+        message = '*' if id is None else str(id)
+        for path in self.peers():
+            try:
+                self.socket.sendto(message, path)
+                self.sent += 1
+            except socket.error:
+                pass # Exited, or has a full buffer and will reload at the cache TTL
+
+    def receive(self):
+        """Apply one invalidation from another process, returning its message"""
+        message = self.socket.recv(256)
+        self.received += 1
+        models.drop_customer(None if message == '*' else message)
+        return message
+
+    def start(self):
+        """Apply invalidations in a background thread, and publish this process's own"""
+        thread = threading.Thread(target=self._listen, name="invalidation")
+        thread.daemon = True
+        thread.start()
+        models.on_invalidate = self.publish
+        return self
+
+    def _listen(self):
+        while True:
+            try:
+                self.receive()
+            except socket.error:
+                return # Closed
+
+    def close(self):
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def process_memory(pid):
+    """Return the (RSS, PSS) of process pid in bytes, where PSS divides shared pages between
+    the processes sharing them. Either is None where /proc doesn't provide it."""
+    rss = pss = None
+    for path in ('/proc/%d/smaps_rollup' % pid, '/proc/%d/status' % pid):
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('Rss', 'VmRSS') and rss is None:
+                        rss = int(value.split()[0]) * 1024
+                    elif key == 'Pss' and pss is None:
+                        pss = int(value.split()[0]) * 1024
+        except (IOError, OSError):
+            continue
+        if rss is not None:
+            break
+    return rss, pss
+
+
+def megabytes(n):
+    return "%.1f MB" % (n / 1048576.0) if n is not None else "n/a"
+
+
+def run_worker(n, listener, ready, threaded, concurrency):
+    """Serve requests in a forked worker process numbered n, until SIGTERM"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The master stops workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # The log listener thread isn't forked with the process
+    if log_listener is not None:
+        log_listener.start()
+
+    # Pooled connections were opened by the master, and can't be shared across processes
+    if config.sql_engine.url.database not in (None, '', ':memory:'):
+        config.sql_engine.dispose()
+
+    # Forked workers would otherwise make the same visitor ids
+    models.visitor_ids.reseed()
+
+    # Appends to one log from several processes would interleave, so each worker has its own
+    name = "worker-%02d" % n
+    models.event_log = EventLog(os.path.join(config.EVENT_LOG_DIR, name),
+        segment_size=config.EVENT_LOG_SEGMENT_SIZE, fsync=config.EVENT_LOG_FSYNC)
+    models.visitor_events.spill = EventLog(os.path.join(config.INGEST_SPILL_DIR, name))
+
+    bus = InvalidationBus().start()
+    try:
+        os.write(ready, 'r')
+    except OSError:
+        pass # The master has stopped waiting
+    try:
+        if threaded:
+            serve_threaded(listener, concurrency)
+        else:
+            serve_cooperative(listener=listener, concurrency=concurrency)
+    finally:
+        models.visitor_events.stop()
+        models.visitor_store.close()
+        models.event_log.close()
+        bus.close()
+
+
+def serve_prefork(host='0.0.0.0', port=3000, workers=config.SERVER_WORKERS, threaded=False, concurrency=None):
+    """Warm the caches, then serve from workers forked to share them and one listening socket.
+    One worker per core if workers is 0. Each serves cooperatively, or with threads if threaded."""
+    if config.sql_engine.url.database in (None, '', ':memory:'):
+        raise SystemExit("Pre-fork serving needs a database the workers share, not one in memory per process: "
+            "set APE_DATABASE_URL, eg sqlite:///var/ape.db")
+    start = time.time()
+    workers = workers or os.sysconf('SC_NPROCESSORS_ONLN')
+    concurrency = concurrency or (config.SERVER_THREADS if threaded else 10000)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+
+    loaded = warm_caches()
+    warmed = time.time()
+    logger.info("Warmed %(customers)d customers, %(sites)d sites and %(components)d components" % loaded
+        + " in %.3fs, master RSS %s" % (warmed - start, megabytes(process_memory(os.getpid())[0])))
+
+    # Collect now, so workers don't each dirty shared pages collecting what the master left
+    gc.collect()
+
+    # Workers write a byte here once serving. Non-blocking, so nobody waits on a worker that died starting.
+    ready_out, ready_in = os.pipe()
+    for fd in (ready_out, ready_in):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    children = dict() # pid => worker number
+    state = dict(stopping=False, report=False)
+
+    def spawn(n):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(ready_out)
+                run_worker(n, listener, ready_in, threaded, concurrency)
+            except SystemExit as e:
+                code = e.code or 0
+            except BaseException:
+                logger.exception("Worker %d failed" % n)
+                code = 1
+            os._exit(code) # Never return into the master's code
+        children[pid] = n
+        return pid
+
+    def stop(signum, frame):
+        state['stopping'] = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def report(signum=None, frame=None):
+        state['report'] = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, report)
+
+    for n in range(workers):
+        spawn(n)
+    started = 0
+    while started < workers and time.time() - start < 60:
+        if select.select([ready_out], [], [], 1)[0]:
+            started += len(os.read(ready_out, workers))
+    logger.info("Serving on %s:%d from %d of %d %s workers, started in %.3fs" % (host, port, started, workers,
+        "threaded" if threaded else "cooperative", time.time() - start))
+    report()
+
+    while children:
+        if state['report']:
+            state['report'] = False
+            for pid, n in sorted(children.items(), key=lambda item: item[1]):
+                rss, pss = process_memory(pid)
+                logger.info("Worker %d pid %d: RSS %s, PSS %s" % (n, pid, megabytes(rss), megabytes(pss)))
+        try:
+            os.read(ready_out, 4096) # Discard restarted workers' ready bytes
+        except OSError:
+            pass
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        n = children.pop(pid, None)
+        stale = "%s.%d.sock" % (config.INVALIDATION_SOCKET, pid)
+        if os.path.exists(stale):
+            os.remove(stale) # Left by a worker that didn't exit cleanly
+        if n is not None and not state['stopping']:
+            logger.warning("Worker %d pid %d exited with status %d, restarting" % (n, pid, status))
+            spawn(n)
+    listener.close()
+    logger.info("Stopped")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve the APE beacon")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, help="Max requests in flight per process")
+    parser.add_argument('--workers', type=int, default=1, help="Pre-fork worker processes, 0 for one per core")
+    parser.add_argument('--threaded', action='store_true', help="Serve pre-fork workers with threads, not gevent")
+    parser.add_argument('--log-level', default='INFO', help="APE log level, eg DEBUG to log every response")
+    options = parser.parse_args()
+
+    logger.setLevel(options.log_level.upper())
+    if options.workers == 1 and not options.threaded:
+        serve_cooperative(options.host, options.port, options.concurrency or 10000)
+    else:
+        serve_prefork(options.host, options.port, options.workers, options.threaded, options.concurrency)
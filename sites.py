@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Site ownership matching
+#
+# SiteIndex : A compiled set of sites and their owners, matched by reversed hostname and path prefix
+#
+# A site is a hostname with an optional path, eg "foo.com" or "foo.com/blog".
+# A site owns its host and every subdomain of it, and every path at or below
+# its path. So "foo.com/blog" owns "http://www.foo.com/blog/post" but not
+# "http://foo.com/blogger" or "http://notfoo.com/blog".
+
+
+def parse_url(url):
+    """Return the (host, path) of a url, with or without a scheme. Host is lowercased and
+    stripped of credentials, port and trailing dot. Path excludes query and fragment."""
+    if url.startswith('//'):
+        url = url[2:]
+    else:
+        scheme, sep, rest = url.partition('://')
+        if sep and scheme.replace('+', '').replace('-', '').replace('.', '').isalnum():
+            url = rest
+
+    end = len(url)
+    for c in '/?#':
+        i = url.find(c)
+        if i != -1 and i < end:
+            end = i
+    host, rest = url[:end], url[end:]
+
+    host = host.rpartition('@')[2]
+    if host.startswith('['):
+        host = host[:host.find(']') + 1] # IPv6 literal
+    else:
+        host = host.partition(':')[0]
+    host = host.rstrip('.').lower()
+
+    for c in '?#':
+        rest = rest.partition(c)[0]
+    return host, rest or '/'
+
+
+def reverse_host(host):
+    """Return host with its labels reversed, eg "www.foo.com" => "com.foo.www", so a domain
+    and its subdomains share a prefix"""
+    return '.'.join(reversed(host.split('.')))
+
+
+def host_suffixes(host):
+    """Yield the reversed host and each of its parent domains reversed, from the longest"""
+    labels = host.split('.')
+    for i in range(len(labels)):
+        yield '.'.join(reversed(labels[i:]))
+
+
+def path_prefixes(path):
+    """Yield path and each of its ancestor paths, from the longest, ending with '/'"""
+    path = path.rstrip('/')
+    while path:
+        yield path
+        path = path[:path.rfind('/')]
+    yield '/'
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'paths')
+
+    def __init__(self):
+        self.children = dict() # Host label => _Node
+        self.paths    = None   # Owned path prefix => owner, if a site ends here
+
+
+class SiteIndex(object):
+
+    def __init__(self, sites=()):
+        """Compile a list of site strings into an index"""
+        self.root = _Node()
+        self.size = 0 # Sites added
+        for site in sites:
+            self.add(site)
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def owners(cls, pairs):
+        """Return an index of (site, owner) pairs"""
+        index = cls()
+        for site, owner in pairs:
+            index.add(site, owner)
+        return index
+
+    def add(self, site, owner=True):
+        """Add a site string to the index, owned by owner"""
+        host, path = parse_url(site)
+        if not host:
+            return
+        node = self.root
+        for label in reversed(host.split('.')):
+            node = node.children.setdefault(label, _Node())
+        if node.paths is None:
+            node.paths = dict()
+        node.paths[path.rstrip('/') or '/'] = owner
+        self.size += 1
+
+    def owns(self, url):
+        """Test if any site in the index owns this url"""
+        host, path = parse_url(url)
+        if not host:
+            return False
+        prefixes = None
+        node = self.root
+        for label in reversed(host.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                return False
+            if node.paths is not None:
+                if '/' in node.paths:
+                    return True
+                if prefixes is None:
+                    prefixes = list(path_prefixes(path))
+                for prefix in prefixes:
+                    if prefix in node.paths:
+                        return True
+        return False
+
+    def owner(self, url):
+        """Return the owner of the most specific site owning this url, or None"""
+        host, path = parse_url(url)
+        if not host:
+            return None
+        owner = prefixes = None
+        node = self.root
+        for label in reversed(host.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.paths is not None:
+                if prefixes is None:
+                    prefixes = list(path_prefixes(path))
+                for prefix in prefixes:
+                    if prefix in node.paths:
+                        owner = node.paths[prefix] # Deeper hosts are more specific
+                        break
+        return owner
@@ -18,7 +18,7 @@
             e = doc.getElementsByTagName("*"),
             i;
             for( i=0; i<e.length; i++ ){
-                if( r.test(e[i].className) ){ a[i] = e[i]; }
+                if( r.test(e[i].className) ){ a.push(e[i]); }
             }
             return a;
         };
@@ -32,6 +32,9 @@
 
     var
 
+    queue = [],   // Events waiting to be sent in a batch
+    timer = null, // Pending batch flush
+
     /*
      * Initialisation Function
      * @args: arguments object defined in page
@@ -39,34 +42,69 @@
     init = function(args){
     
         // Get configuration from args or default
-        conf.version      = version;
-        conf.customer_id  = args.customer_id;
-        conf.load         = args.load.getTime() || (new Date()).getTime();
-        conf.class_prefix = args.class_prefix || 'ape';
-        conf.debug        = args.debug    || false;
-        conf.cookie       = args.cookie   || '_ape';
-        conf.callback     = args.callback || '_ape.callback';
-        conf.endpoint     = args.endpoint || 'beacon.js';
+        conf.version        = version;
+        conf.customer_id    = args.customer_id;
+        conf.load           = args.load.getTime() || (new Date()).getTime();
+        conf.class_prefix   = args.class_prefix || 'ape';
+        conf.debug          = args.debug    || false;
+        conf.cookie         = args.cookie   || '_ape';
+        conf.callback       = args.callback || '_ape.callback';
+        conf.endpoint       = args.endpoint || 'beacon.js';
+        conf.batch_endpoint = args.batch_endpoint || 'batch.js';
+        conf.components_endpoint = args.components_endpoint || 'components.js';
+        conf.batch_size     = args.batch_size     || 20;   // Events queued before a flush
+        conf.batch_delay    = args.batch_delay    || 5000; // Max milliseconds an event waits to be flushed
 
         if( conf.debug ){
             win._ape.conf = conf;
         }
 
-        // Set callback handler in global scope
+        // Set callback and event tracking handlers in global scope
         win._ape.callback = callback;
+        win._ape.track    = track;
 
         // Build the request data payload
-        payload = {
+        payload = build_payload();
+        payload.ev = 'pageload';               // Page load event
+        payload.pc = get_placeholder_classes(); // The set of placeholder classes on this page
+
+        // Anonymous visitors all get the same components, so fetch them from a URL any cache can share
+        if( !payload.cc && payload.pc ){
+            get_components(payload.pc);
+            payload.pc = '';
+        }
+
+        // Send page load payload to beacon endpoint
+        send_beacon(payload);
+
+        // Queue clicks on placeholders, and flush anything queued as the page goes away
+        add_listener(doc, 'click', function(e){
+            for( var node = e.target || e.srcElement; node && node.className !== undefined; node = node.parentNode ){
+                if( (' ' + node.className + ' ').indexOf(' ' + conf.class_prefix + ' ') !== -1 ){
+                    track('click');
+                    return;
+                }
+            }
+        });
+        add_listener(win, 'pagehide', function(){ flush(true); });
+        add_listener(win, 'beforeunload', function(){ flush(true); });
+
+    },
+
+
+    /**
+     * Return the request data shared by every beacon from this page
+     */
+    build_payload = function(){
+        return {
             cc: get_cookie(conf.cookie),    // The APE cookie
             db: conf.debug,                 // Debug switch
             dl: win.location.href,          // Page URL
             dr: doc.referrer,               // Referrer URL if set
             dt: doc.title,                  // Page title
-            ev: 'pageload',                 // Page load event
             id: conf.customer_id,           // The customer account ID
             ld: conf.load,                  // Page load time
             lg: win.navigator.language,     // Browser language
-            pc: get_placeholder_classes(),  // The set of placeholder classes on this page
             px: conf.class_prefix,          // Placeholder class prefix
             sc: win.screen.colorDepth,      // Screen colour depth
             sh: win.screen.height,          // Screen height
@@ -75,10 +113,58 @@
             vr: conf.version,               // Version number of this script
             jsonp: conf.callback            // jsonp callback function
         };
+    },
+
+
+    /**
+     * Queue an event to send in the next batch
+     * @name: The event name, of letters, digits, '_' and '-'
+     */
+    track = function(name){
+        queue.push(name + '.' + Math.max(0, (new Date()).getTime() - conf.load));
+        if( queue.length >= conf.batch_size ){
+            flush(false);
+        } else if( !timer ){
+            timer = setTimeout(function(){ flush(false); }, conf.batch_delay);
+        }
+    },
+
+
+    /**
+     * Send every queued event in one batch request
+     * @unloading: true if the page is going away, so the response can't be handled
+     */
+    flush = function(unloading){
+        if( timer ){
+            clearTimeout(timer);
+            timer = null;
+        }
+        if( !queue.length ){
+            return;
+        }
+        var payload = build_payload();
+        payload.eb = queue.join(','); // Events as name.offset pairs, offset in ms after page load
+        queue = [];
+
+        // A script tag may never load during unload, so hand the batch to the browser if it can send it
+        if( unloading && win.navigator.sendBeacon ){
+            win.navigator.sendBeacon(conf.batch_endpoint, url_serialize(payload));
+        } else {
+            send_beacon(payload, conf.batch_endpoint);
+        }
+    },
 
-        // Send page load payload to beacon endpoint
-        send_beacon(payload);
 
+    /**
+     * Add an event listener
+     * For IE <9
+     */
+    add_listener = function(elem, type, listener){
+        if( elem.addEventListener ){
+            elem.addEventListener(type, listener, false);
+        } else if( elem.attachEvent ){
+            elem.attachEvent('on' + type, listener);
+        }
     },
 
 
@@ -159,11 +245,27 @@
 
     /*
      * Send a payload of data to the beacon end point
-     * @payload: object of key-value pair data to send
+     * @payload:  object of key-value pair data to send
+     * @endpoint: the end point to send to (optional, the single event beacon by default)
+     */
+    send_beacon = function(payload, endpoint){
+        payload.rd = Math.random(); // Beacons record events, so must reach the server even through caches ignoring no-store
+        add_script_tag((endpoint || conf.endpoint) + '?' + url_serialize(payload));
+    },
+
+
+    /*
+     * Request untargeted components from the cacheable components end point
+     * Nothing varies per request, so the URL is the same for every anonymous visitor to a page like this
+     * @placeholders: the placeholder classes on this page, in canonical order
      */
-    send_beacon = function(payload){
-        payload.rd = Math.random(); // To kick through agressive local caching
-        add_script_tag(conf.endpoint + '?' + url_serialize(payload));
+    get_components = function(placeholders){
+        add_script_tag(conf.components_endpoint + '?' + url_serialize({
+            id: conf.customer_id,
+            pc: placeholders,
+            px: conf.class_prefix,
+            jsonp: conf.callback
+        }));
     },
 
 
@@ -209,16 +311,24 @@
 
 
     /**
-     * Return a string of all classes assigned to placeholders on the page
+     * Return a string of all classes assigned to placeholders on the page, sorted and without repeats
      */
     get_placeholder_classes = function(){
         var
         elements = doc.getElementsByClassName(conf.class_prefix),
-        classes  = [];
-        for( var i in elements ){
-            classes.push(elements[i].className);
+        classes  = [],
+        seen     = {},
+        names, i, j;
+        for( i = 0; i < elements.length; i++ ){
+            names = elements[i].className.split(' ');
+            for( j = 0; j < names.length; j++ ){
+                if( names[j] && !seen.hasOwnProperty(names[j]) ){
+                    seen[names[j]] = true;
+                    classes.push(names[j]);
+                }
+            }
         }
-        return classes.join(' ');
+        return classes.sort().join(' ');
     };
 
 
@@ -5,11 +5,46 @@
 
 import os
 import json
+import time
+import atexit
+import shutil
+import tempfile
+from StringIO import StringIO
+import threading
 import logging
 import unittest
 import datetime as DT
+from multiprocessing.pool import ThreadPool
+
+# Events and visitor state written by tests go to a scratch directory, never var/, read by reports
+os.environ['APE_VAR_DIR'] = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, os.environ['APE_VAR_DIR'], True) # Last, after the app's own exit handlers
+
+import app as ape
 from app import app as beacon
-from models import Customer, Visitor, Component
+from server import beacon_wsgi, InvalidationBus, process_memory, warm_caches, offload_blocking, serve_prefork
+from werkzeug.test import Client, create_environ
+from werkzeug.wrappers import Response
+from cache import LRUCache
+from eventlog import EventLog, SegmentReader, encode, decode
+try:
+    import analytics
+    from numpy import dtype as np_dtype, array as np_array
+except ImportError: # Requires numpy
+    analytics = None
+from metrics import Counter, Histogram, Gauge, Registry, Sampler, StageTimer, NULL_TIMER
+from logs import QueueHandler, QueueListener, SamplingFilter
+from limits import RateLimiter, ConcurrencyLimit
+from useragents import UserAgents, UserAgent, parse as parse_user_agent, UNKNOWN
+from ingest import IngestPipeline, FileSpill, DROP, BLOCK, SPILL
+from params import Schema, Param, ParamError, INT, ID, BOOL, TIMESTAMP
+from sites import SiteIndex, parse_url, reverse_host
+from segments import SegmentEngine, Segment, Field, Count, LastSeen, VisitorState, DAY, build_segments
+from ids import VisitorIds, LENGTH
+from visitors import VisitorStore, MemoryBackend, DiskBackend, encode_state, decode_state, shard_of
+import models
+from models import Customer, Site, Visitor, Component, ComponentStore, customer_cache, visitor_events
+import config
 from config import sql_engine, SQL_Session, SQL_Base
 
 def unpack_jsonp(payload, callback="_ape.callback"):
@@ -32,6 +67,7 @@ class TestApp(unittest.TestCase):
         self.session.commit()
 
         self.beacon_url = "/beacon.js?id=%s&dl=http%%3A//foo.com" % self.customer.id
+        self.visitor_id = models.visitor_ids.new()
         
     def tearDown(self):
         self.session.close()
@@ -96,6 +132,81 @@ class TestApp(unittest.TestCase):
         data = unpack_jsonp(payload=rv.data, callback='foobar')
         self.assertIsInstance(data, dict)
 
+    def test_beacon_jsonp_invalid(self):
+        for callback in ('alert(1)//', 'a.b.', '1abc', 'x' * 65):
+            rv = self.beacon.get(self.beacon_url + '&jsonp=' + callback)
+            self.assertTrue(rv.data.startswith('_ape.callback('), callback)
+            self.assertEqual(unpack_jsonp(rv.data)['status_code'], 400)
+
+        rv = self.beacon.get(self.beacon_url + '&jsonp=jQuery_123.$cb')
+        self.assertTrue(rv.data.startswith('jQuery_123.$cb('))
+
+    def test_beacon_jsonp_concurrent(self):
+        # Each request gets its own callback, whatever else is in flight
+        wrong = []
+        def run(n):
+            client = Client(self.beacon.application, Response)
+            for i in range(20):
+                callback = "cb%d_%d" % (n, i)
+                rv = client.get(self.beacon_url + '&jsonp=' + callback + ('' if i % 2 else '&dl='))
+                if not rv.data.startswith(callback + '('):
+                    wrong.append(rv.data)
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(wrong, [])
+
+    def test_beacon_rate_limited(self):
+        limits = ape.customer_limits, ape.visitor_limits
+        ape.customer_limits, ape.visitor_limits = RateLimiter(1, 5), RateLimiter(1, 2)
+        try:
+            # A visitor over its rate is refused, with the callback it asked for
+            url = self.beacon_url + '&jsonp=foobar&cc=' + self.visitor_id
+            codes = [unpack_jsonp(self.beacon.get(url).data, 'foobar')['status_code'] for i in range(3)]
+            self.assertEqual(codes, [200, 200, 429])
+            data = unpack_jsonp(self.beacon.get(url).data, 'foobar')
+            self.assertEqual(data['name'], "Too Many Requests")
+            self.assertNotIn('visitor_id', data)
+
+            # Other visitors use their customer's tokens, until those run out too
+            codes = [unpack_jsonp(self.beacon.get(self.beacon_url).data)['status_code'] for i in range(4)]
+            self.assertEqual(codes, [200, 200, 200, 429])
+            self.assertEqual(ape.customer_limits.stats()['limited'], 1)
+            self.assertEqual(ape.visitor_limits.stats()['limited'], 2)
+        finally:
+            ape.customer_limits, ape.visitor_limits = limits
+
+    def test_beacon_customer_id_canonical(self):
+        # Spellings of one id share a rate limit bucket and a cache entry
+        limits = ape.customer_limits
+        ape.customer_limits = RateLimiter(1, 10)
+        try:
+            models.customer_cache.clear()
+            for id in ('%d', '0%d', '+%d', '%d+', '%%20%d'):
+                url = "/beacon.js?id=%s&dl=http%%3A//foo.com" % (id % self.customer.id)
+                self.assertEqual(unpack_jsonp(self.beacon.get(url).data)['status_code'], 200, id)
+            self.assertEqual(len(ape.customer_limits), 1)
+            self.assertEqual(models.customer_cache.stats()['size'], 1)
+            for id in ('abc', '-1', '1.0', '%d' % 2 ** 63):
+                rv = self.beacon.get("/beacon.js?id=%s&dl=http%%3A//foo.com" % id)
+                self.assertEqual(unpack_jsonp(rv.data)['status_code'], 400, id)
+        finally:
+            ape.customer_limits = limits
+
+    def test_beacon_shed(self):
+        limit = ape.concurrency
+        ape.concurrency = ConcurrencyLimit(1)
+        try:
+            ape.concurrency.acquire() # Another request in flight
+            self.assertEqual(unpack_jsonp(self.beacon.get(self.beacon_url).data)['status_code'], 429)
+            ape.concurrency.release()
+            self.assertEqual(unpack_jsonp(self.beacon.get(self.beacon_url).data)['status_code'], 200)
+            self.assertEqual(ape.concurrency.stats(), dict(active=0, peak=1, limit=1, shed=1))
+        finally:
+            ape.concurrency = limit
+
     def test_beacon_visitor_id(self):
         # visitor_id not provided
         rv = self.beacon.get(self.beacon_url + '&db=true')
@@ -103,9 +214,17 @@ class TestApp(unittest.TestCase):
         self.assertIn('visitor_id', data.keys()) # new visitor id returned
         
         # visitor_id provided (cc)
-        rv = self.beacon.get(self.beacon_url + '&db=true&cc=foobar')
+        rv = self.beacon.get(self.beacon_url + '&db=true&cc=' + self.visitor_id)
         data = unpack_jsonp(rv.data)
-        self.assertEqual(data['visitor_id'], 'foobar')
+        self.assertEqual(data['visitor_id'], self.visitor_id)
+
+        # Forged or malformed visitor_id replaced
+        tampered = self.visitor_id[:5] + ('A' if self.visitor_id[5] != 'A' else 'B') + self.visitor_id[6:]
+        for forged in ('foobar', tampered, 'x' * 64):
+            data = unpack_jsonp(self.beacon.get(self.beacon_url + '&cc=' + forged).data)
+            self.assertEqual(data['status_code'], 200)
+            self.assertNotEqual(data['visitor_id'], forged)
+            self.assertTrue(models.visitor_ids.valid(data['visitor_id']))
 
     def test_beacon_referrer_url(self):
         # referrer_url not provided
@@ -191,6 +310,170 @@ class TestApp(unittest.TestCase):
         self.assertEqual(data['args']['prefix'], "foo")
         self.assertEqual(data['args']['placeholder_ids'], ["baz"])
 
+        # ids starting with prefix characters are kept whole
+        rv = self.beacon.get(self.beacon_url + '&db=true&pc=ape-apple%20ape-eel%20ape-')
+        data = unpack_jsonp(rv.data)
+        self.assertEqual(data['args']['placeholder_ids'], ["apple", "eel"])
+
+    def test_beacon_invalid_values(self):
+        for query in ('&sw=wide', '&sh=-1', '&sc=999'):
+            rv = self.beacon.get(self.beacon_url + query)
+            data = unpack_jsonp(rv.data)
+            self.assertEqual(data['status_code'], 400, query)
+            self.assertIn('Invalid value', data['description'])
+
+        # An unreadable timestamp falls back to now
+        rv = self.beacon.get(self.beacon_url + '&ld=soon')
+        self.assertEqual(unpack_jsonp(rv.data)['status_code'], 200)
+
+    def test_beacon_components(self):
+        # no placeholders on the page
+        rv = self.beacon.get(self.beacon_url)
+        data = unpack_jsonp(rv.data)
+        self.assertNotIn('components', data)
+
+        # placeholders provided (pc)
+        rv = self.beacon.get(self.beacon_url + '&pc=ape-W3P0xOxK3rLV')
+        data = unpack_jsonp(rv.data)
+        self.assertEqual(data['status_code'], 200)
+        component = data['components']['ape-W3P0xOxK3rLV']
+        self.assertEqual(component['id'], 'W3P0xOxK3rLV')
+        self.assertEqual(component['styles'], '.ape-W3P0xOxK3rLV {color: red;}')
+        self.assertIn('Ad Number One', component['content'])
+        self.assertEqual(data['components'].keys(), ['ape-W3P0xOxK3rLV']) # Only those on the page
+
+        # unknown placeholders
+        rv = self.beacon.get(self.beacon_url + '&pc=ape-foo')
+        data = unpack_jsonp(rv.data)
+        self.assertEqual(data['components'], {})
+
+    def test_batch(self):
+        url = self.beacon_url.replace('/beacon.js', '/batch.js') + '&cc=%s&ld=1490916389000&db=true' % self.visitor_id
+        lookups = customer_cache.hits + customer_cache.misses
+        queued = visitor_events.stats()['enqueued']
+        rv = self.beacon.get(url + '&eb=click.100,scroll.2500,click.3000')
+        data = unpack_jsonp(rv.data)
+        self.assertEqual(data['status_code'], 200)
+        self.assertEqual(data['visitor_id'], self.visitor_id)
+        self.assertEqual(data['events'], 3)
+        self.assertEqual(customer_cache.hits + customer_cache.misses, lookups + 1) # Once per batch
+        self.assertEqual(visitor_events.stats()['enqueued'], queued + 3)
+
+        # Batches flushed on unload are POSTed
+        rv = self.beacon.post('/batch.js', data=url.partition('?')[2] + '&eb=click.100')
+        self.assertEqual(unpack_jsonp(rv.data)['events'], 1)
+
+    def test_batch_bad_request(self):
+        url = self.beacon_url.replace('/beacon.js', '/batch.js')
+        too_many = ",".join(["click.%d" % i for i in range(config.BATCH_MAX_EVENTS + 1)])
+        for query in ('', '&eb=', '&eb=click', '&eb=click.1,', '&eb=cl%20ick.1', '&eb=' + too_many,
+                      '&ld=253402300799000&eb=click.9999999999'):
+            rv = self.beacon.get(url + query)
+            self.assertEqual(unpack_jsonp(rv.data)['status_code'], 400, query)
+
+        # A POSTed batch whose length isn't a number of bytes
+        body = url.partition('?')[2] + '&ld=1490916389000&eb=click.1'
+        self.assertEqual(unpack_jsonp(self.beacon.post('/batch.js', data=body).data)['status_code'], 200)
+        for length in ('foo', '-1'):
+            environ = create_environ('/batch.js', method='POST', data=body)
+            environ['CONTENT_LENGTH'] = length
+            rv = Client(self.beacon.application, Response).open(environ)
+            self.assertEqual(rv.status_code, 200, length)
+            self.assertEqual(unpack_jsonp(rv.data)['status_code'], 400, length)
+
+    def test_beacon_not_cached(self):
+        rv = self.beacon.get(self.beacon_url)
+        self.assertEqual(rv.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', rv.headers)
+
+    def test_components_cacheable(self):
+        url = "/components.js?id=%s&pc=ape%%20ape-W3P0xOxK3rLV%%20ape-A9GDeXaib6kZ" % self.customer.id
+        rv = self.beacon.get(url)
+        data = unpack_jsonp(rv.data)
+        self.assertEqual(data['status_code'], 200)
+        self.assertEqual(sorted(data['components']), ['ape-A9GDeXaib6kZ', 'ape-W3P0xOxK3rLV'])
+        self.assertNotIn('visitor_id', data)
+        self.assertEqual(rv.headers['Cache-Control'], 'public, max-age=%d' % config.COMPONENTS_MAX_AGE)
+        etag = rv.headers['ETag']
+
+        # Placeholder order doesn't change the body
+        rv = self.beacon.get(url.replace('W3P0xOxK3rLV', 'tmp').replace('A9GDeXaib6kZ', 'W3P0xOxK3rLV').replace('tmp', 'A9GDeXaib6kZ'))
+        self.assertEqual(rv.headers['ETag'], etag)
+
+        # Revalidated without a body
+        rv = self.beacon.get(url, headers=[('If-None-Match', etag)])
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, '')
+
+        # Errors are never cached
+        rv = self.beacon.get("/components.js?pc=ape-W3P0xOxK3rLV")
+        self.assertEqual(unpack_jsonp(rv.data)['status_code'], 400)
+        self.assertEqual(rv.headers['Cache-Control'], 'no-store')
+
+    def test_components_segments(self):
+        models.component_store.add(Component('returnOnly01', 'Welcome back'), segments=['returning'])
+        try:
+            url = "/components.js?id=%s&pc=ape-W3P0xOxK3rLV%%20ape-returnOnly01" % self.customer.id
+            data = unpack_jsonp(self.beacon.get(url).data)
+            self.assertEqual(data['components'].keys(), ['ape-W3P0xOxK3rLV']) # Anonymous
+            data = unpack_jsonp(self.beacon.get(url + '&sg=returning').data)
+            self.assertEqual(sorted(data['components']), ['ape-W3P0xOxK3rLV', 'ape-returnOnly01'])
+            data = unpack_jsonp(self.beacon.get(url + '&sg=%3Cb%3E').data)
+            self.assertEqual(data['status_code'], 400)
+        finally:
+            models.component_store.remove('returnOnly01')
+
+    def test_script(self):
+        rv = self.beacon.get('/ape.js')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/javascript')
+        self.assertEqual(rv.headers['Cache-Control'], 'public, max-age=%d' % config.ASSET_LATEST_AGE)
+        self.assertEqual(rv.headers['ETag'], '"%s"' % ape.ape_js.etag)
+        self.assertEqual(self.beacon.get('/ape.js', headers=[('If-None-Match', rv.headers['ETag'])]).status_code, 304)
+
+        # Versioned URL, cached forever
+        self.assertEqual(ape.ape_js.url, '/ape.%s.js' % ape.ape_js.etag[:12])
+        versioned = self.beacon.get(ape.ape_js.url)
+        self.assertEqual(versioned.data, rv.data)
+        self.assertEqual(versioned.headers['Cache-Control'], 'public, max-age=%d, immutable' % config.ASSET_MAX_AGE)
+
+        # Superseded versions redirect to the current one
+        rv = self.beacon.get('/ape.000000000000.js')
+        self.assertEqual(rv.status_code, 302)
+        self.assertTrue(rv.headers['Location'].endswith(ape.ape_js.url))
+
+    def test_metrics(self):
+        ape.sampler.rate = 1
+        try:
+            self.beacon.get(self.beacon_url + '&pc=ape-W3P0xOxK3rLV')
+            self.beacon.get('/beacon.js')
+        finally:
+            ape.sampler.rate = config.METRICS_SAMPLE_RATE
+        rv = self.beacon.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, "text/plain")
+        self.assertIn('# TYPE ape_beacon_requests_total counter', rv.data)
+        self.assertIn('ape_errors_total{code="400"}', rv.data)
+        for stage in ('parse', 'user_agent', 'dnt', 'customer', 'ownership', 'visitor', 'update', 'components', 'render'):
+            self.assertIn('ape_beacon_stage_seconds_count{stage="%s"}' % stage, rv.data)
+        self.assertIn('ape_customer_cache{counter="hits"}', rv.data)
+        self.assertIn('ape_user_agents{counter="hit_rate"}', rv.data)
+
+    def test_beacon_user_agent_classified(self):
+        iphone = "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.0 Mobile/14E304 Safari/602.1"
+        rv = self.beacon.get(self.beacon_url + '&db=true&ua=' + iphone.replace(' ', '%20'))
+        data = unpack_jsonp(rv.data)
+        self.assertEqual((data['args']['device'], data['args']['browser'], data['args']['os']), ('mobile', 'safari', 'ios'))
+        self.assertIn('visitor_id', data)
+
+        # Known crawlers get no visitor and no components
+        googlebot = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+        rv = self.beacon.get(self.beacon_url + '&pc=ape-W3P0xOxK3rLV&ua=' + googlebot.replace(' ', '%20'))
+        data = unpack_jsonp(rv.data)
+        self.assertEqual(data['status_code'], 200)
+        self.assertNotIn('visitor_id', data)
+        self.assertNotIn('components', data)
+
     def test_beacon_screen_colour(self):
         # screen_colour not provided
         rv = self.beacon.get(self.beacon_url + '&db=true')
@@ -247,6 +530,141 @@ class TestApp(unittest.TestCase):
         self.assertEqual(data['args']['script_version'], "1.0")
 
 
+class TestBeaconWSGI(TestApp):
+    """Runs every TestApp test against the lean WSGI app used by the cooperative server"""
+
+    def setUp(self):
+        TestApp.setUp(self)
+        self.beacon = Client(beacon_wsgi, Response)
+
+    def test_same_as_flask(self):
+        url = self.beacon_url + '&pc=ape-W3P0xOxK3rLV&cc=%s&ld=1490916389000&db=true' % self.visitor_id
+        a = unpack_jsonp(self.beacon.get(url).data)
+        b = unpack_jsonp(beacon.test_client().get(url).data)
+        self.assertEqual(a, b)
+
+    def test_offload_blocking(self):
+        # A returning visitor's state is read from disk on the threadpool, not the serving thread
+        hooks = models.run_blocking, models.customer_cache.event, models.visitor_store
+        models.visitor_store = VisitorStore(DiskBackend(tempfile.mkdtemp(), 4), shards=4)
+        pool = ThreadPool(1)
+        readers = []
+        load = models.visitor_store.backend.load
+        def recording_load(shard, key):
+            readers.append(threading.current_thread())
+            return load(shard, key)
+        models.visitor_store.backend.load = recording_load
+        try:
+            offload_blocking(lambda func, *args: pool.apply(func, args), threading.Event)
+            data = unpack_jsonp(self.beacon.get(self.beacon_url + '&cc=' + self.visitor_id).data)
+            self.assertEqual(data['status_code'], 200)
+            self.assertEqual(len(readers), 1)
+            self.assertIsNot(readers[0], threading.current_thread())
+        finally:
+            models.visitor_store.close()
+            models.run_blocking, models.customer_cache.event, models.visitor_store = hooks
+            pool.close()
+
+
+class TestPrefork(unittest.TestCase):
+
+    def setUp(self):
+        SQL_Base.metadata.create_all(sql_engine)
+        prefix = os.path.join(tempfile.mkdtemp(), 'invalidate')
+        self.a = InvalidationBus(prefix, 'a')
+        self.b = InvalidationBus(prefix, 'b')
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        models.on_invalidate = lambda id: None
+
+    def test_warm_caches(self):
+        session = SQL_Session()
+        session.add(Customer(name='foobar', sites=["warm.com"]))
+        session.commit()
+        session.close()
+
+        Customer.invalidate()
+        loaded = warm_caches()
+        self.assertGreater(loaded['customers'], 0)
+        self.assertEqual(loaded['components'], len(models.component_store))
+        misses = customer_cache.misses
+        self.assertTrue(Customer.get(1)._site_index)
+        self.assertEqual(customer_cache.misses, misses)
+        self.assertGreater(loaded['sites'], 0)
+
+        # Warmed customers are shared by workers for as long as they're valid, not just until a ttl
+        key = str(Customer.get(1).id)
+        self.assertIsNone(customer_cache._entries[key][0])
+
+    def test_warm_caches_no_schema(self):
+        engine = models.sql_engine
+        models.sql_engine = config.make_engine('sqlite://')
+        try:
+            self.assertEqual(warm_caches(), dict(customers=0, sites=0, components=len(models.component_store)))
+        finally:
+            models.sql_engine = engine
+
+    def test_prefork_in_memory(self):
+        # Each worker would have its own empty database
+        self.assertEqual(config.sql_engine.url.database, ':memory:')
+        with self.assertRaises(SystemExit) as e:
+            serve_prefork(port=0)
+        self.assertIn("APE_DATABASE_URL", str(e.exception))
+
+    def test_site_owners(self):
+        session = SQL_Session()
+        customer = Customer(name='owners', sites=["owned.com"])
+        session.add(customer)
+        session.commit()
+        warm_caches()
+        self.assertTrue(Site.unowned("http://foreign.com/", customer.id))
+        self.assertFalse(Site.unowned("http://owned.com/page", customer.id))
+
+        # A foreign page is answered without looking the customer up
+        lookups = customer_cache.hits + customer_cache.misses
+        rv = Client(beacon_wsgi, Response).get('/beacon.js?id=%d&dl=http%%3A//foreign.com/' % customer.id)
+        data = unpack_jsonp(rv.data)
+        self.assertEqual(data['status_code'], 200)
+        self.assertNotIn('visitor_id', data)
+        self.assertEqual(customer_cache.hits + customer_cache.misses, lookups)
+
+        # Sites added since loading aren't in the map, so their customer is checked as before
+        customer.sites.append("added.com")
+        session.commit()
+        self.assertFalse(Site.unowned("http://added.com/", customer.id))
+        self.assertTrue(Site.unowned("http://added.com/", customer.id + 1))
+        rv = Client(beacon_wsgi, Response).get('/beacon.js?id=%d&dl=http%%3A//added.com/' % customer.id)
+        self.assertIn('visitor_id', unpack_jsonp(rv.data))
+        session.close()
+
+        Customer.invalidate()
+        self.assertIsNone(models.site_owners)
+        self.assertFalse(Site.unowned("http://foreign.com/", customer.id))
+
+    def test_invalidation_bus(self):
+        self.assertEqual(self.a.peers(), [self.b.path])
+        customer_cache.set('1', 'customer')
+        customer_cache.set('2', 'customer')
+
+        self.a.publish(1)
+        self.assertEqual(self.b.receive(), '1')
+        self.assertNotIn('1', customer_cache)
+        self.assertIn('2', customer_cache)
+
+        # Local invalidations are published once the bus is started
+        self.b.start()
+        Customer.invalidate()
+        self.assertEqual(self.a.receive(), '*')
+        self.assertEqual(self.b.sent, 1)
+
+    def test_process_memory(self):
+        rss, pss = process_memory(os.getpid())
+        if rss is not None:
+            self.assertGreater(rss, 0)
+
+
 class TestComponentModel(unittest.TestCase):
 
     def test_constructor(self):
@@ -255,6 +673,75 @@ class TestComponentModel(unittest.TestCase):
         self.assertEqual(a.content, "Demo Content")
         self.assertEqual(a.styles,  "xxx")
 
+    def test_compact(self):
+        a = Component(id=''.join(['demo', '-id']), content='Demo Content')
+        b = Component(id=''.join(['demo-', 'id']), content='Demo Content')
+        self.assertIs(a.id, b.id) # Equal ids are interned
+        self.assertFalse(hasattr(a, '__dict__'))
+
+    def test_fragment(self):
+        a = Component(id='demo-id', content='Demo "Content"', styles="xxx")
+        fragment = a.fragment('ape')
+        self.assertIs(a.fragment('ape'), fragment) # Rendered once
+        self.assertEqual(json.loads("{%s}" % fragment),
+            {'ape-demo-id': {'id': 'demo-id', 'content': 'Demo "Content"', 'styles': 'xxx'}})
+        self.assertIn('"foo-demo-id"', a.fragment('foo'))
+
+        # Other prefixes come from requests, so aren't kept
+        for i in range(100):
+            a.fragment('foo%d' % i)
+        self.assertIs(a.fragment('ape'), fragment)
+        self.assertIsNot(a.fragment('foo'), a.fragment('foo'))
+
+        # Changing the component re-renders it
+        a.content = 'New Content'
+        self.assertIn('New Content', a.fragment('ape'))
+
+    def test_render(self):
+        a = Component(id='a', content='A')
+        b = Component(id='b', content='B')
+        data = json.loads(Component.render([a, b], 'ape'))
+        self.assertEqual(sorted(data.keys()), ['ape-a', 'ape-b'])
+        self.assertEqual(Component.render([], 'ape'), '{}')
+
+
+class TestComponentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.a = Component(id='a', content='A')
+        self.b = Component(id='b', content='B')
+        self.c = Component(id='c', content='C')
+        self.store = ComponentStore([self.a])
+        self.store.add(self.b, segments=['new'])
+        self.store.add(self.c, segments=['new', 'returning'])
+
+    def test_get(self):
+        self.assertIs(self.store.get('a'), self.a)
+        self.assertIsNone(self.store.get('foo'))
+        self.assertEqual(len(self.store), 3)
+
+    def test_get_many(self):
+        self.assertEqual(self.store.get_many(['c', 'foo', 'a', 'c']), [self.c, self.a])
+        self.assertEqual(self.store.get_many(['a', 'b', 'c'], segments=['returning']), [self.a, self.c])
+        self.assertEqual(self.store.get_many(['a', 'b', 'c'], segments=[]), [self.a])
+
+    def test_for_segment(self):
+        self.assertEqual(self.store.for_segment('new'), [self.b, self.c])
+        self.assertEqual(self.store.for_segment('foo'), [])
+
+    def test_replace(self):
+        b = Component(id='b', content='New B')
+        self.store.add(b, segments=['returning'])
+        self.assertIs(self.store.get('b'), b)
+        self.assertEqual(self.store.for_segment('new'), [self.c])
+        self.assertEqual(self.store.for_segment('returning'), [b, self.c])
+
+    def test_remove(self):
+        self.store.remove('c')
+        self.assertIsNone(self.store.get('c'))
+        self.assertEqual(self.store.for_segment('returning'), [])
+        self.assertNotIn('returning', self.store.by_segment)
+
 
 class TestVisitorModel(unittest.TestCase):
 
@@ -264,29 +751,295 @@ class TestVisitorModel(unittest.TestCase):
     def test_constructor(self):
         v = Visitor(self.customer, 'demo-id')
         self.assertEqual(v.id, "demo-id")
+        self.assertEqual(v.data_id, "demo-id-demo-id")
+        self.assertFalse(hasattr(v, '__dict__'))
         
     def test_get(self):
-        v = Visitor.get(self.customer, "demo-id")
-        self.assertEqual(v.id, "demo-id")
+        id = models.visitor_ids.new()
+        v = Visitor.get(self.customer, id)
+        self.assertEqual(v.id, id)
         self.assertEqual(v.customer, self.customer)
 
+        # New visitors get a new id
+        self.assertEqual(len(Visitor.get(self.customer, None).id), LENGTH)
+        self.assertNotEqual(Visitor.get(self.customer, "demo-id").id, "demo-id")
+
     def test_update_with_data(self):
         v1 = Visitor(self.customer, 'demo-id')
         v2 = v1.update_with_data(dict())
         self.assertIsInstance(v2, Visitor)
         self.assertEqual(v1.id, v2.id)
+        self.assertGreater(visitor_events.stats()['enqueued'], 0)
 
     def test_data(self):
         v = Visitor(self.customer, 'demo-id')
         self.assertIsInstance(v.data(), dict)
+        v.update_with_data(dict(event='pageload', screen_width=640))
+        self.assertEqual(v.data()['screen_width'], 640)
 
     def test_segments(self):
         v = Visitor(self.customer, 'demo-id')
         self.assertIsInstance(v.segments(), list)
+        v.update_with_data(dict(event='pageload', page_url='http://foo.com/', screen_width=640))
+        self.assertEqual(v.segments(), ['mobile'])
+
+        # State follows the visitor between requests
+        id = models.visitor_ids.new()
+        v = Visitor.get(self.customer, id)
+        v.update_with_data(dict(event='pageload', page_url='http://foo.com/'))
+        v = Visitor.get(self.customer, id)
+        v.update_with_data(dict(event='pageload', page_url='http://foo.com/'))
+        self.assertEqual(v.segments(), ['returning'])
 
     def test_components(self):
         v = Visitor(self.customer, 'demo-id')
         self.assertIsInstance(v.components(), list)
+        self.assertEqual(len(v.components()), 4)
+
+        # Filtered by ad_ids
+        components = v.components(ad_ids=['nNQQOYbFBbPI', 'foo', 'W3P0xOxK3rLV'])
+        self.assertEqual([c.id for c in components], ['nNQQOYbFBbPI', 'W3P0xOxK3rLV'])
+
+    def test_components_targeted(self):
+        # Components targeted at other segments are left out, whether or not ad_ids are given
+        store = models.component_store
+        models.component_store = ComponentStore([Component(id='a', content='A')])
+        models.component_store.add(Component(id='b', content='B'), segments=['returning'])
+        try:
+            v = Visitor(self.customer, 'demo-id')
+            self.assertEqual([c.id for c in v.components()], ['a'])
+            self.assertEqual([c.id for c in v.components(ad_ids=['a', 'b'])], ['a'])
+            v.update_with_data(dict(event='pageload'))
+            v.update_with_data(dict(event='pageload'))
+            self.assertEqual(sorted(c.id for c in v.components()), ['a', 'b'])
+        finally:
+            models.component_store = store
+
+
+class TestVisitorIds(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = VisitorIds('secret')
+
+    def test_new(self):
+        id = self.ids.new()
+        self.assertEqual(len(id), LENGTH)
+        self.assertRegexpMatches(id, r'^[-\w]+$')
+        self.assertNotEqual(self.ids.new(), id)
+        self.assertAlmostEqual(self.ids.timestamp(id), time.time(), delta=1)
+
+    def test_time_ordered(self):
+        ids = [self.ids.new(now=1490916389 + i * 0.001) for i in range(0, 100000, 997)]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(self.ids.timestamp(ids[1]), 1490916389.997)
+
+    def test_valid(self):
+        id = self.ids.new()
+        self.assertTrue(self.ids.valid(id))
+        self.assertTrue(self.ids.valid(unicode(id)))
+        self.assertFalse(VisitorIds('other').valid(id)) # Signed with another key
+        tampered = id[:10] + ('A' if id[10] != 'A' else 'B') + id[11:]
+        other_last = id[:-1] + ('-' if id[-1] != '-' else 'F') # Same bytes if the padding bits are ignored
+        for forged in ('', 'foobar', tampered, id[:-1], id + 'a', id[:-1] + '=', id[:-1] + 'G', other_last,
+                       u'\xe9' * LENGTH, 'x' * 1000):
+            self.assertFalse(self.ids.valid(forged), forged)
+        self.assertEqual(self.ids.stats()['rejected'], 10)
+
+    def test_legacy(self):
+        legacy = '0b8a6fd1-3a1c-4c8e-9f4e-0123456789ab'
+        self.assertFalse(self.ids.valid(legacy))
+        ids = VisitorIds('secret', legacy=True)
+        self.assertTrue(ids.valid(legacy))
+        self.assertFalse(ids.valid(legacy.upper()))
+        self.assertEqual(ids.stats()['legacy'], 1)
+
+    def test_reseed(self):
+        a, b = VisitorIds('secret', seed=1), VisitorIds('secret', seed=1)
+        self.assertEqual(a.new(now=1), b.new(now=1)) # As forked workers would
+        b.reseed()
+        self.assertNotEqual(a.new(now=1), b.new(now=1))
+
+
+class TestVisitorStore(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = SegmentEngine([
+            Segment('returning', Count(event='pageload', at_least=2)),
+            Segment('recent', Count(event='pageload', at_least=2, within=DAY)),
+            Segment('mobile', Field('screen_width', '<', 800)),
+        ])
+        self.backend = MemoryBackend(4)
+        self.store = VisitorStore(self.backend, shards=4, cache_size=8, batch_size=3, flush_interval=60)
+
+    def tearDown(self):
+        self.store.close()
+
+    def visit(self, data_id, **data):
+        state = self.store.get(data_id)
+        self.engine.update(state, dict(dict(event='pageload', screen_width=640), **data))
+        self.store.save(data_id, state)
+        return state
+
+    def test_encode_state(self):
+        state = VisitorState()
+        self.engine.update(state, dict(event='pageload', screen_width=640))
+        self.engine.update(state, dict(event='pageload', screen_width=640))
+        decoded = decode_state(encode_state(state))
+        self.assertEqual(decoded.fields, state.fields)
+        self.assertEqual(decoded.aggregates, state.aggregates)
+        self.assertEqual(decoded.segments, frozenset(['returning', 'recent', 'mobile']))
+        self.assertEqual(decoded.expires, state.expires)
+        window = decoded.aggregates[('count', 'pageload', None, 2, DAY)]
+        self.assertEqual(window.maxlen, 2)
+        self.assertEqual(decode_state(encode_state(VisitorState())).fields, {})
+
+    def test_get(self):
+        state = self.store.get('1-a')
+        self.assertIsInstance(state, VisitorState)
+        self.assertIs(self.store.get('1-a'), state) # Cached
+        self.assertIs(self.store.get(u'1-a'), state)
+        self.assertIsNot(self.store.get('1-a', new=True), state)
+        self.assertEqual(self.store.stats()['created'], 2)
+
+    def test_write_back(self):
+        self.visit('1-a')
+        self.assertEqual(self.store.stats()['dirty'], 1)
+        self.assertEqual(self.backend.count(), 0)
+        self.assertEqual(self.store.flush(), 1)
+        self.assertEqual(self.backend.count(), 1)
+        self.assertEqual(self.store.stats()['dirty'], 0)
+
+    def test_lazy_load(self):
+        self.visit('1-a')
+        self.store.flush()
+        store = VisitorStore(self.backend, shards=4)
+        state = store.get('1-a')
+        self.assertEqual(store.stats()['loads'], 1)
+        self.engine.update(state, dict(event='pageload'))
+        self.assertEqual(self.engine.segments(state), ['mobile', 'recent', 'returning'])
+
+    def test_eviction(self):
+        # Evicted states are reloaded, whether or not they have been written yet
+        for i in range(50):
+            self.visit('1-%d' % i)
+        self.assertGreater(self.store.stats()['evictions'], 0)
+        self.assertLessEqual(self.store.stats()['size'], 8)
+        for i in range(50):
+            self.assertEqual(self.visit('1-%d' % i).segments, frozenset(['returning', 'recent', 'mobile']))
+        self.store.flush()
+        self.assertEqual(self.backend.count(), 50)
+
+    def test_batches(self):
+        self.store.start()
+        for i in range(40):
+            self.visit('1-%d' % i)
+        self.store.close()
+        self.assertEqual(self.backend.count(), 40)
+        self.assertGreaterEqual(self.store.stats()['batches'], 40 // 3)
+
+    def test_shards(self):
+        counts = [0] * 4
+        for i in range(1000):
+            counts[shard_of(u'1-%d' % i, 4)] += 1
+        self.assertTrue(all(150 < count < 350 for count in counts), counts)
+        self.assertEqual(shard_of(u'1-caf\xe9', 4), shard_of(u'1-caf\xe9', 4))
+
+    def test_disk(self):
+        directory = tempfile.mkdtemp()
+        store = VisitorStore(DiskBackend(directory, 4), shards=4)
+        state = store.get(u'1-caf\xe9')
+        self.engine.update(state, dict(event='pageload', screen_width=640))
+        store.save(u'1-caf\xe9', state)
+        store.close()
+        self.assertTrue(os.listdir(directory))
+
+        # Kept across restarts
+        store = VisitorStore(DiskBackend(directory, 4), shards=4)
+        self.assertEqual(store.get(u'1-caf\xe9').fields, dict(screen_width=640))
+        self.assertEqual(store.backend.count(), 1)
+        store.close()
+
+    def test_disk_workers(self):
+        # Each worker caches its own copy, revalidated against the version stored by the other
+        directory = tempfile.mkdtemp()
+        now = [0.0]
+        one = VisitorStore(DiskBackend(directory, 4), shards=4, clock=lambda: now[0])
+        two = VisitorStore(DiskBackend(directory, 4), shards=4, clock=lambda: now[0])
+        self.engine.update(one.get('1-a'), dict(event='pageload'))
+        one.save('1-a', one.get('1-a'))
+        one.flush()
+        cached = two.get('1-a')
+        self.assertIs(two.get('1-a'), cached)
+
+        state = one.get('1-a')
+        self.engine.update(state, dict(event='pageload'))
+        one.save('1-a', state)
+        one.flush()
+        self.assertIs(two.get('1-a'), cached) # Not yet revalidated
+        now[0] += 1
+        reloaded = two.get('1-a')
+        self.assertIsNot(reloaded, cached)
+        self.assertEqual(reloaded.segments, frozenset(['returning', 'recent']))
+        self.assertEqual(two.stats()['stale'], 1)
+        self.assertEqual(two.stats()['conflicts'], 0)
+
+        # Updates pending in both at once: the later write wins, and is counted
+        for store in (one, two):
+            state = store.get('1-a')
+            state.fields = dict(store=id(store))
+            store.save('1-a', state)
+        one.flush()
+        two.flush()
+        self.assertEqual(two.stats()['conflicts'], 1)
+        now[0] += 1
+        self.assertEqual(one.get('1-a').fields, dict(store=id(two)))
+        self.assertEqual(one.stats()['stale'], 1)
+        one.close()
+        two.close()
+
+    def test_revalidate_after(self):
+        # A hot visitor is checked against the disk once per interval, not on every hit
+        now = [0.0]
+        store = VisitorStore(DiskBackend(tempfile.mkdtemp(), 4), shards=4, revalidate_after=1.0,
+                             clock=lambda: now[0])
+        checks = []
+        version = store.backend.version
+        store.backend.version = lambda shard, key: checks.append(key) or version(shard, key)
+        state = store.get('1-a')
+        for i in range(100):
+            self.assertIs(store.get('1-a'), state)
+        self.assertEqual(checks, [])
+        now[0] += 1
+        for i in range(100):
+            self.assertIs(store.get('1-a'), state)
+        self.assertEqual(checks, ['1-a'])
+        self.assertEqual(store.stats()['stale'], 0)
+        store.close()
+
+    def test_memory_bounded(self):
+        backend = MemoryBackend(2, max_states=4)
+        store = VisitorStore(backend, shards=2, cache_size=2, batch_size=1)
+        for i in range(20):
+            store.save(u'1-%d' % i, store.get(u'1-%d' % i))
+        store.flush()
+        self.assertEqual(sum(len(table) for table in backend.tables), 4)
+        self.assertEqual(backend.evictions, 16)
+
+        # The least recently used are forgotten first
+        older, newer = backend.tables[0].keys()
+        backend.load(0, older)
+        backend.save_many(0, [(u'1-x', b'', None, 1)])
+        self.assertEqual(list(backend.tables[0].keys()), [older, u'1-x'])
+
+    def test_memory_versions(self):
+        self.visit('1-a')
+        self.store.flush()
+        version = self.store.get('1-a').version
+        self.assertEqual(self.backend.version(shard_of(u'1-a', 4), u'1-a'), version)
+        self.visit('1-a')
+        self.store.flush()
+        self.assertNotEqual(self.store.get('1-a').version, version)
+        self.assertEqual(self.store.stats()['conflicts'], 0)
 
 
 class TestCustomerModel(unittest.TestCase):
@@ -313,6 +1066,93 @@ class TestCustomerModel(unittest.TestCase):
         self.assertEqual(c.name,  b.name)
         self.assertEqual(c.sites, b.sites)
 
+    def test_get_cached(self):
+        c = Customer(name='foobar', sites=["foo.com"])
+        self.session.add(c)
+        self.session.commit()
+
+        # Second lookup is served from the cache, with either id type
+        Customer.invalidate()
+        a = Customer.get(c.id)
+        b = Customer.get(str(c.id))
+        self.assertIs(a, b)
+        self.assertEqual(customer_cache.hits, 1)
+        self.assertEqual(customer_cache.misses, 1)
+
+        # Writes invalidate the cached record
+        c.name = 'bazqux'
+        self.session.commit()
+        self.assertEqual(Customer.get(c.id).name, 'bazqux')
+
+    def test_get_unknown_cached(self):
+        Customer.invalidate()
+        self.assertIsNone(Customer.get(-1))
+        self.assertIsNone(Customer.get(-1))
+        self.assertEqual(customer_cache.hits, 1)
+
+        # Inserting the customer clears the negative entry
+        self.assertIsNone(Customer.get(100001))
+        self.session.add(Customer(id=100001, name='foobar', sites=["foo.com"]))
+        self.session.commit()
+        self.assertEqual(Customer.get(100001).name, 'foobar')
+
+    def test_load_from_other_thread(self):
+        c = Customer(name='foobar', sites=["foo.com"])
+        self.session.add(c)
+        self.session.commit()
+
+        # The in-memory database is shared by every thread
+        loaded = []
+        worker = threading.Thread(target=lambda: loaded.append(Customer.load(c.id)))
+        worker.start()
+        worker.join()
+        self.assertEqual(loaded[0].name, 'foobar')
+
+    def test_sqlite_file_engine(self):
+        directory = tempfile.mkdtemp()
+        engine = config.make_engine('sqlite:///' + os.path.join(directory, 'ape.db'))
+        SQL_Base.metadata.create_all(engine)
+        self.assertEqual(engine.execute("PRAGMA journal_mode").scalar(), 'wal')
+
+        session = config.SQL_Session(bind=engine)
+        session.add(Customer(id=7, name='foobar', sites=["foo.com"]))
+        session.commit()
+        session.close()
+        session = config.SQL_Session(bind=engine)
+        self.assertEqual(session.query(Customer).get(7).sites, ["foo.com"])
+        session.close()
+        engine.dispose()
+
+    def test_sites_table(self):
+        c = Customer(name='foobar', sites=["routing.com", "routing.org/blog"])
+        self.session.add(c)
+        self.session.commit()
+
+        hosts = self.session.query(Site.host).filter(Site.customer_id == c.id).order_by(Site.id).all()
+        self.assertEqual([h for h, in hosts], ["com.routing", "org.routing"])
+        self.assertEqual(Site.owner_of("http://www.routing.com/"), c.id)
+        self.assertEqual(Site.owner_of("http://routing.org/blog/post"), c.id)
+        self.assertIsNone(Site.owner_of("http://routing.org/"))
+        self.assertEqual(Site.load_owners().owner("http://routing.org/blog"), c.id)
+
+        # Removing a site updates the table and the cached customer
+        Customer.get(c.id)
+        c.sites.remove("routing.org/blog")
+        self.session.commit()
+        self.assertIsNone(Site.owner_of("http://routing.org/blog/post"))
+        self.assertEqual(Customer.get(c.id).sites, ["routing.com"])
+
+    def test_migrate_pickled_sites(self):
+        c = Customer(name='foobar', legacy_sites=["pickled.com", "pickled.org"])
+        self.session.add(c)
+        self.session.commit()
+
+        Customer.migrate_pickled_sites(self.session)
+        self.assertEqual(Customer.migrate_pickled_sites(self.session), 0)
+        self.assertEqual(Customer.get(c.id).sites, ["pickled.com", "pickled.org"])
+        self.assertIsNone(c.legacy_sites)
+        self.assertEqual(Site.owner_of("http://pickled.org/"), c.id)
+
     def test_get_visitor(self):
         # TODO test_get_visitor
         pass
@@ -321,6 +1161,847 @@ class TestCustomerModel(unittest.TestCase):
         c = Customer(name='foobar', sites=["foo.com", "bar.co.uk"])
         self.assertTrue(c.is_site_owner("http://foo.com/path"))
         self.assertFalse(c.is_site_owner("http://bar.com/path"))
+        self.assertTrue(c.is_site_owner("https://foo.com/path"))
+        self.assertTrue(c.is_site_owner("//bar.co.uk"))
+        self.assertFalse(c.is_site_owner("http://foo.community.com"))
+        self.assertFalse(c.is_site_owner("http://ttp.foo.org")) # lstrip would have eaten the 'h'
+
+        # Index follows reassigned sites
+        c.sites = ["bar.com"]
+        self.assertTrue(c.is_site_owner("http://bar.com/path"))
+        self.assertFalse(c.is_site_owner("http://foo.com/path"))
+
+    def test_is_site_owner_loaded(self):
+        c = Customer(name='foobar', sites=["foo.com"])
+        self.session.add(c)
+        self.session.commit()
+
+        Customer.invalidate()
+        b = Customer.get(c.id)
+        self.assertIsNotNone(b._site_index) # Compiled on load
+        self.assertTrue(b.is_site_owner("http://foo.com/path"))
+
+
+class TestParams(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = Schema(
+            Param('id', 'customer_id', required=True),
+            Param('dt', 'page_title', max_length=5),
+            Param('sw', 'screen_width', type=INT, default=0, min=0, max=100),
+            Param('db', 'debug', type=BOOL, default=False),
+            Param('ci', 'canonical_id', type=ID, min=0),
+            Param('ld', 'timestamp', type=TIMESTAMP),
+        )
+
+    def test_parse(self):
+        args = self.schema.parse('id=1&dt=Hello+W%C3%B6rld&sw=50&db=true&ld=1490916389000&zz=ignored&sw=99')
+        self.assertEqual(args['customer_id'], u"1")
+        self.assertEqual(args['page_title'], u"Hello") # Truncated
+        self.assertEqual(args['screen_width'], 50) # First value wins
+        self.assertTrue(args['debug'])
+        self.assertEqual(args['timestamp'], DT.datetime(2017, 3, 30, 23, 26, 29))
+        self.assertNotIn('zz', args)
+        self.assertEqual(self.schema.parse('id=1&ci=+007')['canonical_id'], u"7")
+
+    def test_defaults(self):
+        args = self.schema.parse('id=1')
+        self.assertEqual(args['page_title'], "")
+        self.assertEqual(args['screen_width'], 0)
+        self.assertFalse(args['debug'])
+        self.assertIsInstance(args['timestamp'], DT.datetime)
+        self.assertEqual(sorted(self.schema.echo(args)), sorted(['customer_id', 'page_title', 'screen_width', 'debug', 'canonical_id',
+            'timestamp']))
+
+    def test_default_timestamp_utc(self):
+        # Event times are UTC whatever the host's time zone
+        zone = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            for query in ('id=1', 'id=1&ld=foo'):
+                timestamp = self.schema.parse(query)['timestamp']
+                self.assertLess(abs((timestamp - DT.datetime.utcnow()).total_seconds()), 5)
+        finally:
+            if zone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = zone
+            time.tzset()
+
+    def test_errors(self):
+        with self.assertRaises(ParamError) as e:
+            self.schema.parse('dt=foo')
+        self.assertEqual(str(e.exception), "Value required for customer id (id)")
+        self.assertEqual(e.exception.values['page_title'], "foo")
+        with self.assertRaises(ParamError) as e:
+            Schema(Param('id', 'customer_id', type=ID, required=True)).parse('id=abc')
+        self.assertEqual(str(e.exception), "Invalid value for customer id (id)")
+        for query in ('id=1&sw=abc', 'id=1&sw=101', 'id=1&sw=-1', 'id=1&ci=x1', 'id=1&ci=-1'):
+            self.assertRaises(ParamError, self.schema.parse, query)
+
+
+class TestSiteIndex(unittest.TestCase):
+
+    def test_parse_url(self):
+        self.assertEqual(parse_url("http://foo.com"), ("foo.com", "/"))
+        self.assertEqual(parse_url("//foo.com/bar"), ("foo.com", "/bar"))
+        self.assertEqual(parse_url("foo.com/bar?x=1#y"), ("foo.com", "/bar"))
+        self.assertEqual(parse_url("https://user@WWW.Foo.com:8080/a/b"), ("www.foo.com", "/a/b"))
+        self.assertEqual(parse_url("http://foo.com?next=http://bar.com/"), ("foo.com", "/"))
+
+    def test_hosts(self):
+        index = SiteIndex(["foo.com", "bar.co.uk"])
+        self.assertTrue(index.owns("http://foo.com/"))
+        self.assertTrue(index.owns("http://www.foo.com/path"))
+        self.assertTrue(index.owns("https://bar.co.uk"))
+        self.assertFalse(index.owns("http://notfoo.com/"))
+        self.assertFalse(index.owns("http://foo.com.evil.org/"))
+        self.assertFalse(index.owns("http://co.uk/"))
+        self.assertFalse(index.owns(""))
+
+    def test_paths(self):
+        index = SiteIndex(["foo.com/blog", "foo.com/shop/"])
+        self.assertTrue(index.owns("http://foo.com/blog"))
+        self.assertTrue(index.owns("http://foo.com/blog/post?id=1"))
+        self.assertTrue(index.owns("http://foo.com/shop"))
+        self.assertFalse(index.owns("http://foo.com/"))
+        self.assertFalse(index.owns("http://foo.com/blogger"))
+
+    def test_owner(self):
+        self.assertEqual(reverse_host("www.foo.co.uk"), "uk.co.foo.www")
+        index = SiteIndex.owners([("foo.com", 1), ("blog.foo.com", 2), ("foo.com/shop", 3)])
+        self.assertEqual(index.owner("http://www.foo.com/"), 1)
+        self.assertEqual(index.owner("http://foo.com/shop/cart"), 3)
+        self.assertEqual(index.owner("http://blog.foo.com/shop"), 2) # Deepest host wins
+        self.assertIsNone(index.owner("http://bar.com/"))
+
+
+class TestSegmentEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = SegmentEngine([
+            Segment('french-mobile', Field('language', '==', 'fr'), Field('screen_width', '<', 800)),
+            Segment('pricing', Count(event='pageload', path='/pricing', at_least=3, within=7 * DAY)),
+            Segment('returning', Count(event='pageload', at_least=2)),
+            Segment('recent-click', LastSeen(event='click', within=60)),
+        ])
+        self.state = VisitorState()
+        self.start = DT.datetime(2017, 3, 31)
+
+    def event(self, seconds=0, **data):
+        data.setdefault('event', 'pageload')
+        data['timestamp'] = self.start + DT.timedelta(seconds=seconds)
+        return data
+
+    def test_field(self):
+        self.assertEqual(self.engine.update(self.state, self.event(event='scroll', language='fr')), set())
+        self.assertEqual(self.engine.update(self.state, self.event(event='scroll', screen_width=640)), set(['french-mobile']))
+        self.assertEqual(self.engine.update(self.state, self.event(event='scroll', screen_width=1024)), set(['french-mobile']))
+        self.assertNotIn('french-mobile', self.state.segments)
+
+    def test_count(self):
+        self.engine.update(self.state, self.event())
+        self.assertNotIn('returning', self.state.segments)
+        self.engine.update(self.state, self.event())
+        self.assertIn('returning', self.state.segments)
+
+    def test_window(self):
+        url = 'http://foo.com/pricing/plans'
+        for day in (0, 1, 5):
+            self.engine.update(self.state, self.event(day * DAY, page_url=url))
+        self.engine.update(self.state, self.event(6 * DAY, page_url='http://foo.com/pricingx'))
+        start = (self.start - DT.datetime(1970, 1, 1)).total_seconds()
+        self.assertIn('pricing', self.engine.segments(self.state, now=start + 6 * DAY))
+
+        # Lapses without any further event once the first visit leaves the window
+        self.assertNotIn('pricing', self.engine.segments(self.state, now=start + 7 * DAY + 1))
+
+        # A fourth visit inside the window of the last three rejoins
+        self.engine.update(self.state, self.event(7 * DAY + 2, page_url=url))
+        self.assertIn('pricing', self.engine.segments(self.state, now=start + 7 * DAY + 2))
+
+    def test_build_segments(self):
+        segments = build_segments([
+            ('pricing', [('count', dict(event='pageload', path='/pricing', at_least=3, within=7 * DAY))]),
+            ('french-mobile', [('field', dict(name='language', op='==', value='fr')),
+                               ('field', dict(name='screen_width', op='<', value=800))]),
+            ('recent-click', [('last_seen', dict(event='click', within=60))]),
+        ])
+        self.assertEqual([segment.name for segment in segments], ['pricing', 'french-mobile', 'recent-click'])
+        self.assertEqual([type(c) for c in segments[1].conditions], [Field, Field])
+        self.assertEqual(segments[0].conditions[0].key, Count(event='pageload', path='/pricing', at_least=3, within=7 * DAY).key)
+        self.assertIsInstance(segments[2].conditions[0], LastSeen)
+        self.assertRaises(ValueError, build_segments, [('foo', [('bar', dict())])])
+
+    def test_last_seen(self):
+        start = (self.start - DT.datetime(1970, 1, 1)).total_seconds()
+        self.engine.update(self.state, self.event(event='click'))
+        self.assertIn('recent-click', self.engine.segments(self.state, now=start + 30))
+        self.assertNotIn('recent-click', self.engine.segments(self.state, now=start + 61))
+
+    def test_untouched(self):
+        # Events only re-evaluate the segments reading what they changed
+        evaluated = []
+        for compiled in self.engine.compiled:
+            compiled.predicates.insert(0, lambda state, now, name=compiled.name: evaluated.append(name) or True)
+        self.engine.update(self.state, self.event(event='click'))
+        self.assertEqual(evaluated, ['recent-click'])
+
+    def test_bad_operator(self):
+        self.assertRaises(ValueError, Field, 'language', '~', 'fr')
+
+
+class TestIngestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.spill_path = os.path.join(tempfile.mkdtemp(), 'spill')
+
+    def sink(self, batch):
+        self.gate.wait()
+        self.batches.append(batch)
+
+    def test_batch_size(self):
+        pipeline = IngestPipeline(self.sink, batch_size=2, flush_interval=60)
+        for i in range(5):
+            self.assertTrue(pipeline.put(i))
+        pipeline.stop()
+        self.assertEqual(self.batches, [[0, 1], [2, 3], [4]])
+        self.assertEqual(pipeline.stats()['flushed'], 5)
+        self.assertEqual(pipeline.stats()['batches'], 3)
+
+    def test_flush_interval(self):
+        pipeline = IngestPipeline(self.sink, batch_size=100, flush_interval=0.01)
+        pipeline.put(1)
+        for i in range(100):
+            if self.batches: break
+            time.sleep(0.01)
+        self.assertEqual(self.batches, [[1]])
+        pipeline.stop()
+
+    def test_drop(self):
+        self.gate.clear() # Stall the sink so the queue fills
+        pipeline = IngestPipeline(self.sink, maxsize=1, batch_size=1, policy=DROP)
+        results = [pipeline.put(i) for i in range(10)]
+        self.assertFalse(all(results))
+        self.assertGreater(pipeline.stats()['dropped'], 0)
+        self.gate.set()
+        pipeline.stop()
+
+    def test_block(self):
+        self.gate.clear()
+        pipeline = IngestPipeline(self.sink, maxsize=1, batch_size=1, policy=BLOCK, block_timeout=0.01)
+        results = [pipeline.put(i) for i in range(10)]
+        self.assertFalse(all(results)) # Blocking put timed out
+        self.gate.set()
+        pipeline.stop()
+
+    def test_spill(self):
+        self.gate.clear()
+        pipeline = IngestPipeline(self.sink, maxsize=1, batch_size=1, policy=SPILL, spill=FileSpill(self.spill_path))
+        self.assertTrue(all(pipeline.put(i) for i in range(10)))
+        spilled = pipeline.stats()['spilled']
+        self.assertGreater(spilled, 0)
+        self.gate.set()
+
+        # Workers replay the spill by themselves once the queue has drained
+        for i in range(200):
+            if pipeline.stats()['replayed'] == spilled: break
+            time.sleep(0.01)
+        pipeline.stop()
+        self.assertEqual(pipeline.stats()['replayed'], spilled)
+        self.assertEqual(sorted(sum(self.batches, [])), range(10)) # Nothing lost
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_spill_replayed_on_start(self):
+        # Events spilled before a restart are stored when the next pipeline starts
+        spill = FileSpill(self.spill_path)
+        for i in range(3):
+            spill.append(i)
+        pipeline = IngestPipeline(self.sink, batch_size=2, flush_interval=60, policy=SPILL, spill=spill)
+        pipeline.put(3)
+        pipeline.stop()
+        self.assertEqual(sum(self.batches, []), [0, 1, 2, 3])
+        self.assertEqual(pipeline.stats()['replayed'], 3)
+
+    def test_spill_workers(self):
+        # Workers replay one at a time, so they don't take each other's files
+        spill = EventLog(os.path.dirname(self.spill_path))
+        events = [("1-v%d" % i, dict(customer_id=u"1", event=u"pageload")) for i in range(200)]
+        for event in events:
+            spill.append(event)
+        pipeline = IngestPipeline(self.sink, batch_size=7, flush_interval=0.001, workers=4, policy=SPILL, spill=spill)
+        pipeline.start()
+        for i in range(200):
+            if pipeline.stats()['replayed'] == 200: break
+            time.sleep(0.01)
+        pipeline.stop()
+        self.assertEqual(sorted(data_id for data_id, data in sum(self.batches, [])), sorted(e[0] for e in events))
+        self.assertEqual(pipeline.stats()['errors'], 0)
+        self.assertEqual(os.listdir(os.path.dirname(self.spill_path)), [])
+
+    def test_spill_sink_fails(self):
+        # A file is kept until the sink has taken all of it, and resumed where the sink stopped
+        spill = FileSpill(self.spill_path)
+        for i in range(5):
+            spill.append(i)
+        failures = [False, True] # The second batch fails
+        def sink(batch):
+            if failures and failures.pop(0):
+                raise IOError("Storage is down")
+            self.batches.append(batch)
+        pipeline = IngestPipeline(sink, batch_size=2, policy=SPILL, spill=spill)
+        self.assertEqual(pipeline.replay_spill(), 2)
+        self.assertEqual(len(os.listdir(os.path.dirname(self.spill_path))), 1)
+        self.assertEqual(pipeline.replay_spill(), 3)
+        self.assertEqual(sum(self.batches, []), range(5))
+        self.assertEqual(os.listdir(os.path.dirname(self.spill_path)), [])
+
+    def test_spill_unreadable(self):
+        # An unreadable file is set aside, and the workers carry on
+        directory = os.path.dirname(self.spill_path)
+        with open(os.path.join(directory, "%020d.log" % 0), 'wb') as f:
+            f.write('garbage' * 10)
+        spill = EventLog(directory)
+        pipeline = IngestPipeline(self.sink, batch_size=1, flush_interval=0.001, policy=SPILL, spill=spill)
+        self.assertEqual(pipeline.replay_spill(), 0)
+        self.assertEqual(pipeline.stats()['errors'], 1)
+        self.assertEqual([name for name in os.listdir(directory) if name.endswith('.bad')], os.listdir(directory))
+        pipeline.put(("1-v1", dict(customer_id=u"1")))
+        pipeline.stop()
+        self.assertEqual(len(self.batches), 1)
+
+    def test_spill_orphaned(self):
+        # Files claimed by a process that exited before replaying them are replayed
+        spill = FileSpill(self.spill_path)
+        spill.append(1)
+        child = os.fork()
+        if not child:
+            spill.claim()
+            os._exit(0)
+        os.waitpid(child, 0)
+        pipeline = IngestPipeline(self.sink, policy=SPILL, spill=spill)
+        self.assertEqual(pipeline.replay_spill(), 1)
+        self.assertEqual(self.batches, [[1]])
+        self.assertEqual(os.listdir(os.path.dirname(self.spill_path)), [])
+
+    def test_sink_errors(self):
+        pipeline = IngestPipeline(lambda batch: 1 / 0, batch_size=1)
+        pipeline.put(1)
+        pipeline.stop()
+        self.assertEqual(pipeline.stats()['errors'], 1)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, IngestPipeline, self.sink, policy='foo')
+        self.assertRaises(ValueError, IngestPipeline, self.sink, policy=SPILL)
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = EventLog(self.directory, segment_size=512)
+
+    def tearDown(self):
+        self.log.close()
+
+    def event(self, n):
+        return ("1-visitor-%d" % n, dict(customer_id=u"1", visitor_id=u"visitor-%d" % n,
+            page_url=u"http://foo.com/%d" % n, page_title=u"Caf\xe9", event=u"pageload",
+            timestamp=DT.datetime(2017, 3, 31, 0, 6, 29, 123000), screen_width=1280,
+            screen_height=800, screen_colour=24, placeholder_ids=[u"foo", u"bar"]))
+
+    def test_encode(self):
+        data_id, data = decode(encode(self.event(1)))
+        self.assertEqual(data_id, "1-visitor-1")
+        self.assertEqual(data['page_title'], u"Caf\xe9")
+        self.assertEqual(data['timestamp'], DT.datetime(2017, 3, 31, 0, 6, 29, 123000))
+        self.assertEqual(data['screen_width'], 1280)
+        self.assertEqual(data['placeholder_ids'], [u"foo", u"bar"])
+        self.assertEqual(data['referrer_url'], u"") # Missing fields default
+
+    def test_replay(self):
+        self.assertEqual(self.log.append(self.event(0)), 0)
+        self.assertEqual(self.log.extend([self.event(n) for n in range(1, 10)]), 1)
+        events = list(self.log.replay())
+        self.assertEqual([seq for seq, event in events], range(10))
+        self.assertEqual(events[3][1][0], "1-visitor-3")
+        self.assertEqual([seq for seq, event in self.log.replay(start=7)], [7, 8, 9])
+
+    def test_rotation(self):
+        self.log.extend([self.event(n) for n in range(10)])
+        segments = self.log.segments()
+        self.assertGreater(len(segments), 1)
+        self.assertTrue(all(os.path.getsize(path) <= 512 for path in segments))
+
+    def test_reopen(self):
+        self.log.extend([self.event(n) for n in range(10)])
+        self.log.close()
+
+        # Simulate a crash mid-write with a torn record at the tail
+        with open(self.log.segments()[-1], 'ab') as f:
+            f.write('\x40\x00\x00\x00garbage')
+
+        log = EventLog(self.directory, segment_size=512)
+        self.assertEqual(log.append(self.event(10)), 10)
+        self.assertEqual([seq for seq, event in log.replay()], range(11))
+        log.close()
+
+    def test_claim(self):
+        self.log.extend([self.event(n) for n in range(10)])
+        claimed = self.log.claim()
+        self.assertEqual(self.log.segments(), [])
+        self.assertEqual(self.log.append(self.event(0)), 0) # Starts a fresh log
+        self.assertEqual(sum(len(list(self.log.read(path))) for path in claimed), 10)
+
+        # Kept until removed, and claimed again, after the fresh log
+        self.assertEqual(self.log.claim()[:len(claimed)], claimed)
+        for path in self.log.claim():
+            self.log.remove(path)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+@unittest.skipIf(analytics is None, "numpy is not installed")
+class TestAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        log = EventLog(self.directory, segment_size=1024)
+        start = DT.datetime(2017, 3, 31, 0, 0)
+        events = []
+        for i in range(60):
+            events.append(("1-v%d" % (i % 7), dict(customer_id=u"1", event=u"pageload",
+                page_url=u"http://foo.com/%s" % ('pricing' if i % 3 == 0 else u'caf\xe9'),
+                referrer_url=[u"", u"https://www.google.com/", u"https://t.co/abc"][i % 3 if i % 2 else 0],
+                language=u"en-GB" if i % 4 else u"fr", screen_width=[375, 1280, 1920][i % 3],
+                timestamp=start + DT.timedelta(minutes=i * 2))))
+            events.append(("1-v%d" % (i % 7), dict(customer_id=u"1", event=u"click", page_url=u"http://foo.com/",
+                timestamp=start)))
+        events.append(("2-v1", dict(customer_id=u"2", event=u"pageload", page_url=u"http://bar.com/",
+            screen_width=0, timestamp=start)))
+        log.extend(events)
+        log.close()
+        self.paths = analytics.segment_paths([self.directory])
+
+    def test_load(self):
+        batch, dictionaries = analytics.load(self.paths)
+        self.assertGreater(len(self.paths), 1)
+        self.assertEqual(len(batch), 121)
+        self.assertEqual(batch['timestamp'].dtype, np_dtype('int64'))
+        self.assertEqual(batch['page_url'].dtype, np_dtype('int32'))
+        self.assertEqual(dictionaries['customer_id'].decode(batch['customer_id'][-1]), u"2")
+        self.assertEqual(len(dictionaries['event']), 3) # "", pageload and click
+        self.assertEqual(batch['timestamp'][1], 1490918400000)
+
+    def test_report(self):
+        report = analytics.analyse(self.paths, bucket=3600)
+        self.assertEqual(report.events, 121)
+        self.assertEqual(report.customers(), [u"1", u"2"])
+        data = report.for_customer(u"1")
+        self.assertEqual(data['page_views'], 60)
+        self.assertEqual(data['urls'], [(u"http://foo.com/caf\xe9", 40), (u"http://foo.com/pricing", 20)])
+        self.assertEqual(data['screen_widths'], [('<480', 20), ('1280-1439', 20), ('1920-2559', 20)])
+        self.assertEqual(data['languages'], [(u"en-GB", 0.75), (u"fr", 0.25)])
+        self.assertEqual(data['direct'], 40)
+        self.assertEqual(data['referrers'], [(u"https://www.google.com/", 10), (u"https://t.co/abc", 10)])
+        self.assertEqual(data['timeline'], [(1490918400, 30), (1490922000, 30)])
+        self.assertEqual(report.for_customer(u"2")['screen_widths'], [('unknown', 1)])
+        self.assertIsNone(report.for_customer(u"3"))
+
+    def test_chunked(self):
+        whole = analytics.analyse(self.paths)
+        for chunk_size in (1, 7, 50):
+            report = analytics.analyse(self.paths, chunk_size=chunk_size)
+            for id in (u"1", u"2"):
+                self.assertEqual(report.for_customer(id), whole.for_customer(id), chunk_size)
+
+    def test_top(self):
+        data = analytics.analyse(self.paths, top=1).for_customer(u"1")
+        self.assertEqual(data['referrers'], [(u"https://www.google.com/", 10)])
+
+    def test_group_counts(self):
+        # Values outside 32 bits are kept apart from the customer code
+        counts = analytics.GroupCounts()
+        counts.add(np_array([1, 1, 2]), np_array([-1, 2 ** 32 + 5, 0]))
+        counts.add(np_array([2, 1]), np_array([-1, -1]))
+        values, totals = counts.for_customer(1)
+        self.assertEqual(values.tolist(), [-1, 2 ** 32 + 5])
+        self.assertEqual(totals.tolist(), [2, 1])
+        values, totals = counts.for_customer(2)
+        self.assertEqual(values.tolist(), [-1, 0])
+        self.assertEqual(counts.customers().tolist(), [1, 2])
+
+        # Too far apart to offset within int64
+        counts.add(np_array([2, 1, 2]), np_array([2 ** 62, -2 ** 62, 0]))
+        values, totals = counts.for_customer(1)
+        self.assertEqual(values.tolist(), [-2 ** 62, -1, 2 ** 32 + 5])
+        values, totals = counts.for_customer(2)
+        self.assertEqual(values.tolist(), [-1, 0, 2 ** 62])
+        self.assertEqual(totals.tolist(), [1, 2, 1])
+
+    def test_timeline_range(self):
+        # Buckets before 1970 and above 2 ** 32, and timestamps no date can have
+        directory = tempfile.mkdtemp()
+        log = EventLog(directory)
+        log.extend([("3-v1", dict(customer_id=u"3", event=u"pageload", timestamp=timestamp)) for timestamp in
+            (DT.datetime(1969, 12, 31, 23, 59, 59), DT.datetime(2200, 1, 1), -2 ** 62, 2 ** 62)])
+        log.close()
+        report = analytics.analyse(analytics.segment_paths([directory]), bucket=1)
+        data = report.for_customer(u"3")
+        self.assertEqual(data['page_views'], 4)
+        self.assertEqual(data['timeline'], [(-1, 1), (7258118400, 1)])
+        self.assertEqual(report.undated, 2)
+
+
+class TestBench(unittest.TestCase):
+
+    def test_percentile(self):
+        import bench
+        ordered = range(1, 101)
+        self.assertEqual(bench.percentile(ordered, 50), 51)
+        self.assertEqual(bench.percentile(ordered, 99), 100)
+        self.assertIsNone(bench.percentile([], 50))
+
+    def test_wsgi_beacon_mix(self):
+        import bench
+        logging.disable(logging.CRITICAL)
+        query_strings = bench.beacon_query_strings(200)
+        self.assertEqual(query_strings, bench.beacon_query_strings(200)) # Reproducible
+        for query_string in query_strings[:50]:
+            rv = beacon.test_client().get('/beacon.js?' + query_string)
+            self.assertIn(unpack_jsonp(rv.data)['status_code'], (200, 400))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        c = Counter('foo_total', "Foos", label='code')
+        c.inc(200)
+        c.inc(200)
+        c.inc(404, n=3)
+        self.assertEqual(c.render(), "\n".join([
+            '# HELP foo_total Foos', '# TYPE foo_total counter',
+            'foo_total{code="200"} 2', 'foo_total{code="404"} 3']))
+
+    def test_histogram(self):
+        h = Histogram('foo_seconds', "Foo time", buckets=(0.1, 1.0))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+        self.assertEqual(h.count(), 3)
+        self.assertEqual(h.render().split("\n")[2:], [
+            'foo_seconds_bucket{le="0.1"} 1', 'foo_seconds_bucket{le="1.0"} 2',
+            'foo_seconds_bucket{le="+Inf"} 3', 'foo_seconds_sum 5.55', 'foo_seconds_count 3'])
+
+    def test_gauge(self):
+        registry = Registry()
+        registry.add(Gauge('foo', "Foo", lambda: 7))
+        registry.add(Gauge('bar', "Bar", lambda: dict(a=1, b='x"y'), label='name'))
+        text = registry.render()
+        self.assertIn('\nfoo 7\n', text)
+        self.assertIn('bar{name="a"} 1', text)
+        self.assertTrue(text.endswith("\n"))
+
+    def test_sampler(self):
+        h = Histogram('stage_seconds', "Stages", label='stage')
+        total = Histogram('total_seconds', "Total")
+        self.assertIs(Sampler(0).timer(h, total), NULL_TIMER)
+        timer = Sampler(1).timer(h, total)
+        self.assertIsInstance(timer, StageTimer)
+        timer.mark('a')
+        timer.mark('b')
+        timer.done()
+        self.assertEqual(h.count('a'), 1)
+        self.assertEqual(h.count('b'), 1)
+        self.assertEqual(total.count(), 1)
+
+
+class TestLogs(unittest.TestCase):
+
+    class Formatted(object):
+        """A log argument counting how often it is formatted"""
+        def __init__(self):
+            self.count = 0
+        def __str__(self):
+            self.count += 1
+            return "formatted"
+
+    def setUp(self):
+        self.disabled = logging.root.manager.disable
+        logging.disable(logging.NOTSET)
+        self.logger = logging.getLogger('APE.test-logs')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.queue_handler = QueueHandler(maxsize=3)
+        self.logger.addHandler(self.queue_handler)
+        self.stream = StringIO()
+        self.listener = QueueListener(self.queue_handler, logging.StreamHandler(self.stream))
+
+    def tearDown(self):
+        self.listener.stop()
+        self.logger.removeHandler(self.queue_handler)
+        logging.disable(self.disabled)
+
+    def test_queued(self):
+        arg = self.Formatted()
+        self.logger.info("Hello %s", arg)
+        self.assertEqual(arg.count, 0) # Formatted by the listener, not the caller
+        self.assertEqual(self.queue_handler.stats()['queued'], 1)
+        self.listener.start()
+        self.listener.stop()
+        self.assertEqual(self.stream.getvalue(), "Hello formatted\n")
+        self.assertEqual(arg.count, 1)
+
+    def test_dropped(self):
+        for i in range(5):
+            self.logger.info("Record %d", i)
+        self.assertEqual(self.queue_handler.stats(), dict(queued=3, maxsize=3, dropped=2))
+        self.listener.start()
+        self.listener.stop()
+        self.assertEqual(self.stream.getvalue().splitlines(), ["Record 0", "Record 1", "Record 2"])
+
+    def test_exception(self):
+        self.listener.start()
+        try:
+            raise ValueError("Boom")
+        except ValueError:
+            self.logger.exception("Failed")
+        self.listener.stop()
+        self.assertIn("ValueError: Boom", self.stream.getvalue())
+
+    def test_sampling(self):
+        sampling = SamplingFilter({'DEBUG': 0, logging.INFO: 0.5})
+        self.queue_handler.addFilter(sampling)
+        self.assertFalse(sampling.sampled(logging.DEBUG))
+        self.assertTrue(sampling.sampled(logging.ERROR))
+        self.assertTrue(300 < len([i for i in range(1000) if sampling.sampled(logging.INFO)]) < 700)
+        self.logger.debug("Dropped")
+        self.logger.debug("Kept", extra=dict(sampled=True)) # Sampled before logging
+        self.logger.error("Kept")
+        self.listener.start()
+        self.listener.stop()
+        self.assertEqual(self.stream.getvalue().splitlines(), ["Kept", "Kept"])
+
+
+class TestLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.limiter = RateLimiter(rate=2, burst=3, max_keys=4, clock=lambda: self.now)
+
+    def test_burst_and_rate(self):
+        self.assertEqual([self.limiter.allow('a') for i in range(4)], [True, True, True, False])
+        self.assertTrue(self.limiter.allow('b')) # Keys have their own buckets
+        self.now += 0.5 # One token back
+        self.assertEqual([self.limiter.allow('a') for i in range(2)], [True, False])
+        self.now += 10 # Full again, but no more than burst
+        self.assertEqual([self.limiter.allow('a') for i in range(4)], [True, True, True, False])
+        self.assertEqual(self.limiter.stats(), dict(keys=2, admitted=8, limited=3, evicted=0))
+
+    def test_idle_eviction(self):
+        self.limiter.allow('a')
+        self.limiter.allow('b')
+        self.now += 1.6 # A new window
+        self.limiter.allow('a')
+        self.now += 1.6 # Another, so b is unused for a whole window
+        self.limiter.allow('c')
+        self.assertEqual(len(self.limiter), 2)
+        self.assertEqual(self.limiter.stats()['evicted'], 1)
+
+        # Eviction never forgets an empty bucket, however many windows pass
+        for i in range(4):
+            self.limiter.allow('d')
+        for i in range(10):
+            self.now += 0.4
+            self.assertFalse(self.limiter.allow('d'))
+            self.now += 0.1
+            self.assertTrue(self.limiter.allow('d'))
+
+    def test_max_keys(self):
+        for key in 'abcdefghij':
+            self.limiter.allow(key)
+        self.assertLessEqual(len(self.limiter), 8)
+
+    def test_unlimited(self):
+        limiter = RateLimiter(rate=0)
+        self.assertTrue(all(limiter.allow('a') for i in range(1000)))
+        self.assertEqual(len(limiter), 0)
+
+    def test_concurrency(self):
+        limit = ConcurrencyLimit(2)
+        self.assertEqual([limit.acquire() for i in range(3)], [True, True, False])
+        limit.release()
+        self.assertTrue(limit.acquire())
+        self.assertEqual(limit.stats(), dict(active=2, peak=2, limit=2, shed=1))
+        self.assertTrue(all(ConcurrencyLimit(0).acquire() for i in range(1000)))
+
+
+class TestUserAgents(unittest.TestCase):
+
+    def test_parse(self):
+        for user_agent, expected in (
+            ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
+                ('desktop', 'chrome', 'windows')),
+            ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36 Edg/91.0.864.59",
+                ('desktop', 'edge', 'windows')),
+            ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_4) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.1 Safari/603.1.30",
+                ('desktop', 'safari', 'macos')),
+            ("Mozilla/5.0 (Linux; Android 7.0; SM-G930F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.83 Mobile Safari/537.36",
+                ('mobile', 'chrome', 'android')),
+            ("Mozilla/5.0 (Linux; Android 7.0; SM-T810) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.83 Safari/537.36",
+                ('tablet', 'chrome', 'android')),
+            ("Mozilla/5.0 (iPad; CPU OS 10_3 like Mac OS X) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.0 Mobile/14E277 Safari/602.1",
+                ('tablet', 'safari', 'ios')),
+            ("Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0", ('desktop', 'firefox', 'linux')),
+            ("Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; Trident/5.0)", ('desktop', 'ie', 'windows')),
+        ):
+            agent = parse_user_agent(user_agent)
+            self.assertEqual((agent.device, agent.browser, agent.os), expected, user_agent)
+            self.assertFalse(agent.bot)
+
+    def test_bots(self):
+        for user_agent in ("Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+                           "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)",
+                           "Mozilla/5.0 (compatible; Yahoo! Slurp; http://help.yahoo.com/help/us/ysearch/slurp)",
+                           "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
+                           "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) HeadlessChrome/79.0.3945.0 Safari/537.36",
+                           "Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)",
+                           "Mozilla/5.0 (compatible; bot)",
+                           "python-requests/2.18.4", "curl/7.54.0"):
+            agent = parse_user_agent(user_agent)
+            self.assertTrue(agent.bot, user_agent)
+            self.assertEqual(agent.device, 'bot')
+
+        # Not bots, though they contain "bot"
+        for user_agent in ("Mozilla/5.0 (Linux; Android 9; CUBOT X19) AppleWebKit/537.36 (KHTML, like Gecko) "
+                           "Chrome/74.0.3729.136 Mobile Safari/537.36",
+                           "Mozilla/5.0 (Linux; Android 10; CUBOT_NOTE_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+                           "Chrome/88.0.4324.181 Mobile Safari/537.36"):
+            self.assertEqual(parse_user_agent(user_agent), UserAgent('mobile', 'chrome', 'android'), user_agent)
+
+    def test_cache(self):
+        agents = UserAgents(maxsize=2)
+        chrome = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36"
+        for i in range(3):
+            self.assertEqual(agents.classify(chrome), UserAgent('desktop', 'chrome', 'windows'))
+        self.assertIs(agents.classify(''), UNKNOWN)
+        self.assertIs(agents.classify(None), UNKNOWN)
+        stats = agents.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['parses']), (2, 1, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3.0)
+        self.assertGreater(stats['parse_seconds'], 0)
+
+        # Bounded, least recently used evicted
+        agents.classify("curl/7.54.0")
+        agents.classify("Wget/1.19")
+        self.assertEqual(len(agents.cache), 2)
+        self.assertNotIn(chrome, agents.cache)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LRUCache(maxsize=2, ttl=10, negative_ttl=5, clock=lambda: self.now)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a') # a is now most recently used
+        self.cache.set('c', 3)
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_ttl(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', None)
+        self.now += 6
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache) # Negative entries expire sooner
+        self.now += 5
+        self.assertNotIn('a', self.cache)
+
+        # Set with its own ttl
+        self.cache.set('c', 1, ttl=None)
+        self.cache.set('d', None, ttl=20)
+        self.now += 1000
+        self.assertIn('c', self.cache)
+        self.assertNotIn('d', self.cache)
+
+    def test_get_or_load(self):
+        calls = []
+        loader = lambda: calls.append(1) or None
+        self.assertIsNone(self.cache.get_or_load('a', loader))
+        self.assertIsNone(self.cache.get_or_load('a', loader))
+        self.assertEqual(len(calls), 1) # Miss was negatively cached
+
+    def test_get_or_load_once(self):
+        # Concurrent misses of a key share one load
+        calls = []
+        started, release = threading.Event(), threading.Event()
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 1
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_load('a', loader))) for i in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1] * 4)
+        self.assertEqual(len(calls), 1)
+
+        # A failed load caches nothing
+        def failing():
+            raise ValueError("database down")
+        self.assertRaises(ValueError, self.cache.get_or_load, 'b', failing)
+        self.assertEqual(self.cache.get_or_load('b', lambda: 2), 2)
+
+    def test_invalidate_during_load(self):
+        # A load overtaken by an invalidation returns its value, but doesn't cache it
+        def loader():
+            self.cache.invalidate('a')
+            return 'stale'
+        self.assertEqual(self.cache.get_or_load('a', loader), 'stale')
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(self.cache.get_or_load('a', lambda: 'fresh'), 'fresh')
+
+        # Likewise a set, which is newer
+        def loader():
+            self.cache.set('b', 'newer')
+            return 'older'
+        self.cache.get_or_load('b', loader)
+        self.assertEqual(self.cache.get('b'), 'newer')
+
+        def loader():
+            self.cache.clear()
+            return 'stale'
+        self.cache.get_or_load('c', loader)
+        self.assertNotIn('c', self.cache)
+
+    def test_invalidate(self):
+        self.cache.set('a', 1)
+        self.assertTrue(self.cache.invalidate('a'))
+        self.assertFalse(self.cache.invalidate('a'))
+        self.assertIsNone(self.cache.get('a'))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Cached user agent classification
+#
+# UserAgent : The device, browser, OS and bot classification of a user agent string
+# UserAgents : Classifies user agent strings, caching the result for each distinct string
+#
+# Every beacon carries its browser's user agent string, but sites see few
+# distinct strings compared with their page views, so each is parsed once
+# and its classification cached, most recently used first. Crawlers are
+# recognised by one precompiled pattern, tried before anything else, so a
+# crawler's requests can be answered without storing a visitor or choosing
+# components. The other patterns are tried in order, first match wins, as
+# user agents name the browsers they're compatible with as well as their own.
+
+import re
+import time
+import threading
+from cache import LRUCache
+
+# Crawlers, monitors, headless browsers and HTTP libraries. "bot" counts as a word of its own, or the end of a
+# product name, eg Googlebot/2.1, but not inside a device name, eg the CUBOT phones. Crawlers link to their
+# documentation, eg "+http://www.google.com/bot.html".
+BOT = re.compile(r"(?<![a-z])bot\b|[a-z]bot/|\+https?://|crawl|spider|slurp|archiver|facebookexternalhit|embedly|"
+                 r"lighthouse|pingdom|headless|phantomjs|python-|curl/|wget/|go-http-client|java/|okhttp|scrapy|libwww", re.I).search
+
+# (name, pattern) rules in order of precedence
+BROWSERS = [(name, re.compile(pattern).search) for name, pattern in (
+    ('edge',    r"Edge?/|EdgA/|EdgiOS/"),
+    ('opera',   r"OPR/|Opera"),
+    ('samsung', r"SamsungBrowser/"),
+    ('chrome',  r"Chrome/|CriOS/"),
+    ('firefox', r"Firefox/|FxiOS/"),
+    ('ie',      r"MSIE |Trident/"),
+    ('safari',  r"Safari/"),
+)]
+SYSTEMS = [(name, re.compile(pattern).search) for name, pattern in (
+    ('windows',  r"Windows"),
+    ('ios',      r"iPhone|iPad|iPod"),
+    ('android',  r"Android"),
+    ('chromeos', r"CrOS"),
+    ('macos',    r"Macintosh|Mac OS X"),
+    ('linux',    r"Linux"),
+)]
+DEVICES = [(name, re.compile(pattern).search) for name, pattern in (
+    ('tablet', r"iPad|Tablet|Kindle|Silk/|Android(?!.*Mobile)"),
+    ('mobile', r"Mobi|iPhone|iPod|Android|Windows Phone"),
+)]
+
+
+class UserAgent(object):
+
+    __slots__ = ('device', 'browser', 'os', 'bot')
+
+    def __init__(self, device, browser, os, bot=False):
+        """Construct a classification: device is 'desktop', 'mobile', 'tablet', 'bot' or 'unknown'"""
+        self.device  = device
+        self.browser = browser
+        self.os      = os
+        self.bot     = bot
+
+    def __repr__(self):
+        return "<UserAgent %s %s %s%s>" % (self.device, self.browser, self.os, " bot" if self.bot else "")
+
+    def __eq__(self, other):
+        return isinstance(other, UserAgent) and self.fields() == other.fields()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def fields(self):
+        """Return the classification as beacon fields, for segmenting"""
+        return dict(device=self.device, browser=self.browser, os=self.os)
+
+
+UNKNOWN   = UserAgent('unknown', 'other', 'other')
+BOT_AGENT = UserAgent('bot', 'other', 'other', bot=True)
+
+
+def first_match(rules, user_agent, default):
+    """Return the name of the first rule matching user_agent, or default"""
+    for name, search in rules:
+        if search(user_agent):
+            return name
+    return default
+
+
+def parse(user_agent):
+    """Return the UserAgent classification of a user agent string"""
+    if not user_agent:
+        return UNKNOWN
+    if BOT(user_agent):
+        return BOT_AGENT
+    return UserAgent(first_match(DEVICES, user_agent, 'desktop'), first_match(BROWSERS, user_agent, 'other'),
+        first_match(SYSTEMS, user_agent, 'other'))
+
+
+class UserAgents(object):
+
+    def __init__(self, maxsize=10000):
+        """Construct a classifier caching the classification of at most maxsize user agent strings"""
+        self.cache         = LRUCache(maxsize=maxsize)
+        self.lock          = threading.Lock()
+        self.parses        = 0
+        self.parse_seconds = 0.0
+
+    def classify(self, user_agent):
+        """Return the UserAgent classification of a user agent string, parsed once while cached"""
+        if not user_agent:
+            return UNKNOWN
+        return self.cache.get_or_load(user_agent, lambda: self._parse(user_agent))
+
+    def _parse(self, user_agent):
+        """Parse a user agent string not in the cache, timing it"""
+        start = time.time()
+        agent = parse(user_agent)
+        elapsed = time.time() - start
+        with self.lock:
+            self.parses += 1
+            self.parse_seconds += elapsed
+        return agent
+
+    def stats(self):
+        """Return cache and parse counters as a dict"""
+        stats = self.cache.stats()
+        with self.lock:
+            stats.update(parses=self.parses, parse_seconds=self.parse_seconds)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Craig Russell <craig@craig-russell.co.uk>
+# Sharded store of visitor segment state
+#
+# MemoryBackend : Encoded visitor states in a bounded LRU dict per shard
+# DiskBackend : Encoded visitor states in an embedded SQLite file per shard
+# VisitorStore : Visitor states keyed by data_id, sharded by its hash, cached hot and written back in batches
+#
+# A data_id, "<customer>-<visitor>", is hashed to one of a fixed number of
+# shards. Each shard has its own lock, LRU cache of hot states, and table in
+# the backend, so neither lookups nor writes contend across shards. A cold
+# visitor is loaded from the backend on first use. Updated states are marked
+# dirty and written back in batches by a background thread; a dirty state
+# stays reachable until it is written, so evicting it from the cache can't
+# lose it, and a reload can't see a stale copy.
+#
+# Each pre-fork worker has its own cache, so with the disk backend a visitor
+# whose beacons reach two workers has a copy cached in each. Every write
+# stores a fresh version token alongside the state, and a cached state is
+# revalidated against the stored token when it is reused more than
+# revalidate_after seconds after it was last found current, so a worker
+# reloads a visitor another worker has since written, and hot visitors cost
+# one query per interval rather than per beacon. Updates still pending in two
+# workers at once, within one flush_interval, conflict: the later write wins,
+# and the conflict is counted. The memory backend is private to its process,
+# so with it visitor state is per worker, and it forgets the least recently
+# used visitors beyond its bound.
+#
+# States are stored compactly with marshal: fields of basic types, aggregates
+# as lists with their window length, segments and when they expire.
+
+import os
+import time
+import zlib
+import itertools
+import atexit
+import logging
+import marshal
+import sqlite3
+import threading
+from collections import deque, OrderedDict
+from cache import LRUCache
+from segments import VisitorState
+
+logger = logging.getLogger('APE')
+
+FORMAT = 1 # Version of the encoded state
+TOKENS = itertools.count(1) # Writes made by this process, for version tokens
+
+
+def encode_state(state):
+    """Return a VisitorState packed as a string"""
+    aggregates = dict((key, (getattr(value, 'maxlen', None), list(value))) for key, value in state.aggregates.items())
+    return marshal.dumps((FORMAT, dict(state.fields), aggregates, tuple(state.segments), state.expires), 2)
+
+
+def decode_state(body):
+    """Return the VisitorState packed in a string by encode_state"""
+    version, fields, aggregates, segments, expires = marshal.loads(body)
+    if version != FORMAT:
+        raise ValueError("Unknown visitor state format %r" % version)
+    state = VisitorState()
+    if fields:
+        state.fields = fields
+    if aggregates:
+        state.aggregates = dict((key, deque(values, maxlen) if maxlen else values)
+            for key, (maxlen, values) in aggregates.items())
+    state.segments = frozenset(segments)
+    state.expires  = expires
+    return state
+
+
+def call(func, *args):
+    """Call func(*args), where it is"""
+    return func(*args)
+
+
+def shard_of(key, shards):
+    """Return the shard number of a unicode key"""
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % shards
+
+
+class MemoryBackend(object):
+
+    shared   = False # Private to this process, so cached states are never stale
+    blocking = False # Calls never wait on I/O
+
+    def __init__(self, shards, max_states=None):
+        """Construct an empty backend of shards dicts, lost when the process ends, holding at most
+        max_states states in all, the least recently used forgotten first, or unbounded if None"""
+        self.tables    = [OrderedDict() for i in range(shards)]
+        self.max_table = max(max_states // shards, 1) if max_states else None
+        self.evictions = 0
+
+    def load(self, shard, key):
+        """Return (encoded state, version) stored for key, or None"""
+        table = self.tables[shard]
+        row = table.pop(key, None)
+        if row is not None:
+            table[key] = row # Most recently used
+        return row
+
+    def version(self, shard, key):
+        """Return the version stored for key, or None"""
+        row = self.tables[shard].get(key)
+        return row[1] if row else None
+
+    def save_many(self, shard, items):
+        """Store (key, encoded state, version read, new version) items, returning how many had been
+        written elsewhere since they were read. Those are overwritten all the same."""
+        table = self.tables[shard]
+        conflicts = 0
+        for key, body, expected, version in items:
+            row = table.pop(key, None)
+            if (row[1] if row else None) != expected:
+                conflicts += 1
+            table[key] = (body, version)
+        while self.max_table and len(table) > self.max_table:
+            table.popitem(last=False)
+            self.evictions += 1
+        return conflicts
+
+    def count(self):
+        """Return the number of states stored"""
+        return sum(len(table) for table in self.tables)
+
+    def close(self):
+        pass
+
+
+class DiskBackend(object):
+
+    shared   = True # Sibling processes may write the same files
+    blocking = True # Calls wait on the disk
+
+    def __init__(self, directory, shards):
+        """Construct a backend of one SQLite file per shard in directory, opened on first use.
+        Sibling processes may share the files; each opens its own connections."""
+        self.directory   = directory
+        self.shards      = shards
+        self.connections = dict()
+        self.pid         = None
+        self.lock        = threading.Lock()
+
+    def _connection(self, shard):
+        """Return this process's connection to a shard's file. Caller holds the shard's backend lock."""
+        if self.pid != os.getpid():
+            # Connections inherited across a fork can't be used
+            with self.lock:
+                self.connections = dict()
+                self.pid = os.getpid()
+        connection = self.connections.get(shard)
+        if connection is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory, "visitors-%03d.db" % shard)
+            connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS states (id TEXT PRIMARY KEY, state BLOB, version INTEGER) "
+                "WITHOUT ROWID")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(states)")]
+            if 'version' not in columns:
+                connection.execute("ALTER TABLE states ADD COLUMN version INTEGER") # Written before versioning
+            self.connections[shard] = connection
+        return connection
+
+    def load(self, shard, key):
+        row = self._connection(shard).execute("SELECT state, version FROM states WHERE id = ?", (key,)).fetchone()
+        return (str(row[0]), row[1]) if row else None
+
+    def version(self, shard, key):
+        row = self._connection(shard).execute("SELECT version FROM states WHERE id = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, shard, items):
+        connection = self._connection(shard)
+        conflicts = 0
+        with connection:
+            for key, body, expected, version in items:
+                if expected is None:
+                    cursor = connection.execute("INSERT OR IGNORE INTO states (id, state, version) VALUES (?, ?, ?)",
+                        (key, buffer(body), version))
+                else:
+                    cursor = connection.execute("UPDATE states SET state = ?, version = ? WHERE id = ? AND version = ?",
+                        (buffer(body), version, key, expected))
+                if cursor.rowcount != 1:
+                    conflicts += 1
+                    connection.execute("INSERT OR REPLACE INTO states (id, state, version) VALUES (?, ?, ?)",
+                        (key, buffer(body), version))
+        return conflicts
+
+    def count(self):
+        return sum(self._connection(shard).execute("SELECT COUNT(*) FROM states").fetchone()[0]
+            for shard in range(self.shards))
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = dict()
+
+
+class _Shard(object):
+
+    __slots__ = ('number', 'cache', 'dirty', 'flushing', 'lock', 'io')
+
+    def __init__(self, number, cache_size):
+        self.number   = number
+        self.cache    = LRUCache(maxsize=cache_size)
+        self.dirty    = dict() # Key => state updated since the last write
+        self.flushing = dict() # Key => state being written now
+        self.lock     = threading.Lock() # Guards dirty and flushing, never held across I/O
+        self.io       = threading.Lock() # One backend call on the shard at a time
+
+
+class VisitorStore(object):
+
+    def __init__(self, backend, shards=16, cache_size=100000, batch_size=500, flush_interval=1.0,
+                 revalidate_after=1.0, clock=time.time):
+        """Construct a store of shards shards over backend, caching at most cache_size hot states in all,
+        and writing dirty states back in batches of batch_size, or after flush_interval seconds. A cached
+        state from a backend shared with other processes is checked against it when reused after
+        revalidate_after seconds."""
+        self.backend          = backend
+        self.revalidate_after = revalidate_after
+        self.clock            = clock
+        self.shards         = [_Shard(i, max(cache_size // shards, 1)) for i in range(shards)]
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.wake           = threading.Event()
+        self.thread         = None
+        self.pid            = None
+        self.lock           = threading.Lock()
+        self.flush_lock     = threading.Lock() # One flush at a time
+        self.run_blocking   = call # Runs backend reads for requests, replaced to move them off an event loop
+        self.counts         = dict(loads=0, created=0, written=0, batches=0, errors=0, stale=0, conflicts=0)
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def _shard(self, key):
+        return self.shards[shard_of(key, len(self.shards))]
+
+    def offload(self, run_blocking, event):
+        """Run backend reads for requests through run_blocking(func, *args), eg on a threadpool off an event
+        loop, with requests waiting on another's load of the same visitor using event. A backend that
+        doesn't block is left where it is."""
+        if self.backend.blocking:
+            self.run_blocking = run_blocking
+            for shard in self.shards:
+                shard.cache.event = event
+
+    def _read(self, shard, read, key):
+        """Return read(shard number, key) from the backend, through run_blocking"""
+        def locked():
+            with shard.io:
+                return read(shard.number, key)
+        return self.run_blocking(locked)
+
+    def get(self, data_id, new=False):
+        """Return the state for data_id from the cache, or loaded from the backend, or a new state.
+        A new visitor, whose id was just made, skips the backend."""
+        key = data_id if isinstance(data_id, unicode) else data_id.decode('utf-8', 'replace')
+        shard = self._shard(key)
+        if new:
+            self._count('created')
+            return shard.cache.set(key, VisitorState())
+        loaded = []
+        def load():
+            loaded.append(True)
+            return self._load(shard, key)
+        state = shard.cache.get_or_load(key, load)
+        if loaded or not self.backend.shared:
+            return state
+        now = self.clock()
+        if now - state.checked < self.revalidate_after:
+            return state
+        if self._current(shard, key, state):
+            state.checked = now
+            return state
+        self._count('stale')
+        return shard.cache.set(key, self._load(shard, key))
+
+    def _current(self, shard, key, state):
+        """Return whether a cached state is the latest, not since written by another process"""
+        with shard.lock:
+            if key in shard.dirty or key in shard.flushing:
+                return True # Updated here since, and about to be written
+        return self._read(shard, self.backend.version, key) == state.version
+
+    def _load(self, shard, key):
+        """Return the state for key not in the cache: pending a write, stored, or new"""
+        with shard.lock:
+            state = shard.dirty.get(key) or shard.flushing.get(key)
+            if state is not None:
+                return state
+        # Not pending, so any write of it has finished
+        checked = self.clock()
+        row = self._read(shard, self.backend.load, key)
+        if row is None:
+            self._count('created')
+            state = VisitorState()
+        else:
+            self._count('loads')
+            body, version = row
+            state = decode_state(body)
+            state.version = version
+        state.checked = checked
+        return state
+
+    def save(self, data_id, state):
+        """Mark the state for data_id updated, to be written back in the next batch"""
+        key = data_id if isinstance(data_id, unicode) else data_id.decode('utf-8', 'replace')
+        shard = self._shard(key)
+        with shard.lock:
+            shard.dirty[key] = state
+            full = len(shard.dirty) >= self.batch_size
+        if self.pid != os.getpid():
+            self.start()
+        if full:
+            self.wake.set()
+
+    def start(self):
+        """Start the background writer in this process, if not already running"""
+        with self.lock:
+            if self.pid == os.getpid():
+                return self
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._work, name="visitor-store")
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def _work(self):
+        """Writer loop: write dirty states back when a shard fills a batch, or every flush_interval"""
+        while self.thread is threading.current_thread():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every dirty state back to the backend, returning how many were written"""
+        with self.flush_lock:
+            written = sum(self._flush(shard) for shard in self.shards)
+        self._count('written', written)
+        return written
+
+    def _flush(self, shard):
+        """Write a shard's dirty states back, returning how many were written"""
+        with shard.lock:
+            if not shard.dirty:
+                return 0
+            shard.flushing, shard.dirty = shard.dirty, dict()
+            states = shard.flushing.items()
+        written = 0
+        try:
+            for i in range(0, len(states), self.batch_size):
+                chunk = states[i:i + self.batch_size]
+                batch = [(key, encode_state(state), state.version, self._token()) for key, state in chunk]
+                with shard.io:
+                    conflicts = self.backend.save_many(shard.number, batch)
+                with shard.lock:
+                    for (key, state), item in zip(chunk, batch):
+                        state.version = item[3]
+                        state.checked = self.clock()
+                self._count('batches')
+                self._count('conflicts', conflicts)
+                written += len(batch)
+        except Exception:
+            self._count('errors')
+            logger.exception("Visitor store failed writing %d states to shard %d", len(states), shard.number)
+            with shard.lock:
+                for key, state in states:
+                    shard.dirty.setdefault(key, state) # Retry next time, unless updated since
+        with shard.lock:
+            shard.flushing = dict()
+        return written
+
+    def _token(self):
+        """Return a version token unique to this write, among every process sharing the backend"""
+        return (os.getpid() << 32) + next(TOKENS)
+
+    def close(self):
+        """Stop the background writer and write back every dirty state"""
+        with self.lock:
+            thread, self.thread, self.pid = self.thread, None, None
+        if thread is not None and thread.is_alive():
+            self.wake.set()
+            thread.join()
+        self.flush()
+        self.backend.close()
+
+    def register_shutdown(self):
+        """Write back on interpreter exit"""
+        atexit.register(self.close)
+        return self
+
+    def stats(self):
+        """Return store counters as a dict, with the cache counters summed over shards"""
+        with self.lock:
+            stats = dict(self.counts)
+        for name in ('size', 'maxsize', 'hits', 'misses', 'evictions'):
+            stats[name] = sum(shard.cache.stats()[name] for shard in self.shards)
+        stats['dirty'] = sum(len(shard.dirty) for shard in self.shards)
+        return stats
+
+
+def make_backend(name, directory, shards, max_states=None):
+    """Return the backend called name, 'memory' or 'disk', storing shards shards, on disk in directory,
+    or in memory for at most max_states visitors"""
+    if name == 'memory':
+        return MemoryBackend(shards, max_states)
+    if name == 'disk':
+        return DiskBackend(directory, shards)
+    raise ValueError("Unknown visitor store backend %r" % name)